@@ -0,0 +1,107 @@
+"""Benchmark joining the NW.js executable and the app.nw payload
+
+Times utils.join_files with every copy method on its own against the old
+4 KB read/write loop, in each of the given directories. Pass directories
+on different file systems, such as tmpfs and ext4, to compare them.
+
+Run Example:
+    From the root of the repository, execute
+
+        $ python benchmarks/bench_join_files.py --size 150 /dev/shm /var/tmp
+
+"""
+
+import os
+import io
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import functools
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import utils
+
+
+def read_write_loop(destination, *args):
+    """The join_files implementation this benchmark compares against"""
+    with io.open(destination, "wb") as dest_file:
+        for arg in args:
+            with io.open(arg, "rb") as file:
+                while True:
+                    data = file.read(4096)
+                    if len(data) == 0:
+                        break
+                    dest_file.write(data)
+    return "4 KB loop"
+
+
+def join_with(methods, destination, *args):
+    return utils.join_files(destination, *args, methods=methods)
+
+
+def make_file(path, size):
+    block = os.urandom(1024 * 1024)
+    with open(path, "wb") as f:
+        for _ in range(size // len(block)):
+            f.write(block)
+        f.write(block[: size % len(block)])
+
+
+def run(directory, exe_size, payload_size, repeat):
+    work_dir = tempfile.mkdtemp(prefix="bench_join_", dir=directory)
+    try:
+        exe = os.path.join(work_dir, "nw.exe")
+        payload = os.path.join(work_dir, "app.nw")
+        make_file(exe, exe_size)
+        make_file(payload, payload_size)
+
+        joiners = [("4 KB loop", read_write_loop)]
+        for method in utils.JOIN_METHODS:
+            joiners.append((method, functools.partial(join_with, [method])))
+
+        total = exe_size + payload_size
+        print(directory)
+
+        for name, joiner in joiners:
+            best = None
+            used = None
+            for index in range(repeat):
+                dest = os.path.join(work_dir, "joined{}.exe".format(index))
+                start = time.perf_counter()
+                used = joiner(dest, exe, payload)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+                os.remove(dest)
+
+            print(
+                "  {:<16} {:>9.1f} MB/s  (used {})".format(
+                    name, total / best / 1024 / 1024, used
+                )
+            )
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directories", nargs="*", default=[tempfile.gettempdir()])
+    parser.add_argument("--size", type=int, default=150, help="exe size in MB")
+    parser.add_argument("--payload", type=int, default=30, help="app.nw size in MB")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    for directory in args.directories:
+        run(
+            directory,
+            args.size * 1024 * 1024,
+            args.payload * 1024 * 1024,
+            args.repeat,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Benchmark the compiled FileTree path matcher
+
+Compares matching a synthetic project tree against the blacklist and
+whitelist one fnmatch call at a time with the compiled PathMatcher.
+
+Run Example:
+    From the root of the repository, execute
+
+        $ python benchmarks/bench_path_matcher.py --paths 500000
+
+"""
+
+import os
+import sys
+import time
+import argparse
+from fnmatch import fnmatch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from util_classes import PathMatcher
+
+BLACKLIST = [
+    "node_modules*",
+    "*.git*",
+    "*.psd",
+    "*.map",
+    "*/test/*",
+    "*.[oa]",
+    "build",
+    "*output*",
+]
+
+WHITELIST = ["node_modules/keep*", "*.min.js", "docs/*.md"]
+
+EXTENSIONS = [".js", ".min.js", ".css", ".png", ".map", ".md", ".psd", ".o", ".html"]
+
+TOP_DIRS = ["src", "js", "css", "docs", "node_modules", ".git", "assets"]
+
+
+def synthetic_paths(count):
+    """Generate count project relative paths spread over a deep tree"""
+    paths = []
+    index = 0
+    while len(paths) < count:
+        top = TOP_DIRS[index % len(TOP_DIRS)]
+        middle = "pkg{}".format(index % 997)
+        sub = "test" if index % 13 == 0 else "lib{}".format(index % 31)
+        ext = EXTENSIONS[index % len(EXTENSIONS)]
+        paths.append(os.path.join(top, middle, sub, "file{}{}".format(index, ext)))
+        index += 1
+    return paths
+
+
+def fnmatch_loop(path):
+    skip = False
+    for pattern in BLACKLIST:
+        if fnmatch(path, pattern):
+            skip = True
+            break
+    for pattern in WHITELIST:
+        if fnmatch(path, pattern):
+            skip = False
+            break
+    return skip
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--paths", type=int, default=500000)
+    args = parser.parse_args()
+
+    paths = synthetic_paths(args.paths)
+
+    start = time.perf_counter()
+    expected = [fnmatch_loop(path) for path in paths]
+    loop_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    matcher = PathMatcher(WHITELIST, BLACKLIST)
+    result = [matcher.match(path) == PathMatcher.EXCLUDE for path in paths]
+    matcher_time = time.perf_counter() - start
+
+    assert result == expected, "the compiled matcher disagrees with fnmatch"
+
+    print("paths:         {}".format(len(paths)))
+    print("excluded:      {}".format(sum(result)))
+    print("fnmatch loop:  {:.3f}s".format(loop_time))
+    print("PathMatcher:   {:.3f}s".format(matcher_time))
+    print("speedup:       {:.1f}x".format(loop_time / matcher_time))
+
+
+if __name__ == "__main__":
+    main()
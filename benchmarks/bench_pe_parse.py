@@ -0,0 +1,92 @@
+"""Benchmark constructing a PEFile for an NW.js executable
+
+Times constructing a PEFile, constructing it and looking up the icon
+resources that replace_icon needs, and constructing it and walking the
+whole resource tree, which is what the constructor used to do. Each exe
+is copied to a temporary directory first, so the memory mapped runs
+can't change it.
+
+Run Example:
+    From the root of the repository, execute
+
+        $ python benchmarks/bench_pe_parse.py path/to/nw.exe
+
+    The nw.exe files unpacked into the runtime cache under the download
+    directory are the sizes that get exported.
+
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pe import PEFile, ResourceTypes
+
+
+def construct(path, in_place):
+    with PEFile(path, in_place=in_place):
+        pass
+
+
+def icon_lookup(path, in_place):
+    with PEFile(path, in_place=in_place) as p:
+        for resource_type in (ResourceTypes.Group_Icon, ResourceTypes.Icon):
+            directory = p.get_directory_by_type(resource_type)
+            directory.subdirectory_tables[0].data_entries[0]
+
+
+def full_walk(path, in_place):
+    with PEFile(path, in_place=in_place) as p:
+        stack = [p.resource_directory_table]
+        while stack:
+            table = stack.pop()
+            for entry in table.data_entries:
+                entry.data
+            stack.extend(table.subdirectory_tables)
+
+
+def best_time(function, path, in_place, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(path, in_place)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("exes", nargs="+")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="bench_pe_")
+    try:
+        for exe in args.exes:
+            path = os.path.join(work_dir, "nw.exe")
+            shutil.copy(exe, path)
+            print("{} ({:.1f} MB)".format(exe, os.path.getsize(path) / 1024 / 1024))
+
+            for in_place in (False, True):
+                mode = "mmap" if in_place else "read"
+                for name, function in [
+                    ("construct", construct),
+                    ("icon lookup", icon_lookup),
+                    ("full walk", full_walk),
+                ]:
+                    elapsed = best_time(function, path, in_place, args.repeat)
+                    print(
+                        "  {:<5} {:<12} {:>9.2f} ms".format(mode, name, elapsed * 1000)
+                    )
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -26,6 +26,7 @@ import time
 import sys
 import os
 import glob
+import tempfile
 import json
 import shutil
 import stat
@@ -36,6 +37,9 @@ import subprocess
 import plistlib
 import codecs
 import logging
+import hashlib
+import threading
+from concurrent import futures
 from datetime import datetime, timedelta
 
 from io import StringIO
@@ -43,17 +47,35 @@ from io import StringIO
 import config
 import utils
 from utils import zip_files, join_files
+from utils import prepare_zip_entries, write_zip_entries
 from utils import get_data_path, get_data_file_path
-from util_classes import Setting, FileTree
+from util_classes import Setting, FileTree, RuntimeCache, RangedDownloader
+from util_classes import ArtifactStore, UpxCache, PatchedExeCache
 
 from image_utils.pycns import save_icns
-from pe import PEFile
+from pe import PEFile, ICON_SIZES, ICON_PATCH_VERSION
 
 from semantic_version import Version
 
 from configobj import ConfigObj
 
 
+class ExportError(Exception):
+    """Raised when one or more platforms failed to export"""
+
+    def __init__(self, errors):
+        self.errors = errors
+        names = ", ".join(sorted(errors.keys()))
+        super(ExportError, self).__init__("Export failed for: {}".format(names))
+
+    def report(self):
+        """Get the error of every failed platform, one after another"""
+        return "".join(
+            "\nFailed to export {}:\n{}".format(name, error)
+            for name, error in self.errors.items()
+        )
+
+
 class CommandBase(object):
     """The common class for the CMD and the GUI"""
 
@@ -71,8 +93,20 @@ class CommandBase(object):
         self.original_packagejson = {}
         self.readonly = True
         self.update_json = True
-
-        self.file_tree = FileTree()
+        self.app_nw_hash = None
+        self.app_nw_entries = None
+        self.export_jobs = None
+        self.export_errors = {}
+        self.streamed_runtimes = set()
+        self.payload_store = None
+        self.upx_versions = {}
+        self._workspace_dir = None
+        self.upx_lock = threading.Lock()
+        self._stage_local = threading.local()
+        self._stage_lock = threading.Lock()
+        self._stage_progress = {}
+
+        self.file_tree = FileTree(index_dir=get_data_path("files/file_index"))
 
     def init(self):
         self.logger = config.getLogger(__name__)
@@ -528,10 +562,30 @@ class CommandBase(object):
     @property
     def progress_text(self):
         """Get the progress text currently set"""
-        return self._progress_text
+        if getattr(self._stage_local, "name", None) is not None:
+            return self._stage_local.text
+        return self.get_progress_text()
 
     @progress_text.setter
     def progress_text(self, value):
+        """Show progress text.
+
+        Platform stages run on worker threads, so their progress is only
+        recorded here and shown by run_export_stages from the thread
+        that started them.
+        """
+        stage_name = getattr(self._stage_local, "name", None)
+        if stage_name is not None:
+            self._stage_local.text = value
+            with self._stage_lock:
+                self._stage_progress[stage_name] = value
+            return
+        self.set_progress_text(value)
+
+    def get_progress_text(self):
+        return self._progress_text
+
+    def set_progress_text(self, value):
         """Write progress text to the terminal
 
         Args:
@@ -542,6 +596,14 @@ class CommandBase(object):
             sys.stdout.write("\r{}".format(self._progress_text))
             sys.stdout.flush()
 
+    def show_stage_progress(self):
+        """Show the progress the platform stages recorded since last time"""
+        with self._stage_lock:
+            progress, self._stage_progress = self._stage_progress, {}
+        for name, text in sorted(progress.items()):
+            if text and text.strip():
+                self.progress_text = "\n[{}] {}".format(name, text.strip())
+
     def load_from_json(self, json_str):
         """Load settings from the supplied json string
 
@@ -593,32 +655,128 @@ class CommandBase(object):
             or self.get_setting("nw_version").values[0]
         )
 
+    def runtime_cache(self):
+        """Get the cache of extracted NW.js runtimes in the download location"""
+        location = self.get_setting("download_dir").value or config.download_path()
+
+        try:
+            max_size = int(self.get_setting("runtime_cache_size").value or 0)
+        except ValueError:
+            max_size = 0
+
+        return RuntimeCache(location, max_size * 1024 * 1024)
+
+    def runtime_key(self, ex_setting):
+        """Get the runtime cache key of the export setting"""
+        sdk_build = self.get_setting("sdk_build").value
+        return self.runtime_cache().key(self.selected_version(), ex_setting, sdk_build)
+
+    def runtime_path(self, ex_setting):
+        """Get the path of the cached NW.js runtime for the export setting"""
+        return self.runtime_cache().entry_path(self.runtime_key(ex_setting))
+
+    def prune_runtimes(self, max_size=None):
+        """
+        Remove broken runtimes from the cache and evict the least recently
+        used ones until the cache fits in max_size bytes.
+
+        Args:
+            max_size: the size cap in bytes, defaults to the
+                      runtime_cache_size setting
+
+        Returns:
+            A list of the removed runtime keys
+        """
+        return self.runtime_cache().prune(max_size)
+
+    def artifact_store(self):
+        """Get the content-addressed store of exported files"""
+        location = self.get_setting("download_dir").value or config.download_path()
+        return ArtifactStore(location)
+
+    def store_artifacts(self, ex_setting, output_dir):
+        """
+        Replace the exported files with hardlinks into the artifact store,
+        keeping the plain files if that is not possible.
+        """
+        try:
+            num_files, saved = self.artifact_store().add_tree(output_dir)
+        except OSError as e:
+            self.logger.warning(
+                "Could not add {} to the artifact store: {}".format(ex_setting.name, e)
+            )
+            return
+
+        self.logger.info(
+            "Stored {} files of {}, {:.1f} MB were already stored".format(
+                num_files, ex_setting.name, saved / 1024.0 / 1024.0
+            )
+        )
+
+    def gc_artifact_store(self):
+        """
+        Remove the blobs of the artifact store that no export uses anymore.
+
+        Returns:
+            A tuple of the number of blobs and bytes removed
+        """
+        return self.artifact_store().gc()
+
     def extract_files(self):
-        """Extract nw.js files to the specific version path"""
+        """Extract nw.js files into the runtime cache if needed"""
         self.extract_error = None
+
+        cache = self.runtime_cache()
+        used_keys = []
+
+        for setting_name, setting in self.settings["export_settings"].items():
+            if setting.value:
+                used_keys.append(self.extract_file(setting, cache))
+                self.progress_text += "."
+
+        cache.prune(keep=used_keys)
+
+        self.progress_text = "\nDone.\n"
+        return True
+
+    def extract_file(self, setting, cache=None):
+        """Extract the nw.js archive for one export setting if needed
+
+        Args:
+            setting: the export setting whose archive to extract
+            cache: the runtime cache to extract into
+
+        Returns:
+            The runtime cache key of the setting
+        """
         location = self.get_setting("download_dir").value or config.download_path()
 
         sdk_build_setting = self.get_setting("sdk_build")
         sdk_build = sdk_build_setting.value
         version = self.selected_version()
+        forced = self.get_setting("force_download").value
 
-        for setting_name, setting in self.settings["export_settings"].items():
-            save_file_path = setting.save_file_path(version, location, sdk_build)
-            try:
-                if setting.value:
-                    extract_path = get_data_path("files/" + setting.name)
-                    setting.extract(extract_path, version, save_file_path, sdk_build)
-
-                    self.progress_text += "."
-
-            except (tarfile.ReadError, zipfile.BadZipfile) as e:
-                if os.path.exists(save_file_path):
-                    os.remove(save_file_path)
-                self.extract_error = e
-                self.logger.error(self.extract_error)
-                # cannot use GUI in thread to notify user. Save it for later
-        self.progress_text = "\nDone.\n"
-        return True
+        cache = cache or self.runtime_cache()
+        key = cache.key(version, setting, sdk_build)
+        save_file_path = setting.save_file_path(version, location, sdk_build)
+
+        # Runtimes extracted while they were downloading are already fresh
+        forced = forced and key not in self.streamed_runtimes
+
+        try:
+            with cache.lock(key):
+                if forced or cache.get(key, save_file_path) is None:
+                    cache.install(key, setting, version, save_file_path, sdk_build)
+                else:
+                    self.logger.info("Using cached runtime {}".format(key))
+        except (tarfile.ReadError, zipfile.BadZipfile) as e:
+            if os.path.exists(save_file_path):
+                os.remove(save_file_path)
+            self.extract_error = e
+            self.logger.error(self.extract_error)
+            # cannot use GUI in thread to notify user. Save it for later
+
+        return key
 
     def create_icns_for_app(self, icns_path):
         """
@@ -638,16 +796,34 @@ class CommandBase(object):
 
         if icon_path:
             icon_path = utils.path_join(self.project_dir(), icon_path)
+            utils.break_hardlink(icns_path, keep_contents=False)
             if not icon_path.endswith(".icns"):
                 save_icns(icon_path, icns_path)
             else:
                 utils.copy(icon_path, icns_path)
 
-    def replace_icon_in_exe(self, exe_path):
+    def patched_exe_cache(self):
+        """Get the cache of executables with the project icon patched in"""
+        location = self.get_setting("download_dir").value or config.download_path()
+        return PatchedExeCache(location)
+
+    def icon_patch_options(self):
+        """Describe how replace_icon patches the exe, for the cache keys"""
+        return "sizes={};version={}".format(
+            ",".join(str(size) for size in ICON_SIZES), ICON_PATCH_VERSION
+        )
+
+    def replace_icon_in_exe(self, exe_path, runtime_exe_path=None):
         """Modifies the nw.js executable to have the project icon
 
+        A previously patched exe is reused when the runtime binary, the
+        icon and the patch options are all the same.
+
         Args:
             exe_path: The path to write the new exe to
+            runtime_exe_path: The unpatched exe in the runtime cache that
+                              exe_path was copied from, which is cheaper to
+                              hash because its digest is remembered
         """
         icon_setting = self.get_setting("icon")
         exe_icon_setting = self.get_setting("exe_icon")
@@ -655,10 +831,25 @@ class CommandBase(object):
             exe_icon_setting.value if exe_icon_setting.value else icon_setting.value
         )
         if icon_path:
-            p = PEFile(exe_path)
-            p.replace_icon(utils.path_join(self.project_dir(), icon_path))
-            p.write(exe_path)
-            p = None
+            icon_path = utils.path_join(self.project_dir(), icon_path)
+
+            cache = self.patched_exe_cache()
+            key = cache.key(
+                cache.digest(runtime_exe_path or exe_path),
+                utils.hash_path(icon_path),
+                self.icon_patch_options(),
+            )
+
+            if cache.get(key, exe_path):
+                self.logger.info("Using cached patched exe for {}".format(exe_path))
+                return
+
+            utils.break_hardlink(exe_path)
+            with PEFile(exe_path, in_place=True) as p:
+                p.replace_icon(icon_path)
+                p.write(exe_path)
+
+            cache.put(key, exe_path)
 
     def write_package_json(self):
         """Collects filled options and writes corresponding json files"""
@@ -732,13 +923,20 @@ class CommandBase(object):
         if os.path.exists(export_dest):
             utils.rmtree(export_dest)
 
-        # shutil will make the directory for us
-        utils.copytree(
-            get_data_path("files/" + ex_setting.name),
-            export_dest,
-            ignore=shutil.ignore_patterns("place_holder.txt"),
+        link_mode = self.get_setting("runtime_link_mode").value
+
+        cache = self.runtime_cache()
+        with cache.lock(self.runtime_key(ex_setting), shared=True):
+            mode = utils.materialize_tree(
+                self.runtime_path(ex_setting),
+                export_dest,
+                mode=link_mode,
+                ignore=shutil.ignore_patterns("place_holder.txt"),
+            )
+
+        self.logger.info(
+            "Materialized {} runtime with {}".format(ex_setting.name, mode)
         )
-        utils.rmtree(get_data_path("files/" + ex_setting.name))
 
     def replace_localized_app_name(self, app_path):
         """
@@ -755,6 +953,8 @@ class CommandBase(object):
         strings = open(strings_path, mode="rb").read()
         strings = str(strings)
         strings = strings.replace("nwjs", self.project_name())
+
+        utils.break_hardlink(strings_path, keep_contents=False)
         with open(strings_path, mode="wb+") as f:
             f.write(bytes(strings, "utf-8"))
 
@@ -781,6 +981,7 @@ class CommandBase(object):
             plist_dict["CFBundleShortVersionString"] = "0.0.0"
             plist_dict["CFBundleVersion"] = "0.0.0"
 
+        utils.break_hardlink(plist_path, keep_contents=False)
         with open(plist_path, "wb") as fp:
             plistlib.dump(plist_dict, fp)
 
@@ -804,7 +1005,9 @@ class CommandBase(object):
 
         app_nw_res = utils.path_join(resource_path, "app.nw")
 
-        if self.uncompressed:
+        if app_loc is None:
+            self.stream_app_nw(app_nw_res)
+        elif self.uncompressed:
             utils.copytree(app_loc, app_nw_res)
         else:
             utils.copy(app_loc, app_nw_res)
@@ -834,7 +1037,12 @@ class CommandBase(object):
         ext = ""
         if "windows" in ex_setting.name:
             ext = ".exe"
-            self.replace_icon_in_exe(nw_path)
+            runtime_exe_path = utils.path_join(
+                self.runtime_path(ex_setting), ex_setting.binary_location
+            )
+            if not os.path.exists(runtime_exe_path):
+                runtime_exe_path = None
+            self.replace_icon_in_exe(nw_path, runtime_exe_path)
 
         self.compress_nw(nw_path, ex_setting)
 
@@ -851,8 +1059,14 @@ class CommandBase(object):
         if os.path.exists(nw_path):
             os.remove(nw_path)
 
-    def process_export_setting(self, ex_setting, output_name):
-        """Create the executable based on the export setting"""
+    def process_export_setting(self, ex_setting, output_name, app_loc):
+        """Create the executable based on the export setting
+
+        Args:
+            ex_setting: the export setting (eg: mac-x64)
+            output_name: the output name pattern for the export
+            app_loc: the shared app.nw payload built by build_app_nw_payload
+        """
         if ex_setting.value:
             self.progress_text = "\n"
 
@@ -860,12 +1074,20 @@ class CommandBase(object):
 
             self.progress_text = "Making files for {}...".format(name)
 
-            temp_dir = utils.path_join(config.TEMP_DIR, "webexectemp")
-
             name_path = self.get_export_path(ex_setting, output_name)
             output_dir = utils.path_join(self.output_dir(), name_path)
-            self.clean_dirs(temp_dir, output_dir)
-            app_loc = self.get_app_nw_loc(temp_dir, output_dir)
+            self.clean_dirs(output_dir)
+
+            if app_loc is None:
+                self.logger.info(
+                    "Streaming the app.nw payload for {}".format(ex_setting.name)
+                )
+            else:
+                self.logger.info(
+                    "Using app.nw payload {} (sha256 {}) for {}".format(
+                        app_loc, self.app_nw_hash, ex_setting.name
+                    )
+                )
 
             self.copy_export_files(ex_setting, output_dir)
 
@@ -876,6 +1098,9 @@ class CommandBase(object):
             else:
                 self.process_win_linux_setting(app_loc, output_dir, ex_setting)
 
+            if self.get_setting("artifact_store").value:
+                self.store_artifacts(ex_setting, output_dir)
+
     @property
     def used_project_files(self):
         return self.file_tree.files
@@ -896,8 +1121,8 @@ class CommandBase(object):
 
         output_blacklist = os.path.basename(self.output_dir())
 
-        blacklist_vals = re.split(r",?\n?", blacklist_setting.value)
-        whitelist_vals = re.split(r",?\n?", whitelist_setting.value)
+        blacklist_vals = utils.split_patterns(blacklist_setting.value)
+        whitelist_vals = utils.split_patterns(whitelist_setting.value)
 
         self.file_tree.init(
             self.project_dir(),
@@ -911,8 +1136,329 @@ class CommandBase(object):
             self.write_package_json()
             self.file_tree.refresh()
 
-        for ex_setting in self.settings["export_settings"].values():
-            self.process_export_setting(ex_setting, output_name)
+        if not self.get_export_options():
+            return
+
+        try:
+            app_loc = None
+            if self.streams_app_nw():
+                fingerprint = self.payload_fingerprint()
+                self.app_nw_entries = self.prepare_app_nw_entries(self.workspace_dir())
+            else:
+                app_loc = self.build_app_nw_payload(self.workspace_dir())
+
+            self.export_errors = self.run_export_stages(output_name, app_loc)
+
+            if self.app_nw_entries is not None:
+                self.store_app_nw_entries(
+                    self.app_nw_entries, fingerprint, self.workspace_dir()
+                )
+        finally:
+            self.app_nw_entries = None
+            self.remove_workspace()
+
+        if self.export_errors:
+            error = ExportError(self.export_errors)
+            self.output_err += error.report()
+            raise error
+
+    def get_export_jobs(self, num_stages):
+        """Get the number of platform stages to run at the same time
+
+        Args:
+            num_stages: the number of platforms being exported
+
+        Returns:
+            The number of workers to use, never less than 1
+        """
+        jobs = self.export_jobs or os.cpu_count() or 1
+        return max(1, min(int(jobs), num_stages))
+
+    def run_export_stages(self, output_name, app_loc):
+        """
+        Run the platform export stages concurrently in a thread pool.
+
+        Each platform is isolated from the others, so a failure in one
+        stage is recorded and the remaining platforms keep exporting.
+
+        Args:
+            output_name: the output name pattern for the export
+            app_loc: the shared app.nw payload
+
+        Returns:
+            A dict of platform name to formatted error for every
+            platform that failed
+        """
+        ex_settings = [
+            ex_setting
+            for ex_setting in self.settings["export_settings"].values()
+            if ex_setting.value
+        ]
+        total = len(ex_settings)
+        jobs = self.get_export_jobs(total)
+
+        self.logger.info("Exporting {} platforms with {} workers".format(total, jobs))
+
+        def run_stage(ex_setting):
+            self._stage_local.name = ex_setting.display_name
+            self._stage_local.text = ""
+            self._stage_local.errors = stage_errors = []
+            try:
+                self.process_export_setting(ex_setting, output_name, app_loc)
+            except Exception:
+                error = utils.format_exc_info(sys.exc_info())
+                self.logger.error(error)
+                stage_errors.append(error)
+            finally:
+                self._stage_local.name = None
+                self._stage_local.errors = None
+
+            if stage_errors:
+                return "\n".join(stage_errors)
+
+        errors = {}
+        done = 0
+        with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            stages = {
+                executor.submit(run_stage, ex_setting): ex_setting
+                for ex_setting in ex_settings
+            }
+            pending = set(stages)
+            while pending:
+                finished, pending = futures.wait(
+                    pending, timeout=0.2, return_when=futures.FIRST_COMPLETED
+                )
+                self.show_stage_progress()
+
+                for stage in finished:
+                    done += 1
+                    ex_setting = stages[stage]
+                    error = stage.result()
+                    status = "done"
+                    if error is not None:
+                        errors[ex_setting.name] = error
+                        status = "failed"
+                    self.progress_text = "\n[{}/{}] {} {}.".format(
+                        done, total, ex_setting.display_name, status
+                    )
+
+        return errors
+
+    def build_app_nw_payload(self, temp_dir):
+        """
+        Build the app.nw payload once so that it can be shared by every
+        platform that is exported.
+
+        The content hash of the payload is stored in ``self.app_nw_hash``
+        so that each platform stage can record which payload it used.
+
+        Args:
+            temp_dir: the temporary directory to build the payload in
+
+        Returns:
+            The path to the app.nw zip file or uncompressed folder
+        """
+        self.progress_text = "Building app.nw payload...\n"
+        self.clean_dirs(temp_dir)
+
+        fingerprint = self.payload_fingerprint()
+        store_dir = self.payload_store_dir()
+
+        # Other exports of the project on this machine share the store
+        with utils.FileLock(store_dir + ".lock"):
+            manifest = self.load_payload_manifest(store_dir)
+
+            if fingerprint is not None and manifest.get("fingerprint") == fingerprint:
+                app_loc = utils.path_join(store_dir, manifest["name"])
+                if os.path.exists(app_loc):
+                    # The modification time orders the payloads for
+                    # prune_payloads()
+                    os.utime(utils.path_join(store_dir, "payload.json"))
+                    self.app_nw_hash = manifest["hash"]
+                    self.logger.info(
+                        "Project unchanged, reusing app.nw payload {}".format(app_loc)
+                    )
+                    return self.link_payload(app_loc, temp_dir)
+
+            previous = None
+            if manifest.get("name"):
+                previous = utils.path_join(store_dir, manifest["name"])
+
+            app_loc = self.get_app_nw_loc(temp_dir, previous=previous)
+            self.app_nw_hash = utils.hash_path(app_loc)
+
+            self.logger.info(
+                "Built app.nw payload {} (sha256 {})".format(app_loc, self.app_nw_hash)
+            )
+
+            if fingerprint is not None:
+                app_loc = self.store_payload(store_dir, app_loc, fingerprint)
+                app_loc = self.link_payload(app_loc, temp_dir)
+
+        return app_loc
+
+    def link_payload(self, app_loc, temp_dir):
+        """
+        Link the stored payload into the temp_dir of this export, so that
+        another export replacing the stored payload does not affect it.
+
+        Returns:
+            The location of the payload in temp_dir
+        """
+        private_loc = utils.path_join(temp_dir, os.path.basename(app_loc))
+
+        if os.path.isdir(app_loc):
+            utils.materialize_tree(app_loc, private_loc, mode="hardlink")
+        else:
+            try:
+                utils.materialize_file(app_loc, private_loc, "hardlink")
+            except OSError:
+                utils.materialize_file(app_loc, private_loc, "copy")
+
+        return private_loc
+
+    def payload_store_root(self):
+        """Get the directory the payloads of every project are kept in"""
+        return self.payload_store or get_data_path("files/payloads")
+
+    def payload_store_dir(self):
+        """Get the directory the last app.nw payload of the project is kept in"""
+        project_dir = os.path.normcase(os.path.abspath(self.project_dir()))
+        name = hashlib.sha1(project_dir.encode("utf-8")).hexdigest()
+        return utils.path_join(self.payload_store_root(), name)
+
+    def prune_payloads(self, max_size=None, keep=()):
+        """
+        Evict the payloads of the least recently exported projects until
+        the payload store fits in max_size bytes.
+
+        Args:
+            max_size: the size cap in bytes, defaults to the
+                      payload_store_size setting. A cap of 0 or less
+                      keeps every payload.
+            keep: store directories that must not be evicted, such as
+                  the one of the current project
+
+        Returns:
+            A list of the removed store directories
+        """
+        if max_size is None:
+            try:
+                max_size = int(self.get_setting("payload_store_size").value or 0)
+            except ValueError:
+                max_size = 0
+            max_size *= 1024 * 1024
+
+        store = self.payload_store_root()
+        if max_size <= 0 or not os.path.isdir(store):
+            return []
+
+        entries = []
+        for name in os.listdir(store):
+            store_dir = utils.path_join(store, name)
+            if not os.path.isdir(store_dir):
+                continue
+
+            try:
+                last_used = os.path.getmtime(utils.path_join(store_dir, "payload.json"))
+            except OSError:
+                last_used = 0
+
+            size = 0
+            for root, dirs, files in os.walk(store_dir):
+                for file_name in files:
+                    try:
+                        size += os.path.getsize(os.path.join(root, file_name))
+                    except OSError:
+                        pass
+
+            entries.append((last_used, store_dir, size))
+
+        total_size = sum(size for _, _, size in entries)
+        entries.sort()
+
+        removed = []
+        for _, store_dir, size in entries:
+            if total_size <= max_size:
+                break
+            if store_dir in keep:
+                continue
+
+            # Payloads that another export is using are kept
+            lock = utils.FileLock(store_dir + ".lock")
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                utils.rmtree(store_dir, ignore_errors=True)
+            finally:
+                lock.release()
+
+            total_size -= size
+            removed.append(store_dir)
+
+        return removed
+
+    def load_payload_manifest(self, store_dir):
+        """Load the manifest of the stored payload, or {} if there is none"""
+        manifest_path = utils.path_join(store_dir, "payload.json")
+        try:
+            with codecs.open(manifest_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def payload_fingerprint(self):
+        """
+        Get a digest of everything the app.nw payload is built from, so an
+        unchanged project can reuse the payload of its previous export.
+
+        Returns:
+            The hex digest, or None if the project files are not indexed
+        """
+        file_index = self.file_tree.file_index
+        if file_index is None:
+            return None
+
+        parts = [
+            file_index.fingerprint(self.used_project_files),
+            self.project_name(),
+            str(self.uncompressed),
+            str(config.ZIP_MODE),
+            str(self.app_nw_compression()),
+        ]
+        parts.extend(sorted(self.used_project_dirs))
+
+        return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+    def store_payload(self, store_dir, app_loc, fingerprint):
+        """
+        Move a freshly built payload into the payload store.
+
+        Returns:
+            The new location of the payload
+        """
+        if os.path.exists(store_dir):
+            utils.rmtree(store_dir, ignore_errors=True)
+        os.makedirs(store_dir)
+
+        name = os.path.basename(app_loc)
+        stored_loc = utils.path_join(store_dir, name)
+        utils.move(app_loc, stored_loc)
+
+        zip_manifest = utils.zip_manifest_path(app_loc)
+        if os.path.exists(zip_manifest):
+            utils.move(zip_manifest, utils.zip_manifest_path(stored_loc))
+
+        manifest = {"fingerprint": fingerprint, "hash": self.app_nw_hash, "name": name}
+
+        tmp_path = utils.path_join(store_dir, "payload.json.tmp")
+        with codecs.open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(tmp_path, utils.path_join(store_dir, "payload.json"))
+
+        self.prune_payloads(keep=[store_dir])
+
+        return stored_loc
 
     @property
     def uncompressed(self):
@@ -920,6 +1466,96 @@ class CommandBase(object):
         uncomp_setting = self.get_setting("uncompressed_folder")
         return uncomp_setting.value
 
+    def streams_app_nw(self):
+        """
+        Returns true if the app.nw zip is written straight into each
+        executable instead of being built once in the temp directory
+        """
+        return bool(self.get_setting("stream_app_nw").value) and not self.uncompressed
+
+    def prepare_app_nw_entries(self, temp_dir):
+        """
+        Compress the files of the app.nw zip once for every executable it
+        is streamed into.
+
+        Unchanged files are copied from the last payload of the project,
+        which is linked into temp_dir first so that another export can
+        replace it in the meantime.
+
+        Returns:
+            The ZipEntries to pass to write_zip_entries
+        """
+        self.progress_text = "Compressing app.nw payload...\n"
+
+        store_dir = self.payload_store_dir()
+        previous = None
+
+        with utils.FileLock(store_dir + ".lock", shared=True):
+            manifest = self.load_payload_manifest(store_dir)
+            if manifest.get("name"):
+                stored_loc = utils.path_join(store_dir, manifest["name"])
+                zip_manifest = utils.zip_manifest_path(stored_loc)
+
+                if os.path.isfile(stored_loc) and os.path.exists(zip_manifest):
+                    previous_dir = utils.path_join(temp_dir, "previous")
+                    os.makedirs(previous_dir, exist_ok=True)
+                    previous = self.link_payload(stored_loc, previous_dir)
+                    utils.copy(zip_manifest, utils.zip_manifest_path(previous))
+
+        entries = prepare_zip_entries(
+            self.project_dir(),
+            *self.used_project_files,
+            previous=previous,
+            compresslevel=self.app_nw_compression() or None
+        )
+        self.logger.info(
+            "Compressed app.nw for streaming: {} files reused, {} compressed".format(
+                entries.copied, entries.compressed
+            )
+        )
+        return entries
+
+    def store_app_nw_entries(self, entries, fingerprint, temp_dir):
+        """
+        Keep the streamed app.nw zip in the payload store, so that the next
+        export copies its unchanged files instead of compressing them.
+        """
+        if fingerprint is None:
+            return
+
+        store_dir = self.payload_store_dir()
+
+        with utils.FileLock(store_dir + ".lock"):
+            manifest = self.load_payload_manifest(store_dir)
+            if manifest.get("fingerprint") == fingerprint:
+                os.utime(utils.path_join(store_dir, "payload.json"))
+                return
+
+            app_loc = utils.path_join(temp_dir, self.project_name() + ".nw")
+            write_zip_entries(app_loc, entries)
+            self.app_nw_hash = utils.hash_path(app_loc)
+            self.store_payload(store_dir, app_loc, fingerprint)
+
+    def stream_app_nw(self, dest_path, prefix=None):
+        """
+        Write the app.nw zip prepared by prepare_app_nw_entries straight
+        into dest_path.
+
+        Args:
+            dest_path: the file to write the archive to
+            prefix: the NW.js executable to write before the archive
+        """
+        write_zip_entries(dest_path, self.app_nw_entries, prefix=prefix, manifest=False)
+        self.logger.info("Streamed app.nw into {}".format(dest_path))
+
+    def app_nw_compression(self):
+        """Get the deflate level of the app.nw zip file, 0 stores the files"""
+        setting = self.get_setting("app_nw_compression")
+        try:
+            return max(0, min(9, int(setting.value)))
+        except (TypeError, ValueError):
+            return 0
+
     def sub_pattern(self):
         """Returns the output pattern substitution or an empty string"""
         setting = self.get_setting("output_pattern")
@@ -930,16 +1566,41 @@ class CommandBase(object):
         self.output_err = ""
         try:
             self.make_output_dirs()
+        except ExportError:
+            # Each failed platform was already added to output_err
+            pass
         except Exception:
             exc_format = utils.format_exc_info(sys.exc_info)
             self.logger.error(exc_format)
             self.output_err += exc_format
         finally:
-            temp_dir = utils.path_join(config.TEMP_DIR, "webexectemp")
-            utils.rmtree(temp_dir, onerror=self.remove_readonly)
+            self.remove_workspace()
+
+    def workspace_dir(self):
+        """
+        Get the private temporary directory of the current export, so that
+        several exports can run on one machine at the same time.
+        """
+        if self._workspace_dir is None:
+            self._workspace_dir = tempfile.mkdtemp(
+                prefix="webexectemp-", dir=config.TEMP_DIR
+            )
+        return self._workspace_dir
+
+    def remove_workspace(self):
+        """Delete the temporary directory of the current export"""
+        if self._workspace_dir is not None:
+            utils.rmtree(self._workspace_dir, onerror=self.remove_readonly)
+            self._workspace_dir = None
+
+    def get_app_nw_loc(self, temp_dir, output_dir=None, previous=None):
+        """
+        Create the app.nw zip file or folder in the temp_dir
 
-    def get_app_nw_loc(self, temp_dir, output_dir):
-        """Copy the temporary app to the output_dir"""
+        Args:
+            previous: the app.nw zip file of the previous export, whose
+                      unchanged entries are copied instead of compressed
+        """
         app_file = utils.path_join(temp_dir, self.project_name() + ".nw")
 
         proj_dir = self.project_dir()
@@ -947,6 +1608,7 @@ class CommandBase(object):
         if self.uncompressed:
             app_nw_folder = utils.path_join(temp_dir, self.project_name() + ".nwf")
             for dir in self.used_project_dirs:
+                dir = utils.path_join(app_nw_folder, dir)
                 if not os.path.exists(dir):
                     os.makedirs(dir)
 
@@ -962,7 +1624,21 @@ class CommandBase(object):
                 utils.copy(src, dest)
             return app_nw_folder
         else:
-            zip_files(app_file, proj_dir, *self.used_project_files)
+            if previous is not None and os.path.isdir(previous):
+                previous = None
+
+            copied, compressed = zip_files(
+                app_file,
+                proj_dir,
+                *self.used_project_files,
+                previous=previous,
+                compresslevel=self.app_nw_compression() or None
+            )
+            self.logger.info(
+                "Zipped app.nw: {} files reused, {} compressed".format(
+                    copied, compressed
+                )
+            )
             return app_file
 
     def get_version_tuple(self):
@@ -982,7 +1658,9 @@ class CommandBase(object):
         Merge the zip file into the exe and copy it to the destination path
         """
         package_loc = utils.path_join(export_path, "package.nw")
-        if self.uncompressed:
+        if app_loc is None:
+            self.stream_app_nw(dest_path, prefix=nw_path)
+        elif self.uncompressed:
             utils.copytree(app_loc, package_loc)
             utils.copy(nw_path, dest_path)
         else:
@@ -1033,13 +1711,8 @@ class CommandBase(object):
 
         os.chmod(dfile_path, 0o755)
 
-    def compress_nw(self, nw_path, ex_setting):
-        """Compress the nw file using upx"""
-        compression = self.get_setting("nw_compression_level")
-
-        if compression.value == 0:
-            return
-
+    def upx_path(self):
+        """Get the path of the UPX binary for this platform, or None"""
         comp_dict = {
             "Darwin64bit": config.get_file(config.UPX_MAC_PATH),
             "Darwin32bit": config.get_file(config.UPX_MAC_PATH),
@@ -1054,67 +1727,155 @@ class CommandBase(object):
             comp_dict["Windows32bit"] = get_data_file_path(config.UPX_WIN_PATH)
 
         plat = platform.system() + platform.architecture()[0]
-        upx_version = comp_dict.get(plat, None)
-
-        if upx_version is not None:
-            upx_bin = upx_version
-            os.chmod(upx_bin, 0o755)
-
-            cmd = [upx_bin, "--lzma", "-{}".format(compression.value)]
-
-            if "windows" in ex_setting.name:
-                path = os.path.join(os.path.dirname(nw_path), "*.dll")
-                cmd.extend(glob.glob(path))
-            elif "linux" in ex_setting.name:
-                path = os.path.join(os.path.dirname(nw_path), "lib", "*.so")
-                cmd.extend(glob.glob(path))
-            elif "mac" in ex_setting.name:
-                dylib_path = utils.path_join(
-                    nw_path,
-                    "Contents",
-                    "Versions",
-                    "**",
-                    "nwjs Framework.framework",
-                )
-                framework_path = os.path.join(dylib_path, "nwjs Framework")
-                cmd.extend(glob.glob(framework_path))
-                path = os.path.join(dylib_path, "*.dylib")
-                cmd.extend(glob.glob(path))
-
-            if platform.system() == "Windows":
-                startupinfo = subprocess.STARTUPINFO()
-                startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-                startupinfo.wShowWindow = subprocess.SW_HIDE
-                proc = subprocess.Popen(
-                    cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    stdin=subprocess.PIPE,
-                    startupinfo=startupinfo,
-                )
-            else:
-                proc = subprocess.Popen(
-                    cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    stdin=subprocess.PIPE,
-                )
+        return comp_dict.get(plat, None)
+
+    def upx_targets(self, nw_path, ex_setting):
+        """Get the runtime libraries of the export that UPX compresses"""
+        targets = []
+
+        if "windows" in ex_setting.name:
+            path = os.path.join(os.path.dirname(nw_path), "*.dll")
+            targets.extend(glob.glob(path))
+        elif "linux" in ex_setting.name:
+            path = os.path.join(os.path.dirname(nw_path), "lib", "*.so")
+            targets.extend(glob.glob(path))
+        elif "mac" in ex_setting.name:
+            dylib_path = utils.path_join(
+                nw_path,
+                "Contents",
+                "Versions",
+                "**",
+                "nwjs Framework.framework",
+            )
+            framework_path = os.path.join(dylib_path, "nwjs Framework")
+            targets.extend(glob.glob(framework_path))
+            path = os.path.join(dylib_path, "*.dylib")
+            targets.extend(glob.glob(path))
 
-            self.progress_text = "\n\n"
-            self.progress_text = "Compressing files"
+        return targets
 
-            while proc.poll() is None:
+    def run_upx(self, cmd):
+        """
+        Run UPX and wait for it to exit.
+
+        Returns:
+            A tuple of the return code and the error output
+        """
+        kwargs = {}
+        if platform.system() == "Windows":
+            startupinfo = subprocess.STARTUPINFO()
+            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+            startupinfo.wShowWindow = subprocess.SW_HIDE
+            kwargs["startupinfo"] = startupinfo
+
+        proc = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            stdin=subprocess.PIPE,
+            **kwargs
+        )
+        output, err = proc.communicate()
+        return proc.returncode, err
+
+    def upx_version(self, upx_bin):
+        """Get the version line of the UPX binary, used in the cache keys"""
+        with self.upx_lock:
+            version = self.upx_versions.get(upx_bin)
+            if version is None:
+                try:
+                    output = subprocess.check_output([upx_bin, "--version"])
+                    version = output.decode("utf-8", "replace").splitlines()[0]
+                except (OSError, subprocess.CalledProcessError, IndexError):
+                    version = utils.hash_path(upx_bin)
+                self.upx_versions[upx_bin] = version
+        return version
+
+    def upx_jobs(self, num_files):
+        """Get the number of UPX processes to run at the same time"""
+        return max(1, min(os.cpu_count() or 1, num_files))
+
+    def compress_nw(self, nw_path, ex_setting):
+        """
+        Compress the runtime libraries with upx.
+
+        Every file is compressed by its own UPX process, with as many
+        processes running as there are CPUs. The outputs are cached by the
+        hash of the input, the level and the UPX version.
+        """
+        compression = self.get_setting("nw_compression_level")
+
+        if int(compression.value or 0) == 0:
+            return
+
+        upx_bin = self.upx_path()
+
+        if upx_bin is None:
+            return
+
+        os.chmod(upx_bin, 0o755)
+
+        level = int(compression.value)
+        upx_version = self.upx_version(upx_bin)
+        cache = UpxCache(
+            self.get_setting("download_dir").value or config.download_path()
+        )
+
+        self.progress_text = "\n\n"
+        self.progress_text = "Compressing files"
+
+        def compress(path):
+            key = cache.key(utils.hash_path(path), level, upx_version)
+
+            if cache.get(key, path):
+                return path, True, None
+
+            # UPX rewrites the files in place
+            utils.break_hardlink(path)
+
+            returncode, err = self.run_upx(
+                [upx_bin, "--lzma", "-{}".format(level), path]
+            )
+
+            if returncode == 0:
+                cache.put(key, path)
+                return path, False, None
+
+            return path, False, err
+
+        targets = self.upx_targets(nw_path, ex_setting)
+        errors = []
+        cached = 0
+
+        with futures.ThreadPoolExecutor(
+            max_workers=self.upx_jobs(len(targets))
+        ) as executor:
+            for path, was_cached, err in executor.map(compress, targets):
                 self.progress_text += "."
-                time.sleep(2)
+                cached += was_cached
+                if err:
+                    self.logger.error(
+                        "UPX failed for {}: {}".format(
+                            path, err.decode("utf-8", "replace")
+                        )
+                    )
+                    errors.append(path)
+
+        self.logger.info(
+            "Compressed {} files for {}, {} from the cache".format(
+                len(targets), ex_setting.name, cached
+            )
+        )
 
-            output, err = proc.communicate()
-            if err:
-                args = ex_setting.name, platform.system(), ex_setting.name
-                self.output_err = (
+        if errors:
+            args = ex_setting.name, platform.system(), ex_setting.name
+            self.add_error(
+                (
                     "Cannot compress files for {} on {}!\n"
                     "Run Web2Exe on {} to "
                     "compress successfully."
                 ).format(*args)
+            )
 
     def remove_readonly(self, action, name, exc):
         """Try to remove readonly files"""
@@ -1125,7 +1886,21 @@ class CommandBase(object):
             error = "Failed to remove file: {}.".format(name)
             error += "\nError recieved: {}".format(e)
             self.logger.error(error)
-            self.output_err += error
+            self.add_error(error)
+
+    def add_error(self, error):
+        """
+        Record an error that doesn't stop the current step.
+
+        Inside a platform stage the error fails that platform once the
+        stage has finished, otherwise it is added to output_err.
+        """
+        stage_errors = getattr(self._stage_local, "errors", None)
+        if stage_errors is not None:
+            stage_errors.append(error)
+        else:
+            with self._stage_lock:
+                self.output_err += error
 
     def copy_files_to_project_folder(self):
         """
@@ -1216,7 +1991,7 @@ class CommandBase(object):
         batcontents = "{}\n{}".format(env_vars, contents)
 
         bat_file = utils.path_join(
-            config.TEMP_DIR, "{}.bat".format(self.project_name())
+            config.TEMP_DIR, "{}-{}.bat".format(self.project_name(), os.getpid())
         )
 
         self.logger.debug(batcontents)
@@ -1256,7 +2031,7 @@ class CommandBase(object):
         bashcontents = "{}\n{}".format(env_vars, contents)
 
         bash_file = utils.path_join(
-            config.TEMP_DIR, "{}.bash".format(self.project_name())
+            config.TEMP_DIR, "{}-{}.bash".format(self.project_name(), os.getpid())
         )
 
         self.logger.debug(bashcontents)
@@ -1343,21 +2118,31 @@ class CommandBase(object):
     def export(self, write_json=True):
         """Start the exporting process
 
+        The platforms that exported are finished up even when others
+        failed, and the ExportError is raised again afterwards.
+
         Kwargs:
             write_json: boolean -> write json output or not
         """
         self.get_files_to_download()
         res = self.try_to_download_files()
         if res:
-            self.make_output_dirs(write_json)
+            export_error = None
+            try:
+                self.make_output_dirs(write_json)
+            except ExportError as e:
+                export_error = e
             script = self.get_setting("custom_script").value
             self.run_script(script)
-            self.progress_text = "\nDone!\n"
+            if export_error is None:
+                self.progress_text = "\nDone!\n"
             out_dir = "{}{}{}".format(
                 self.output_dir(), os.path.sep, self.project_name()
             )
             self.progress_text = "Output directory is {}.\n".format(out_dir)
             self.delete_files()
+            if export_error is not None:
+                raise export_error
 
     def get_export_options(self):
         """Get all of the export options selected"""
@@ -1370,6 +2155,7 @@ class CommandBase(object):
     def get_files_to_download(self):
         """Get all the files needed for download based on export settings"""
         self.files_to_download = []
+        self.streamed_runtimes = set()
         for setting_name, setting in self.settings["export_settings"].items():
             if setting.value is True:
                 self.files_to_download.append(setting)
@@ -1377,7 +2163,103 @@ class CommandBase(object):
 
     def try_to_download_files(self):
         if self.files_to_download:
-            return self.download_file_with_error_handling()
+            return self.download_files()
+
+    def download_jobs(self, num_files):
+        """Get the number of archives to download at the same time
+
+        Args:
+            num_files: the number of archives waiting to be downloaded
+
+        Returns:
+            The number of workers to use, never less than 1
+        """
+        try:
+            jobs = int(self.get_setting("download_jobs").value or 1)
+        except ValueError:
+            jobs = 1
+        return max(1, min(jobs, num_files))
+
+    def download_files(self):
+        """
+        Download all of the pending archives concurrently.
+
+        Each archive is extracted into the runtime cache as soon as its
+        own download completes, while the other downloads keep running.
+        A failed download does not stop the others.
+
+        Returns:
+            True if every archive was downloaded
+        """
+        settings = list(self.files_to_download)
+        self.files_to_download = []
+        self.extract_error = None
+
+        version = self.selected_version()
+        cache = self.runtime_cache()
+        jobs = self.download_jobs(len(settings))
+
+        progress = {setting.name: (0, None) for setting in settings}
+        progress_lock = threading.Lock()
+        start_time = time.time()
+
+        self.logger.info(
+            "Downloading {} archives with {} workers".format(len(settings), jobs)
+        )
+
+        def show_progress(setting, file_size_dl, file_size):
+            with progress_lock:
+                progress[setting.name] = (file_size_dl, file_size)
+                DL_MB = sum(done for done, _ in progress.values()) / 1000000.0
+                MB = sum(size or 0 for _, size in progress.values()) / 1000000.0
+
+            speed = DL_MB / max(time.time() - start_time, 0.001)
+            status = "{:10.2f}/{:.2f} MB  [{:.2f} MB/s]".format(DL_MB, MB, speed)
+
+            self.progress_text = status
+
+        def fetch_and_extract(setting):
+            path = setting.url.format(version, version)
+            started = time.time()
+
+            file_name = self.fetch_archive(
+                path, setting, lambda *args: show_progress(setting, *args)
+            )
+
+            if file_name is not None:
+                size = os.path.getsize(file_name) / 1000000.0
+                elapsed = max(time.time() - started, 0.001)
+                self.logger.info(
+                    "Downloaded {}: {:.2f} MB in {:.1f}s ({:.2f} MB/s)".format(
+                        os.path.basename(file_name), size, elapsed, size / elapsed
+                    )
+                )
+
+            return self.extract_file(setting, cache)
+
+        errors = []
+        used_keys = []
+        with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            downloads = {
+                executor.submit(fetch_and_extract, setting): setting
+                for setting in settings
+            }
+            for download in futures.as_completed(downloads):
+                setting = downloads[download]
+                try:
+                    used_keys.append(download.result())
+                except Exception:
+                    errors.append(utils.format_exc_info(sys.exc_info()))
+
+        if errors:
+            self.show_error("\n".join(errors))
+            self.enable_ui_after_error()
+            return False
+
+        cache.prune(keep=used_keys)
+
+        self.progress_text = "\nDone downloading.\n"
+        return True
 
     def continue_downloading_or_extract(self):
         """If there are more files to download, continue; otherwise extract"""
@@ -1389,6 +2271,22 @@ class CommandBase(object):
 
     def download_file(self, path, setting):
         """Download a file from the path and setting"""
+        self.fetch_archive(path, setting)
+        return self.continue_downloading_or_extract()
+
+    def fetch_archive(self, path, setting, progress_callback=None):
+        """Download the archive for the path and setting if needed
+
+        Args:
+            path: the url of the archive
+            setting: the export setting the archive belongs to
+            progress_callback: called with the bytes downloaded and the
+                total size, defaults to writing the progress text
+
+        Returns:
+            The path of the downloaded archive, or None if nothing needed
+            to be downloaded
+        """
         self.logger.info("Downloading file {}.".format(path))
 
         location = self.get_setting("download_dir").value or config.download_path()
@@ -1403,15 +2301,32 @@ class CommandBase(object):
 
         file_name = setting.save_file_path(self.selected_version(), location, sdk_build)
 
+        # Another export on this machine may be downloading the same archive
+        with utils.FileLock(file_name + ".lock"):
+            return self.download_archive(url, setting, file_name, progress_callback)
+
+    def download_archive(self, url, setting, file_name, progress_callback=None):
+        """
+        Download the archive at url to file_name unless it is already
+        downloaded or extracted, resuming a previous partial download.
+
+        Returns:
+            The path of the downloaded archive, or None if nothing needed
+            to be downloaded
+        """
+        path = url
+        sdk_build = self.get_setting("sdk_build").value
+
         tmp_file = list(os.path.split(file_name))
         tmp_file[-1] = ".tmp." + tmp_file[-1]
         tmp_file = os.sep.join(tmp_file)
-        tmp_size = 0
 
         archive_exists = os.path.exists(file_name)
         tmp_exists = os.path.exists(tmp_file)
 
-        dest_files_exist = False
+        runtime_cache = self.runtime_cache()
+        runtime_key = runtime_cache.key(self.selected_version(), setting, sdk_build)
+        dest_files_exist = runtime_cache.is_valid(runtime_key)
 
         forced = self.get_setting("force_download").value
 
@@ -1419,58 +2334,64 @@ class CommandBase(object):
             self.logger.info(
                 "File {} already downloaded. " "Continuing...".format(path)
             )
-            return self.continue_downloading_or_extract()
-        elif tmp_exists and (os.stat(tmp_file).st_size > 0):
-            tmp_size = os.stat(tmp_file).st_size
-            headers = {"Range": "bytes={}-".format(tmp_size)}
-            url = request.Request(url, headers=headers)
-
-        web_file = utils.urlopen(url)
-
-        f = open(tmp_file, "ab")
-
-        meta = web_file.info()
-        file_size = tmp_size + int(meta.get_all("Content-Length")[0])
+            return None
 
         version = self.selected_version()
         version_file = self.settings["base_url"].format(version)
 
         short_name = path.replace(version_file, "")
 
-        MB = file_size / 1000000.0
+        def show_progress(file_size_dl, file_size):
+            DL_MB = file_size_dl / 1000000.0
+            MB = (file_size or 0) / 1000000.0
+            percent = file_size_dl * 100.0 / file_size if file_size else 0
 
-        downloaded = ""
+            args = (DL_MB, MB, percent)
+            status = "{:10.2f}/{:.2f} MB  [{:3.2f}%]".format(*args)
 
-        if tmp_size:
-            self.progress_text = "Resuming previous download...\n"
-            size = tmp_size / 1000000.0
-            self.progress_text = "Already downloaded {:.2f} MB\n".format(size)
+            self.progress_text = status
 
-        self.progress_text = "Downloading: {}, " "Size: {:.2f} MB {}\n".format(
-            short_name, MB, downloaded
+        downloader = RangedDownloader(
+            url,
+            tmp_file,
+            connections=self.download_connections(),
+            progress_callback=progress_callback or show_progress,
         )
-        file_size_dl = tmp_size or 0
-        block_sz = 8192
 
-        while True:
-            buff = web_file.read(block_sz)
-            if not buff:
-                break
+        file_size, _ = downloader.probe()
+        MB = (file_size or 0) / 1000000.0
 
-            file_size_dl += len(buff)
+        if tmp_exists and (os.stat(tmp_file).st_size > 0):
+            self.progress_text = "Resuming previous download...\n"
 
-            DL_MB = file_size_dl / 1000000.0
-            percent = file_size_dl * 100.0 / file_size
+        self.progress_text = "Downloading: {}, " "Size: {:.2f} MB\n".format(
+            short_name, MB
+        )
 
-            f.write(buff)
+        stream = self.get_setting("stream_extract").value and file_name.endswith(
+            ".tar.gz"
+        )
 
-            args = (DL_MB, MB, percent)
-            status = "{:10.2f}/{:.2f} MB  [{:3.2f}%]".format(*args)
+        if stream:
+            # Extract into the runtime cache while the archive downloads
+            staging_path = runtime_cache.staging_path(runtime_key)
+            try:
+                downloader.stream(
+                    lambda fileobj: setting.extract_stream(
+                        staging_path, fileobj, file_name
+                    )
+                )
+            except (Exception, KeyboardInterrupt):
+                utils.rmtree(staging_path, ignore_errors=True)
+                raise
+        else:
+            downloader.download()
 
-            self.progress_text = status
+        if downloader.resumed:
+            size = downloader.resumed / 1000000.0
+            self.logger.info("Resumed download at {:.2f} MB".format(size))
 
         self.progress_text = "\nDone downloading.\n"
-        f.close()
 
         try:
             os.rename(tmp_file, file_name)
@@ -1483,7 +2404,21 @@ class CommandBase(object):
                 os.remove(tmp_file)
                 raise OSError
 
-        return self.continue_downloading_or_extract()
+        if stream:
+            with runtime_cache.lock(runtime_key):
+                runtime_cache.commit(
+                    runtime_key, setting, version, staging_path, file_name, sdk_build
+                )
+            self.streamed_runtimes.add(runtime_key)
+
+        return file_name
+
+    def download_connections(self):
+        """Get the number of connections used to download each archive"""
+        try:
+            return max(1, int(self.get_setting("download_connections").value or 1))
+        except ValueError:
+            return 1
 
     def delete_files(self):
         """Delete files left over in the data path from downloading"""
@@ -1493,6 +2428,60 @@ class CommandBase(object):
                 utils.rmtree(f_path)
 
 
+class PruneRuntimesAction(argparse.Action):
+    """Prune the runtime cache and the payload store and exit, like --help"""
+
+    def __init__(self, option_strings, command_base=None, **kwargs):
+        self.command_base = command_base
+        super(PruneRuntimesAction, self).__init__(option_strings, **kwargs)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        command_base = self.command_base
+        command_base.logger = command_base.logger or config.getLogger(__name__)
+
+        download_dir = getattr(namespace, "download_dir", None)
+        if download_dir:
+            command_base.get_setting("download_dir").value = download_dir
+
+        max_size = None
+        if values is not None:
+            max_size = values * 1024 * 1024
+
+        removed = command_base.prune_runtimes(max_size)
+        for key in removed:
+            command_base.progress_text = "Removed runtime {}\n".format(key)
+        command_base.progress_text = "Removed {} runtimes.\n".format(len(removed))
+
+        removed = command_base.prune_payloads()
+        command_base.progress_text = "Removed {} app.nw payloads.\n".format(
+            len(removed)
+        )
+        parser.exit()
+
+
+class GcStoreAction(argparse.Action):
+    """Remove unused blobs from the artifact store and exit"""
+
+    def __init__(self, option_strings, command_base=None, **kwargs):
+        self.command_base = command_base
+        kwargs.setdefault("nargs", 0)
+        super(GcStoreAction, self).__init__(option_strings, **kwargs)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        command_base = self.command_base
+        command_base.logger = command_base.logger or config.getLogger(__name__)
+
+        download_dir = getattr(namespace, "download_dir", None)
+        if download_dir:
+            command_base.get_setting("download_dir").value = download_dir
+
+        removed, removed_bytes = command_base.gc_artifact_store()
+        command_base.progress_text = "Removed {} blobs ({:.1f} MB).\n".format(
+            removed, removed_bytes / 1024.0 / 1024.0
+        )
+        parser.exit()
+
+
 class ArgParser(argparse.ArgumentParser):
     """Custom argparser that prints help if there is an error"""
 
@@ -1551,6 +2540,42 @@ def get_arguments(command_base, args=None):
         version="%(prog)s {}".format(config.__version__),
     )
 
+    parser.add_argument(
+        "--prune-runtimes",
+        action=PruneRuntimesAction,
+        command_base=command_base,
+        nargs="?",
+        type=int,
+        metavar="MAX_MB",
+        help=(
+            "Remove broken runtimes from the runtime cache and evict the "
+            "least recently used ones until it fits in MAX_MB megabytes, "
+            "then exit. Defaults to the runtime cache size setting. "
+            "The app.nw payloads of past exports are pruned to the payload "
+            "store size setting as well."
+        ),
+    )
+    parser.add_argument(
+        "--gc-store",
+        action=GcStoreAction,
+        command_base=command_base,
+        help=(
+            "Remove the files of the artifact store that are no longer "
+            "used by any export, then exit."
+        ),
+    )
+    parser.add_argument(
+        "--jobs",
+        dest="jobs",
+        type=int,
+        default=None,
+        metavar="N",
+        help=(
+            "The number of platforms to export at the same time. "
+            "Defaults to the number of CPUs."
+        ),
+    )
+
     generate_setting_args(command_base, parser)
 
     export_args = [arg for arg in command_base.settings["export_settings"]]
@@ -1682,6 +2707,12 @@ def setup_directories(args, command_base):
     )
 
 
+def setup_export_jobs(args, command_base):
+    """Set the number of platforms to export concurrently from args"""
+    if args.jobs is not None:
+        command_base.export_jobs = args.jobs
+
+
 def read_package_json_file(args, command_base):
     """Either load project json or load custom json from file"""
     if args.load_json is True:
@@ -1716,13 +2747,18 @@ def main(args=None):
     setup_logging(args, command_base)
     setup_directories(args, command_base)
     setup_project_name(args, command_base)
+    setup_export_jobs(args, command_base)
 
     initialize_setting_values(args, command_base)
 
     read_package_json_file(args, command_base)
 
     # Never write package.json on command line. Only load it.
-    command_base.export(write_json=False)
+    try:
+        command_base.export(write_json=False)
+    except ExportError as e:
+        sys.stderr.write("{}\n".format(e.report()))
+        sys.exit(1)
 
 
 if __name__ == "__main__":
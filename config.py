@@ -23,6 +23,9 @@ TESTING = False
 
 SSL_CONTEXT = ssl._create_unverified_context()
 
+# Seconds a connection or a read from it may stall before the request fails
+URL_TIMEOUT = 60
+
 ### The following sections are code that needs to be run when importing
 ### from main.py.
 
@@ -55,6 +55,8 @@ from command_line import CommandBase
 class MainWindow(QMainWindow, CommandBase):
     """The main window of Web2Executable."""
 
+    progress_changed = QtCore.Signal(str)
+
     def update_nw_versions(self, button=None):
         """Update NW version list in the background."""
         self.get_versions_in_background()
@@ -575,6 +577,7 @@ class MainWindow(QMainWindow, CommandBase):
         hlayout.addWidget(button_box)
 
         self.progress_label = progress_label
+        self.progress_changed.connect(progress_label.setText)
         self.progress_bar = progress_bar
         self.cancel_button = cancel_button
         self.open_export_button = open_export_button
@@ -625,14 +628,17 @@ class MainWindow(QMainWindow, CommandBase):
             self.progress_bar.setVisible(False)
             self.extract_files_in_background()
 
-    @property
-    def progress_text(self):
-        """Lets the user see progress on the GUI as tasks are performed."""
-        return self.progress_label.text()
+    def get_progress_text(self):
+        return self._progress_text
+
+    def set_progress_text(self, value):
+        """Lets the user see progress on the GUI as tasks are performed.
 
-    @progress_text.setter
-    def progress_text(self, value):
-        self.progress_label.setText(value)
+        Exports run on a background thread, so the label is only updated
+        through a signal, which Qt delivers on the GUI thread.
+        """
+        self._progress_text = value
+        self.progress_changed.emit(value)
 
     def run_in_background(self, method_name, callback):
         """
@@ -667,7 +673,7 @@ class MainWindow(QMainWindow, CommandBase):
 
     def make_output_files_in_background(self):
         self.ex_button.setEnabled(False)
-        self.run_in_background("make_output_dirs", self.done_making_files)
+        self.run_in_background("try_make_output_dirs", self.done_making_files)
 
     def run_custom_script(self):
         """Run the custom script setting"""
@@ -1014,9 +1020,9 @@ class MainWindow(QMainWindow, CommandBase):
 
         self.tree_browser.init(
             directory,
-            whitelist=re.split(r"\n?,?", whitelist_setting.value),
+            whitelist=utils.split_patterns(whitelist_setting.value),
             blacklist=(
-                re.split(r"\n?,?", blacklist_setting.value)
+                utils.split_patterns(blacklist_setting.value)
                 + ["*" + output_blacklist + "*"]
             ),
         )
@@ -1230,7 +1236,9 @@ class MainWindow(QMainWindow, CommandBase):
         return group_box
 
     def create_blacklist_layout(self, blacklist_layout):
-        self.tree_browser = TreeBrowser()
+        self.tree_browser = TreeBrowser(
+            index_dir=utils.get_data_path("files/file_index")
+        )
         self.file_tree = self.tree_browser.file_tree
         self.tree_browser.setContentsMargins(0, 0, 0, 0)
 
@@ -1294,12 +1302,12 @@ class MainWindow(QMainWindow, CommandBase):
         new_val = text.toPlainText()
         output_blacklist = os.path.basename(self.output_dir())
         self.tree_browser.refresh(
-            blacklist=(re.split(r"\n?,?", new_val) + ["*" + output_blacklist + "*"])
+            blacklist=(utils.split_patterns(new_val) + ["*" + output_blacklist + "*"])
         )
 
     def whitelist_changed(self, text, whitelist_setting):
         new_val = text.toPlainText()
-        self.tree_browser.refresh(whitelist=re.split(r"\n?,?", new_val))
+        self.tree_browser.refresh(whitelist=utils.split_patterns(new_val))
 
     def create_output_name_pattern_line(self):
         output_name_layout = QtWidgets.QHBoxLayout()
@@ -3,14 +3,28 @@ Copyright Joey Payne All Rights Reserved
 """
 
 import os
+import mmap
 import struct
 from io import BytesIO
 
 from PIL import Image
 
 
-def resize(image, size, format=None):
-    output = BytesIO()
+ICON_SIZES = [16, 24, 32, 48, 64, 128, 256]
+
+# Part of the cache key of patched executables. Bump it whenever
+# replace_icon starts writing different bytes for the same input.
+ICON_PATCH_VERSION = 2
+
+# Set on sections the loader can drop once the image is loaded, such as
+# the base relocations
+IMAGE_SCN_MEM_DISCARDABLE = 0x02000000
+
+
+def fit_image(image, size):
+    """Scales image to fit in size and centers it on a transparent
+    background of exactly that size.
+    """
     back = Image.new("RGBA", size, (0, 0, 0, 0))
 
     if image.size[0] < size[0] or image.size[1] < size[1]:
@@ -19,10 +33,10 @@ def resize(image, size, format=None):
         else:
             factor = size[1] / image.width
         image = image.resize(
-            (int(image.width * factor), int(image.height * factor)), Image.ANTIALIAS
+            (int(image.width * factor), int(image.height * factor)), Image.LANCZOS
         )
     else:
-        image.thumbnail(size, Image.ANTIALIAS)
+        image.thumbnail(size, Image.LANCZOS)
 
     offset = [0, 0]
     if image.size[0] > image.size[1]:
@@ -34,13 +48,35 @@ def resize(image, size, format=None):
         offset[1] = int(back.size[1] / 2 - image.size[1] / 2)
 
     back.paste(image, tuple(offset))
+    return back
+
+
+def resize(image, size, format=None):
+    output = BytesIO()
     format = format or image.format
+    back = fit_image(image, size)
     back.save(output, format, sizes=[size])
     contents = output.getvalue()
     output.close()
     return contents
 
 
+def icon_images(image, sizes=ICON_SIZES):
+    """Renders image at every size in sizes as one ico file and returns
+    its parsed IconHeader, whose entries hold the image data.
+    """
+    largest = max(sizes)
+    output = BytesIO()
+    fit_image(image, (largest, largest)).save(
+        output, "ico", sizes=[(size, size) for size in sizes]
+    )
+    return IconHeader.parse_from_data(bytearray(output.getvalue()))
+
+
+def align(value, alignment):
+    return (value + alignment - 1) // alignment * alignment
+
+
 struct_symbols = {
     1: "B",  # byte
     2: "H",  # word
@@ -195,7 +231,7 @@ def read_data(file_data, offset, number_of_bytes, string_data=None):
         # print 'data out of bounds:', 'offset', hex(offset), 'data', data, 'data_len', len(data), 'num_bytes', number_of_bytes, 'total', hex(len(file_data))
         return data
     else:
-        return bytearray("")
+        return bytearray()
 
 
 def read_bytes(file_data, offset, number_of_bytes, endian=None, string_data=None):
@@ -307,6 +343,8 @@ class PEFormatError(Exception):
 
 
 class Printable(object):
+    __slots__ = ()
+
     def _attrs(self):
         a = []
         for attr in dir(self):
@@ -334,8 +372,145 @@ class Printable(object):
         return "{} [{}]".format(self.__class__.__name__, self._dict_string())
 
 
+class Field(Printable):
+    """A single decoded field of a Structure.
+
+    The raw bytes and the names looked up in name_dictionary are only
+    worked out when something asks for them, which is mostly printing.
+    Setting value writes the new value back into the file data.
+    """
+
+    __slots__ = (
+        "offset",
+        "size",
+        "absolute_offset",
+        "_value",
+        "_data",
+        "_file_data",
+        "_names",
+    )
+
+    def __init__(self, offset, size, value, absolute_offset, file_data, names=None):
+        self.offset = offset
+        self.size = size
+        self.absolute_offset = absolute_offset
+        self._value = value
+        self._data = None
+        self._file_data = file_data
+        self._names = names
+
+    @property
+    def data(self):
+        if self._data is None and self._file_data is not None:
+            end = self.absolute_offset + self.size
+            self._data = bytes(self._file_data[self.absolute_offset : end])
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+
+    @property
+    def value(self):
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        if self._file_data is not None:
+            self._data = value_to_byte_string(value, self.size)
+            end = self.absolute_offset + self.size
+            self._file_data[self.absolute_offset : end] = self._data
+        self._value = value
+
+    @property
+    def name(self):
+        if not self._names:
+            return ""
+        return self._names.get(self._value, "")
+
+    @property
+    def friendly_name(self):
+        return self.name.replace("_", " ").capitalize()
+
+
+class FlagsField(Field):
+    """A Characteristics field, where every set bit has its own name"""
+
+    __slots__ = ()
+
+    @property
+    def name(self):
+        return ""
+
+    @property
+    def values(self):
+        characteristics = {}
+        for i in range(self._value.bit_length()):
+            set_bit = test_bit(self._value, i)
+            char_name = (self._names or {}).get(set_bit, "")
+            if set_bit != 0 and char_name:
+                characteristics[char_name] = set_bit
+        return characteristics
+
+
+class Layout(object):
+    """The _fields of a Structure compiled into one struct.Struct, so all
+    of them are decoded with a single unpack_from call.
+    """
+
+    __slots__ = ("struct", "fields", "size")
+
+    def __init__(self, class_name, fields, flag_fields=()):
+        fmt = endian_symbols[DEFAULT_ENDIAN]
+        position = 0
+        self.fields = []
+        self.size = 0
+
+        for offset, field_name, size in sorted(
+            (info["offset"], name, info["size"]) for name, info in fields.items()
+        ):
+            if size and offset < position:
+                raise ValueError(
+                    "{}.{} overlaps the field before it".format(class_name, field_name)
+                )
+            if size:
+                fmt += "{}x".format(offset - position) if offset > position else ""
+                fmt += struct_symbols[size]
+                position = offset + size
+            names = name_dictionary.get("{}_{}".format(class_name, field_name))
+            field_class = FlagsField if field_name in flag_fields else Field
+            self.fields.append((field_name, offset, size, names, field_class))
+            self.size += size
+
+        self.struct = struct.Struct(fmt)
+
+    def unpack(self, file_data, offset):
+        """Returns the value of every field, zero for the zero sized ones
+        and for any that lie past the end of file_data.
+        """
+        if len(file_data) >= offset + self.struct.size:
+            values = iter(self.struct.unpack_from(file_data, offset))
+        else:
+            values = iter(
+                read_bytes(file_data, offset + field_offset, size)[0]
+                for _, field_offset, size, _, _ in self.fields
+                if size
+            )
+        return [next(values) if size else 0 for _, _, size, _, _ in self.fields]
+
+
 class Structure(Printable):
     _fields = {}
+    _layout = Layout("Structure", _fields)
+    _flag_fields = ("Characteristics",)
+
+    def __init_subclass__(cls, **kwargs):
+        """Compiles every _fields* dict of the class into a _layout*"""
+        super().__init_subclass__(**kwargs)
+        for attr, fields in list(cls.__dict__.items()):
+            if attr.startswith("_fields"):
+                layout = Layout(cls.__name__, fields, cls._flag_fields)
+                setattr(cls, "_layout" + attr[len("_fields") :], layout)
 
     def __init__(
         self,
@@ -366,9 +541,10 @@ class Structure(Printable):
     @absolute_offset.setter
     def absolute_offset(self, abs_offset):
         self._absolute_offset = abs_offset
-        for k, v in self._fields.items():
-            field = getattr(self, k)
-            field.absolute_offset = self.absolute_offset + field.offset
+        for field_name, offset, _, _, _ in self._layout.fields:
+            field = getattr(self, field_name, None)
+            if field is not None:
+                field.absolute_offset = self.absolute_offset + offset
 
     @property
     def value(self):
@@ -383,72 +559,27 @@ class Structure(Printable):
             ] = bytearray(self.data)
         self._value = value
 
-    def process_field(self, file_data, field_name, field_info):
-        if hasattr(self, "process_" + field_name) and callable(
-            getattr(self, "process_" + field_name)
+    def decode_fields(self, file_data, layout=None):
+        """Decodes all fields of the layout into Field attributes."""
+        layout = layout or self._layout
+        absolute_offset = self.absolute_offset
+        self.size += layout.size
+
+        values = layout.unpack(file_data, absolute_offset)
+        for (field_name, offset, size, names, field_class), value in zip(
+            layout.fields, values
         ):
-            getattr(self, "process_" + field_name)(file_data, field_name, field_info)
-        else:
-            absolute_offset = field_info["offset"] + self.absolute_offset
-            size = field_info["size"]
-            self.size += size
-            int_value, data = read_bytes(file_data, absolute_offset, size)
-            field_name_dict = read_from_name_dict(self, field_name)
-            name = field_name_dict.get(int_value, "")
-            friendly_name = name.replace("_", " ").capitalize()
-
-            setattr(
-                self,
-                field_name,
-                Structure(
-                    offset=field_info["offset"],
-                    size=size,
-                    value=int_value,
-                    data=data,
-                    absolute_offset=absolute_offset,
-                    name=name,
-                    friendly_name=friendly_name,
-                ),
+            field = field_class(
+                offset, size, value, absolute_offset + offset, file_data, names
             )
-            getattr(self, field_name)._file_data = file_data
-
-    def process_Characteristics(self, file_data, field_name, field_info):
-        absolute_offset = field_info["offset"] + self.absolute_offset
-        size = field_info["size"]
-        self.size += size
-        int_value, data = read_bytes(file_data, absolute_offset, size)
-        field_name_dict = read_from_name_dict(self, field_name)
-
-        bit_length = len(bin(int_value)) - 2
-
-        characteristics = {}
-        for i in range(bit_length):
-            set_bit = test_bit(int_value, i)
-            char_name = field_name_dict.get(set_bit, "")
-            if set_bit != 0 and char_name:
-                characteristics[char_name] = set_bit
-
-        setattr(
-            self,
-            field_name,
-            Structure(
-                offset=field_info["offset"],
-                size=size,
-                value=int_value,
-                data=data,
-                absolute_offset=absolute_offset,
-                values=characteristics,
-            ),
-        )
-        getattr(self, field_name)._file_data = file_data
+            setattr(self, field_name, field)
 
     @classmethod
     def parse_from_data(cls, file_data, **cls_args):
         """Parses the Structure from the file data."""
         self = cls(**cls_args)
         self._file_data = file_data
-        for field_name, field_info in self._fields.items():
-            self.process_field(file_data, field_name, field_info)
+        self.decode_fields(file_data)
         return self
 
 
@@ -477,6 +608,8 @@ class PEHeader(Structure):
 
 
 class OptionalHeader(Structure):
+    _flag_fields = ("Characteristics", "DLL_Characteristics")
+
     _fields_32_plus = {
         "Magic": {"offset": 0, "size": 2},
         "MajorLinkerVersion": {"offset": 2, "size": 1},
@@ -605,38 +738,6 @@ class OptionalHeader(Structure):
         "Reserved2": {"offset": 216, "size": 8},
     }
 
-    def process_DLL_Characteristics(self, file_data, field_name, field_info):
-        self.process_Characteristics(file_data, field_name, field_info)
-
-    def process_field(self, file_data, field_name, field_info):
-        if hasattr(self, "process_" + field_name) and callable(
-            getattr(self, "process_" + field_name)
-        ):
-            getattr(self, "process_" + field_name)(file_data, field_name, field_info)
-        else:
-            absolute_offset = field_info["offset"] + self.absolute_offset
-            size = field_info["size"]
-            self.size += size
-            int_value, data = read_bytes(file_data, absolute_offset, size)
-            field_name_dict = read_from_name_dict(self, field_name)
-            name = field_name_dict.get(int_value, "")
-            friendly_name = name.replace("_", " ").capitalize()
-
-            setattr(
-                self,
-                field_name,
-                Structure(
-                    offset=field_info["offset"],
-                    size=size,
-                    value=int_value,
-                    data=data,
-                    absolute_offset=absolute_offset,
-                    name=name,
-                    friendly_name=friendly_name,
-                ),
-            )
-            getattr(self, field_name)._file_data = file_data
-
     @classmethod
     def parse_from_data(cls, file_data, **cls_args):
         """Parses the Structure from the file data."""
@@ -646,14 +747,15 @@ class OptionalHeader(Structure):
 
         if magic == _32BIT_MAGIC:
             self._fields = self._fields_32
+            self._layout = self._layout_32
         elif magic == _32BIT_PLUS_MAGIC:
             self._fields = self._fields_32_plus
+            self._layout = self._layout_32_plus
         else:
             print(magic, _32BIT_MAGIC, _32BIT_PLUS_MAGIC)
             raise PEFormatError("Magic for Optional Header is invalid.")
 
-        for field_name, field_info in self._fields.items():
-            self.process_field(file_data, field_name, field_info)
+        self.decode_fields(file_data)
 
         return self
 
@@ -686,13 +788,131 @@ class ResourceDirectoryTable(Structure):
     }
 
     def __init__(self, *args, **kwargs):
-        self.name_entries = []
-        self.id_entries = []
-        self.subdirectory_tables = []
-        self.data_entries = []
+        self.level = 0
+        self.parsed = False
+        self._name_entries = []
+        self._id_entries = []
+        self._subdirectory_tables = []
+        self._data_entries = []
+        self._entries = []
 
         super(ResourceDirectoryTable, self).__init__(*args, **kwargs)
 
+    @property
+    def entries(self):
+        """(name or id, ResourceDirectoryTable or ResourceDataEntry) pairs
+        in the order they appear in the table
+        """
+        self.parse_entries()
+        return self._entries
+
+    @property
+    def name_entries(self):
+        self.parse_entries()
+        return self._name_entries
+
+    @property
+    def id_entries(self):
+        self.parse_entries()
+        return self._id_entries
+
+    @property
+    def subdirectory_tables(self):
+        self.parse_entries()
+        return self._subdirectory_tables
+
+    @property
+    def data_entries(self):
+        self.parse_entries()
+        return self._data_entries
+
+    def parse_entries(self):
+        """Parses the entries of this table the first time they are needed.
+
+        Subdirectory tables only get their header parsed here, so the
+        resource tree is decoded one level at a time as it is walked.
+        """
+        if self.parsed or self._file_data is None:
+            return
+
+        self.parsed = True
+
+        file_data = self._file_data
+        section_header = self._section_header
+        current_offset = self.absolute_offset + self.size
+
+        for i in range(self.NumberOfNameEntries.value):
+            name_entry = ResourceDirectoryEntryName.parse_from_data(
+                file_data,
+                absolute_offset=current_offset,
+                _section_header=section_header,
+            )
+            current_offset += name_entry.size
+
+            string_offset = name_entry.get_name_absolute_offset()
+            name_entry.directory_string = ResourceDirectoryString.parse_from_data(
+                file_data,
+                absolute_offset=string_offset,
+                _section_header=section_header,
+            )
+
+            offset = name_entry.get_data_or_subdirectory_absolute_offset()
+
+            if not name_entry.data_rva_empty():
+                if name_entry.is_data_entry():
+                    rd = ResourceDataEntry.parse_from_data(
+                        file_data,
+                        absolute_offset=offset,
+                        _section_header=section_header,
+                    )
+                    self._data_entries.append(rd)
+                else:
+                    rd = ResourceDirectoryTable.parse_from_data(
+                        file_data,
+                        absolute_offset=offset,
+                        _section_header=section_header,
+                        type=None,
+                        level=self.level + 1,
+                    )
+                    self._subdirectory_tables.append(rd)
+                self._entries.append((name_entry.directory_string.String.data, rd))
+
+            self._name_entries.append(name_entry)
+
+        for i in range(self.NumberOfIDEntries.value):
+            id_entry = ResourceDirectoryEntryID.parse_from_data(
+                file_data,
+                absolute_offset=current_offset,
+                _section_header=section_header,
+            )
+            current_offset += id_entry.size
+
+            offset = id_entry.get_data_or_subdirectory_absolute_offset()
+
+            if id_entry.is_data_entry():
+                rd = ResourceDataEntry.parse_from_data(
+                    file_data,
+                    absolute_offset=offset,
+                    _section_header=section_header,
+                )
+                self._data_entries.append(rd)
+            else:
+                id_entry.name = str(id_entry.IntegerID.value)
+                if self.level == 0:
+                    id_entry.name = resource_types.get(
+                        id_entry.IntegerID.value, id_entry.name
+                    )
+                rd = ResourceDirectoryTable.parse_from_data(
+                    file_data,
+                    absolute_offset=offset,
+                    _section_header=section_header,
+                    type=id_entry.IntegerID.value,
+                    level=self.level + 1,
+                )
+                self._subdirectory_tables.append(rd)
+            self._entries.append((id_entry.IntegerID.value, rd))
+            self._id_entries.append(id_entry)
+
 
 class ResourceDirectoryEntryName(Structure):
     _fields = {
@@ -767,35 +987,20 @@ class ResourceDirectoryString(Structure):
         """Parses the Structure from the file data."""
         self = cls(**cls_args)
         self._file_data = file_data
-        str_len, _ = read_bytes(file_data, self.absolute_offset, 2)
-
-        self._fields["String"] = {"offset": 2, "size": str_len}
-
-        for field_name, field_info in self._fields.items():
-            self.process_field(file_data, field_name, field_info)
+        self.decode_fields(file_data)
+
+        # The string is Length UTF-16 code units long and follows the
+        # fixed fields, so it is read on its own
+        str_len = self.Length.value
+        absolute_offset = self.absolute_offset + 2
+        self.size += str_len
+        self.String = Field(2, str_len, None, absolute_offset, None)
+        self.String.data = bytes(
+            file_data[absolute_offset : absolute_offset + str_len * 2]
+        ).decode("utf-16-le", "replace")
 
         return self
 
-    def process_String(self, file_data, field_name, field_info):
-        absolute_offset = field_info["offset"] + self.absolute_offset
-        size = field_info["size"]
-        self.size += size
-        data = ""
-        for i in range(size):
-            val, dat = read_bytes(file_data, absolute_offset + i * 2, 2)
-            data += str(dat, "utf-8")
-
-        setattr(
-            self,
-            field_name,
-            Structure(
-                offset=field_info["offset"],
-                size=size,
-                data=data,
-                absolute_offset=absolute_offset,
-            ),
-        )
-
 
 class ResourceDataEntry(Structure):
     _fields = {
@@ -805,6 +1010,21 @@ class ResourceDataEntry(Structure):
         "Reserved": {"offset": 12, "size": 4},
     }
 
+    _data = None
+
+    @property
+    def data(self):
+        """The resource data, read from the file on first access"""
+        if self._data is None and self._file_data is not None:
+            self._data = read_data(
+                self._file_data, self.get_data_absolute_offset(), self.Size.value
+            )
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+
     def get_data_absolute_offset(self):
         return (
             self._section_header.PointerToRawData.value
@@ -812,46 +1032,12 @@ class ResourceDataEntry(Structure):
             + self.DataRVA.value
         )
 
-    def process_field(self, file_data, field_name, field_info):
-        if hasattr(self, "process_" + field_name) and callable(
-            getattr(self, "process_" + field_name)
-        ):
-            getattr(self, "process_" + field_name)(file_data, field_name, field_info)
-        else:
-            absolute_offset = field_info["offset"] + self.absolute_offset
-            size = field_info["size"]
-            self.size += size
-            int_value, data = read_bytes(file_data, absolute_offset, size)
-            field_name_dict = read_from_name_dict(self, field_name)
-            name = field_name_dict.get(int_value, "")
-            friendly_name = name.replace("_", " ").capitalize()
-
-            setattr(
-                self,
-                field_name,
-                Structure(
-                    offset=field_info["offset"],
-                    size=size,
-                    value=int_value,
-                    data=data,
-                    absolute_offset=absolute_offset,
-                    name=name,
-                    friendly_name=friendly_name,
-                ),
-            )
-            getattr(self, field_name)._file_data = file_data
-
     @classmethod
     def parse_from_data(cls, file_data, **cls_args):
         """Parses the Structure from the file data."""
         self = cls(**cls_args)
         self._file_data = file_data
-        for field_name, field_info in self._fields.items():
-            self.process_field(file_data, field_name, field_info)
-
-        self.data = read_data(
-            file_data, self.get_data_absolute_offset(), self.Size.value
-        )
+        self.decode_fields(file_data)
 
         return self
 
@@ -896,7 +1082,7 @@ class IconHeader(Structure):
         self.total_size = self.size
         for group_entry in group_header.entries:
             icon_entry = IconEntry.parse_from_data(
-                bytearray(""),
+                bytearray(b""),
                 absolute_offset=self.absolute_offset + self.size + entry_offset,
                 offset=entry_offset,
             )
@@ -913,8 +1099,7 @@ class IconHeader(Structure):
         self = cls(**cls_args)
         self._file_data = file_data
 
-        for field_name, field_info in self._fields.items():
-            self.process_field(file_data, field_name, field_info)
+        self.decode_fields(file_data)
 
         self.entries = []
         entry_offset = 0
@@ -974,8 +1159,7 @@ class GroupHeader(Structure):
         self = cls(**cls_args)
         self._file_data = file_data
 
-        for field_name, field_info in self._fields.items():
-            self.process_field(file_data, field_name, field_info)
+        self.decode_fields(file_data)
 
         self.entries = []
         entry_offset = 0
@@ -1030,8 +1214,7 @@ class IconEntry(Structure):
         """Parses the Structure from the file data."""
         self = cls(**cls_args)
         self._file_data = file_data
-        for field_name, field_info in self._fields.items():
-            self.process_field(file_data, field_name, field_info)
+        self.decode_fields(file_data)
 
         self.data = read_data(file_data, self.OffsetToData.value, self.DataSize.value)
 
@@ -1070,6 +1253,174 @@ class GroupEntry(Structure):
         self.IconCursorId.value = icon_entry.number
 
 
+def read_resource_tree(table):
+    """Reads the resources below a ResourceDirectoryTable into a list of
+    (name or id, value) pairs, where value is either another such list
+    for a subdirectory or a (data, codepage) pair for a resource.
+    """
+    tree = []
+    for key, child in table.entries:
+        if isinstance(child, ResourceDirectoryTable):
+            tree.append((key, read_resource_tree(child)))
+        else:
+            tree.append((key, (bytes(child.data), child.Codepage.value)))
+    return tree
+
+
+def sort_resource_entries(entries):
+    """Named entries come first, then the ids in ascending order"""
+    named = sorted(entry for entry in entries if isinstance(entry[0], str))
+    ids = sorted(
+        (entry for entry in entries if not isinstance(entry[0], str)),
+        key=lambda entry: entry[0],
+    )
+    return named + ids
+
+
+def build_resource_section(tree, virtual_address):
+    """Lays out a resource tree from read_resource_tree as the contents of
+    a .rsrc section loaded at virtual_address.
+
+    Directory tables come first, breadth first, followed by the entry
+    name strings, the data entries and finally the resource data.
+    """
+    tables = []
+    names = {}
+    resources = []
+
+    pending = [tree]
+    while pending:
+        subtree = pending.pop(0)
+        entries = sort_resource_entries(subtree)
+        tables.append((subtree, entries))
+        for key, value in entries:
+            if isinstance(key, str):
+                names.setdefault(key, None)
+            if isinstance(value, list):
+                pending.append(value)
+            else:
+                resources.append(value)
+
+    offset = 0
+    table_offsets = {}
+    for subtree, entries in tables:
+        table_offsets[id(subtree)] = offset
+        offset += ResourceDirectoryTable._layout.size
+        offset += ResourceDirectoryEntryID._layout.size * len(entries)
+
+    for name in names:
+        names[name] = offset
+        offset += 2 + len(name.encode("utf-16-le"))
+
+    offset = align(offset, 4)
+    entry_offsets = {}
+    for resource in resources:
+        entry_offsets[id(resource)] = offset
+        offset += ResourceDataEntry._layout.size
+
+    data_offsets = {}
+    for resource in resources:
+        offset = align(offset, 8)
+        data_offsets[id(resource)] = offset
+        offset += len(resource[0])
+
+    section = bytearray(offset)
+
+    for subtree, entries in tables:
+        offset = table_offsets[id(subtree)]
+        name_count = sum(1 for key, _ in entries if isinstance(key, str))
+        ResourceDirectoryTable._layout.struct.pack_into(
+            section, offset, 0, 0, 0, 0, name_count, len(entries) - name_count
+        )
+        offset += ResourceDirectoryTable._layout.size
+
+        for key, value in entries:
+            if isinstance(key, str):
+                key = set_bit(names[key], 31)
+            if isinstance(value, list):
+                target = set_bit(table_offsets[id(value)], 31)
+            else:
+                target = entry_offsets[id(value)]
+            ResourceDirectoryEntryID._layout.struct.pack_into(
+                section, offset, key, target
+            )
+            offset += ResourceDirectoryEntryID._layout.size
+
+    for name, offset in names.items():
+        encoded = name.encode("utf-16-le")
+        section[offset : offset + 2] = value_to_byte_string(len(encoded) // 2, 2)
+        section[offset + 2 : offset + 2 + len(encoded)] = encoded
+
+    for resource in resources:
+        data, codepage = resource
+        data_offset = data_offsets[id(resource)]
+        ResourceDataEntry._layout.struct.pack_into(
+            section,
+            entry_offsets[id(resource)],
+            virtual_address + data_offset,
+            len(data),
+            codepage,
+            0,
+        )
+        section[data_offset : data_offset + len(data)] = data
+
+    return section
+
+
+def find_resource(tree, key):
+    for entry_key, value in tree:
+        if entry_key == key:
+            return value
+
+
+def replace_icon_resources(tree, icon_header):
+    """Swaps the icons of the first icon group in a resource tree for the
+    images in icon_header, and points the group at them.
+
+    Icon ids the old images used are handed out again first.
+    """
+    groups = find_resource(tree, ResourceTypes.Group_Icon)
+    if not groups:
+        raise PEFormatError("The file does not have an icon to replace.")
+
+    languages = groups[0][1]
+    language, (group_data, codepage) = languages[0]
+
+    old_group = GroupHeader.parse_from_data(bytearray(group_data))
+    old_ids = [entry.IconCursorId.value for entry in old_group.entries]
+
+    icons = find_resource(tree, ResourceTypes.Icon)
+    if icons is None:
+        icons = []
+        tree.append((ResourceTypes.Icon, icons))
+
+    icons[:] = [icon for icon in icons if icon[0] not in old_ids]
+    used_ids = set(icon[0] for icon in icons if not isinstance(icon[0], str))
+
+    free_ids = sorted(set(old_ids) - used_ids)
+    next_id = max(used_ids | set(old_ids) | {0}) + 1
+    while len(free_ids) < len(icon_header.entries):
+        free_ids.append(next_id)
+        next_id += 1
+
+    group = GroupHeader.parse_from_data(
+        bytearray(
+            GroupHeader._layout.size
+            + GroupEntry._layout.size * len(icon_header.entries)
+        )
+    )
+    group.copy_from(icon_header)
+
+    for group_entry, icon_entry, icon_id in zip(
+        group.entries, icon_header.entries, free_ids
+    ):
+        group_entry.ColorPlanes.value = 1
+        group_entry.IconCursorId.value = icon_id
+        icons.append((icon_id, [(language, (bytes(icon_entry.data), codepage))]))
+
+    languages[0] = (language, (bytes(group._file_data), codepage))
+
+
 class PEFile(Printable):
     """Reads a portable exe file in either big or little endian.
     Right now this only reads the .rsrc section.
@@ -1078,7 +1429,13 @@ class PEFile(Printable):
     signature = b"MZ"
     dos_header = None
 
-    def __init__(self, file_path, endian="little"):
+    def __init__(self, file_path, endian="little", in_place=False):
+        """Parses the PE file at file_path.
+
+        With in_place the file is memory mapped for writing instead of
+        read into memory, and replace_icon patches the mapped bytes so
+        that only the resource ranges it changes are touched.
+        """
         self.file_path = os.path.abspath(os.path.expanduser(file_path))
 
         self.endian = endian
@@ -1087,8 +1444,24 @@ class PEFile(Printable):
                 "File is not a proper portable executable formatted file!"
             )
 
-        self.pe_file_data = bytearray(open(self.file_path, "rb").read())
+        self.in_place = in_place
+        self._file = None
+
+        if in_place:
+            self._file = open(self.file_path, "r+b")
+            self.pe_file_data = mmap.mmap(
+                self._file.fileno(), 0, access=mmap.ACCESS_WRITE
+            )
+        else:
+            with open(self.file_path, "rb") as f:
+                self.pe_file_data = bytearray(f.read())
+
+        self.parse_headers()
 
+    def parse_headers(self):
+        """Parses the headers, the section table and the root resource
+        directory table from pe_file_data.
+        """
         self.dos_header = DOSHeader.parse_from_data(self.pe_file_data)
         self.pe_header = PEHeader.parse_from_data(
             self.pe_file_data, absolute_offset=self.dos_header.PEHeaderOffset.value
@@ -1099,21 +1472,26 @@ class PEFile(Printable):
         )
 
         number_of_sections = self.pe_header.NumberOfSections.value
-        section_size = 40
         section_offset = (
             self.pe_header.size
             + self.pe_header.absolute_offset
             + self.pe_header.SizeOfOptionalHeader.value
         )
         self.sections = {}
+        self.section_headers = []
+        self.resource_section = None
+        self.resource_directory_table = None
+
+        resource_rva = self.optional_header.ResourceTableAddress.value
 
         for section_number in range(number_of_sections):
             section_header = SectionHeader.parse_from_data(
                 self.pe_file_data, absolute_offset=section_offset
             )
-            section_offset += section_size
+            section_offset += SectionHeader._layout.size
             header_name = str(section_header.Name.data, "utf-8").strip("\x00")
             self.sections[header_name] = section_header
+            self.section_headers.append(section_header)
 
             if section_header.PointerToLineNumbers.value != 0:
                 print(
@@ -1129,197 +1507,330 @@ class PEFile(Printable):
                     )
                 )
 
-            if section_header.Name.data == b".rsrc\x00\x00\x00":
-                current_table_pointer = section_header.PointerToRawData.value
-                current_resource_directory_table = (
-                    ResourceDirectoryTable.parse_from_data(
-                        self.pe_file_data,
-                        absolute_offset=current_table_pointer,
-                        _section_header=section_header,
-                        type=None,
-                    )
-                )
-                self.resource_directory_table = current_resource_directory_table
-                cur_level = 0
-                stack = [(current_resource_directory_table, cur_level)]
+            # The resource table data directory says which section holds
+            # the resources, in case an older .rsrc was left behind
+            if (
+                section_header.Name.data == b".rsrc\x00\x00\x00"
+                and self.resource_section is None
+            ) or section_header.VirtualAddress.value == resource_rva:
+                self.resource_section = section_header
+
+        if self.resource_section is not None:
+            # Only the root table is parsed here. The rest of the tree
+            # is parsed as get_directory_by_type and the table
+            # properties reach it.
+            self.resource_directory_table = ResourceDirectoryTable.parse_from_data(
+                self.pe_file_data,
+                absolute_offset=self.resource_section.PointerToRawData.value,
+                _section_header=self.resource_section,
+                type=None,
+            )
 
-                delta = (
-                    section_header.VirtualAddress.value
-                    - section_header.PointerToRawData.value
-                )
+        self.section_table_end = section_offset
 
-                while stack:
-                    resource_directory_table, level = stack.pop()
-                    num_name_entries = (
-                        resource_directory_table.NumberOfNameEntries.value
-                    )
-                    num_id_entries = resource_directory_table.NumberOfIDEntries.value
-                    current_offset = (
-                        resource_directory_table.absolute_offset
-                        + resource_directory_table.size
-                    )
+    def replace_icon(self, icon_path, sizes=ICON_SIZES):
+        """Replaces the main icon of the exe with the image at icon_path,
+        rendered at every size in sizes, and rebuilds the .rsrc section.
 
-                    for i in range(num_name_entries):
-                        name_entry = ResourceDirectoryEntryName.parse_from_data(
-                            self.pe_file_data,
-                            absolute_offset=current_offset,
-                            _section_header=section_header,
-                        )
-                        current_offset += name_entry.size
-
-                        string_offset = name_entry.get_name_absolute_offset()
-                        name_entry.directory_string = (
-                            ResourceDirectoryString.parse_from_data(
-                                self.pe_file_data,
-                                absolute_offset=string_offset,
-                                _section_header=section_header,
-                            )
-                        )
-
-                        offset = name_entry.get_data_or_subdirectory_absolute_offset()
-
-                        if not name_entry.data_rva_empty():
-                            if name_entry.is_data_entry():
-                                rd = ResourceDataEntry.parse_from_data(
-                                    self.pe_file_data,
-                                    absolute_offset=offset,
-                                    _section_header=section_header,
-                                )
-                                resource_directory_table.data_entries.append(rd)
-                            else:
-                                rd = ResourceDirectoryTable.parse_from_data(
-                                    self.pe_file_data,
-                                    absolute_offset=offset,
-                                    _section_header=section_header,
-                                    type=None,
-                                )
-                                resource_directory_table.subdirectory_tables.append(rd)
-
-                                stack.append((rd, level + 1))
-
-                        resource_directory_table.name_entries.append(name_entry)
-
-                    for i in range(num_id_entries):
-                        id_entry = ResourceDirectoryEntryID.parse_from_data(
-                            self.pe_file_data,
-                            absolute_offset=current_offset,
-                            _section_header=section_header,
-                        )
-                        current_offset += id_entry.size
-
-                        offset = id_entry.get_data_or_subdirectory_absolute_offset()
-
-                        if id_entry.is_data_entry():
-                            rd = ResourceDataEntry.parse_from_data(
-                                self.pe_file_data,
-                                absolute_offset=offset,
-                                _section_header=section_header,
-                            )
-                            resource_directory_table.data_entries.append(rd)
-                        else:
-                            id_entry.name = str(id_entry.IntegerID.value)
-                            if level + 1 == 1:
-                                id_entry.name = resource_types[id_entry.IntegerID.value]
-                            rd = ResourceDirectoryTable.parse_from_data(
-                                self.pe_file_data,
-                                absolute_offset=offset,
-                                _section_header=section_header,
-                                type=id_entry.IntegerID.value,
-                            )
-                            resource_directory_table.subdirectory_tables.append(rd)
-                            stack.append((rd, level + 1))
-                        resource_directory_table.id_entries.append(id_entry)
-
-    def replace_icon(self, icon_path):
-        """Replaces an icon in the pe file with the one specified.
-        This only replaces the largest icon and resizes the input
-        image to match so that the data is undisturbed. I tried to
-        update the pointers automatically by moving the data to the end
-        of the file, but that did not work. Comments were left as history
-        to what I attempted.
+        See write_resource_section for where the new section goes. If it
+        fits nowhere, the largest sizes are left out until it fits over
+        the old section.
         """
-        icon_path = os.path.expanduser(
-            icon_path
-        )  # this needs to be a string and not unicode
+        icon_path = os.path.expanduser(icon_path)
 
         if not os.path.exists(icon_path):
             raise Exception("Icon {} does not exist".format(icon_path))
 
-        resource_section = self.sections[".rsrc"]
+        image = Image.open(icon_path)
+        sizes = sorted(sizes)
+
+        for count in range(len(sizes), 0, -1):
+            tree = read_resource_tree(self.resource_directory_table)
+            replace_icon_resources(tree, icon_images(image, sizes[:count]))
+            size = len(build_resource_section(tree, 0))
+            if self.resource_section_plan(size) is not None:
+                break
+
+        self.write_resource_section(tree)
+
+    def following_sections(self, section):
+        """Gets the section headers loaded after section."""
+        return [
+            header
+            for header in self.section_headers
+            if header.VirtualAddress.value > section.VirtualAddress.value
+        ]
+
+    def can_move_section(self, section):
+        """Checks if only the loader uses section, through the base
+        relocation table, so that it can be moved to another address.
+        """
+        relocations = self.optional_header.BaseRelocationTableAddress.value
+        return (
+            bool(section.Characteristics.value & IMAGE_SCN_MEM_DISCARDABLE)
+            and section.VirtualAddress.value == relocations
+            and bool(self.optional_header.BaseRelocationTableSize.value)
+        )
 
-        g_icon_dir = self.get_directory_by_type(ResourceTypes.Group_Icon)
-        g_icon_data_entry = g_icon_dir.subdirectory_tables[0].data_entries[0]
-        icon_dir = self.get_directory_by_type(ResourceTypes.Icon)
-        icon_data_entry = icon_dir.subdirectory_tables[0].data_entries[0]
+    def resource_section_plan(self, size):
+        """Decides how a resource section of size bytes gets written.
 
-        group_header = GroupHeader.parse_from_data(
-            self.pe_file_data,
-            absolute_offset=g_icon_data_entry.get_data_absolute_offset(),
-        )
-        g_entry = group_header.entries[0]
+        Returns "in place" if it fits over the old section, "grow" if the
+        old section can be made larger, "append" if it has to go in a new
+        section or None if there is no room for it.
+        """
+        section = self.resource_section
+        virtual_address = section.VirtualAddress.value
+        next_addresses = [
+            header.VirtualAddress.value for header in self.following_sections(section)
+        ]
+
+        if size <= section.SizeOfRawData.value and (
+            not next_addresses or virtual_address + size <= min(next_addresses)
+        ):
+            return "in place"
+
+        # The sections after it have to be moved along, which only works
+        # for relocations, and so does their data in the file
+        raw_end = section.PointerToRawData.value + section.SizeOfRawData.value
+        following = self.following_sections(section)
+        if all(self.can_move_section(header) for header in following) and all(
+            header in following
+            for header in self.section_headers
+            if header.SizeOfRawData.value and header.PointerToRawData.value >= raw_end
+        ):
+            return "grow"
 
-        icon = Image.open(icon_path)
-        width = g_entry.Width.value
-        height = g_entry.Height.value
+        if self.has_room_for_section():
+            return "append"
 
-        if width == 0:
-            width = 256
-        if height == 0:
-            height = 256
+    def write_resource_section(self, tree):
+        """Replaces the resource section with one built from tree.
 
-        i_data = resize(icon, (width, height), format="ico")
+        The new section is written over the old one when it fits there.
+        Otherwise the old section grows when only the relocations follow
+        it, which are moved behind it. Failing that, it is added as a new
+        section after the last one and the old one is left unused. Any
+        data appended to the exe is moved along.
 
-        new_icon_size = len(i_data)
-        icon_file_size = g_entry.DataSize.value + group_header.size + g_entry.size + 2
+        Raises PEFormatError if there is no room for the new section.
+        """
+        section = self.resource_section
+        virtual_address = section.VirtualAddress.value
+        data = build_resource_section(tree, virtual_address)
+        plan = self.resource_section_plan(len(data))
+
+        if plan is None:
+            raise PEFormatError("There is no room for the new resources.")
+
+        if plan == "in place":
+            start = section.PointerToRawData.value
+            end = start + section.SizeOfRawData.value
+            self.pe_file_data[start:end] = data + bytes(end - start - len(data))
+            section.VirtualSize.value = len(data)
+            if not self.following_sections(section):
+                self.optional_header.SizeOfImage.value = align(
+                    virtual_address + len(data),
+                    self.optional_header.SectionAlignment.value,
+                )
+        else:
+            # The file changes size, so it can't stay memory mapped
+            self.read_into_memory()
+            if plan == "grow":
+                section = self.grow_section(self.resource_section, len(data))
+            else:
+                section = self.append_section(
+                    b".rsrc", len(data), self.resource_section.Characteristics.value
+                )
+                data = build_resource_section(tree, section.VirtualAddress.value)
+            start = section.PointerToRawData.value
+            self.pe_file_data[start : start + len(data)] = data
 
-        # 9662 is the exact length of the icon in nw.exe
-        extra_size = icon_file_size - new_icon_size
+        self.optional_header.ResourceTableAddress.value = section.VirtualAddress.value
+        self.optional_header.ResourceTableSize.value = len(data)
 
-        if extra_size < 0:
-            extra_size = 0
-        icon_data = bytearray(i_data) + bytearray(extra_size)
+        self.resource_section = section
+        self.resource_directory_table = ResourceDirectoryTable.parse_from_data(
+            self.pe_file_data,
+            absolute_offset=section.PointerToRawData.value,
+            _section_header=section,
+            type=None,
+        )
 
-        icon_header = IconHeader.parse_from_data(icon_data, absolute_offset=0)
+    def insert_data(self, offset, size):
+        """Inserts size zero bytes into the file at offset, and moves the
+        section data and certificate table that were behind it along.
+        """
+        self.pe_file_data[offset:offset] = bytes(size)
+
+        for header in self.section_headers:
+            if header.SizeOfRawData.value and header.PointerToRawData.value >= offset:
+                header.PointerToRawData.value += size
+
+        certificates = self.optional_header.CertificateTableAddress
+        if certificates.value >= offset:
+            # The certificate table is the one data directory that holds a
+            # file offset instead of an address
+            certificates.value += size
+
+    def update_size_of_image(self):
+        self.optional_header.SizeOfImage.value = align(
+            max(
+                header.VirtualAddress.value
+                + max(header.VirtualSize.value, header.SizeOfRawData.value)
+                for header in self.section_headers
+            ),
+            self.optional_header.SectionAlignment.value,
+        )
 
-        # group_header.absolute_offset = len(self.pe_file_data)
-        # g_icon_data_entry.DataRVA.value = len(self.pe_file_data) - resource_section.PointerToRawData.value + resource_section.VirtualAddress.value
-        # padding = 6+14*len(icon_header.entries)
-        # g_icon_data_entry.Size.value = padding
+    def grow_section(self, section, size):
+        """Makes section hold size bytes, moving the sections after it in
+        the file and in memory out of the way.
 
-        # self.pe_file_data += bytearray(padding)
-        group_header._file_data = self.pe_file_data
-        group_header.copy_from(icon_header)
+        Returns section.
+        """
+        file_alignment = self.optional_header.FileAlignment.value
+        section_alignment = self.optional_header.SectionAlignment.value
 
-        # icon_data_entry.DataRVA.value = len(self.pe_file_data) - resource_section.PointerToRawData.value + resource_section.VirtualAddress.value
-        # print hex(icon_data_entry.DataRVA.value), hex(len(self.pe_file_data)), hex(icon_data_entry.get_data_absolute_offset())
+        raw_size = align(size, file_alignment)
+        inserted = max(0, raw_size - section.SizeOfRawData.value)
+        following = self.following_sections(section)
 
-        # print hex(read_bytes(self.pe_file_data[icon_data_entry.DataRVA.absolute_offset:icon_data_entry.DataRVA.absolute_offset+icon_data_entry.DataRVA.size],0, icon_data_entry.DataRVA.size)[0])
+        self.insert_data(
+            section.PointerToRawData.value + section.SizeOfRawData.value, inserted
+        )
 
-        # data = bytearray()
-        # for entry in icon_header.entries:
-        # data += entry.data
-        # self.pe_file_data += entry.data
+        if following:
+            end = align(section.VirtualAddress.value + size, section_alignment)
+            moved = max(
+                0, end - min(header.VirtualAddress.value for header in following)
+            )
+            relocations = self.optional_header.BaseRelocationTableAddress
+            if any(
+                header.VirtualAddress.value == relocations.value for header in following
+            ):
+                relocations.value += moved
+            for header in following:
+                header.VirtualAddress.value += moved
+
+        section.SizeOfRawData.value += inserted
+        section.VirtualSize.value = size
+        self.optional_header.SizeOfInitializedData.value += inserted
+        self.update_size_of_image()
+
+        return section
+
+    def has_room_for_section(self):
+        """Checks if the section table has room for another header."""
+        header_offset = self.section_table_end
+        header_end = header_offset + SectionHeader._layout.size
+        first_data = min(
+            [
+                header.PointerToRawData.value
+                for header in self.section_headers
+                if header.SizeOfRawData.value
+            ]
+            + [self.optional_header.SizeOfHeaders.value]
+        )
+        return header_end <= first_data and not any(
+            self.pe_file_data[header_offset:header_end]
+        )
 
-        # icon_data_entry.Size.value = len(data)
+    def append_section(self, name, size, characteristics):
+        """Adds a section header for size bytes after the last section and
+        makes room for them in the file, in front of any appended data.
 
-        # self.optional_header.SizeOfImage.value = self.optional_header.SizeOfImage.value + len(data) + padding
-        # self.optional_header.ResourceTableSize.value = self.optional_header.ResourceTableSize.value + len(data) + padding
-        # self.optional_header.SizeOfInitializedData.value = self.optional_header.SizeOfInitializedData.value + len(data) + padding
-        # resource_section.SizeOfRawData.value = resource_section.SizeOfRawData.value + len(data) + padding
-        # resource_section.VirtualSize.value = resource_section.VirtualSize.value + len(data) + padding
-        # print icon_header.total_size
-        data_address = icon_data_entry.get_data_absolute_offset()
-        data_size = icon_data_entry.Size.value
-        self.pe_file_data = (
-            self.pe_file_data[:data_address]
-            + icon_data[icon_header.total_size :]
-            + self.pe_file_data[data_address + data_size :]
+        Returns the new SectionHeader.
+        """
+        if not self.has_room_for_section():
+            raise PEFormatError("There is no room for another section header.")
+
+        header_offset = self.section_table_end
+        header_end = header_offset + SectionHeader._layout.size
+        raw_headers = [
+            header for header in self.section_headers if header.SizeOfRawData.value
+        ]
+
+        file_alignment = self.optional_header.FileAlignment.value
+        section_alignment = self.optional_header.SectionAlignment.value
+
+        virtual_address = align(
+            max(
+                header.VirtualAddress.value
+                + max(header.VirtualSize.value, header.SizeOfRawData.value)
+                for header in self.section_headers
+            ),
+            section_alignment,
+        )
+        data_end = max(
+            header.PointerToRawData.value + header.SizeOfRawData.value
+            for header in raw_headers
         )
+        pointer = align(data_end, file_alignment)
+        raw_size = align(size, file_alignment)
+
+        self.insert_data(data_end, pointer - data_end + raw_size)
+
+        SectionHeader._layout.struct.pack_into(
+            self.pe_file_data,
+            header_offset,
+            int.from_bytes(name.ljust(8, b"\x00"), "little"),
+            size,
+            virtual_address,
+            raw_size,
+            pointer,
+            0,
+            0,
+            0,
+            0,
+            characteristics,
+        )
+
+        self.pe_header.NumberOfSections.value += 1
+        self.optional_header.SizeOfImage.value = align(
+            virtual_address + size, section_alignment
+        )
+        self.optional_header.SizeOfInitializedData.value += raw_size
+
+        header = SectionHeader.parse_from_data(
+            self.pe_file_data, absolute_offset=header_offset
+        )
+        self.sections[str(name, "utf-8")] = header
+        self.section_headers.append(header)
+        self.section_table_end = header_end
+        return header
+
+    def read_into_memory(self):
+        """Copies a memory mapped file into memory and unmaps it."""
+        if self.in_place:
+            data = bytearray(self.pe_file_data)
+            self.close()
+            self.pe_file_data = data
+            self.in_place = False
+            self.parse_headers()
 
     def write(self, file_name):
+        if self.in_place and os.path.abspath(file_name) == self.file_path:
+            self.pe_file_data.flush()
+            return
+
         with open(file_name, "wb+") as f:
             f.write(self.pe_file_data)
 
+    def close(self):
+        """Flushes and unmaps the file if it was opened in place."""
+        if self._file is not None:
+            self.pe_file_data.flush()
+            self.pe_file_data.close()
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     def get_directory_by_type(self, type):
         """Gets the directory by resource type."""
         for d in self.resource_directory_table.subdirectory_tables:
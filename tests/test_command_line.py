@@ -1,9 +1,12 @@
 import os
+import sys
+import threading
 import config
 import utils
 import pytest
 
 from command_line import CommandBase
+from util_classes import FileIndex
 
 # api = pytest.mark.skipif(
 #     not pytest.Config.getoption("--runapi"),
@@ -77,6 +80,7 @@ def test_invalid_get_setting_objects(command_base):
         setting = command_base.get_setting(setting_name)
         assert setting == None
 
+
 # TODO: investigate why this test is failing
 # def test_get_default_nwjs_branch(command_base):
 #     import re
@@ -87,6 +91,7 @@ def test_invalid_get_setting_objects(command_base):
 
 #     assert match != None
 
+
 def test_download_nwjs(command_base):
     command_base.get_setting("nw_version").value = "0.19.0"
     command_base.get_setting("windows-x64").value = True
@@ -102,3 +107,619 @@ def test_download_nwjs(command_base):
             base, "test_data", "files", "downloads", "nwjs-v0.19.0-win-x64.zip"
         )
     )
+
+
+@pytest.fixture
+def project_base(tmp_path):
+    config.TESTING = True
+
+    project_dir = tmp_path / "project"
+    (project_dir / "js").mkdir(parents=True)
+    (project_dir / "index.html").write_text("<html></html>")
+    (project_dir / "js" / "app.js").write_text("console.log('hi');")
+
+    base = CommandBase(quiet=True)
+    base.logger = config.getLogger("test")
+    base._project_name = "Test"
+    base._project_dir = str(project_dir)
+    base._output_dir = str(tmp_path / "output")
+    base.file_tree.index_dir = str(tmp_path / "file_index")
+    base.payload_store = str(tmp_path / "payloads")
+    return base
+
+
+def test_app_nw_payload_built_once(project_base, monkeypatch):
+    import command_line
+
+    zip_calls = []
+    original_zip_files = command_line.zip_files
+
+    def counting_zip_files(*args, **kwargs):
+        zip_calls.append(args[0])
+        return original_zip_files(*args, **kwargs)
+
+    used_payloads = []
+    payload_hashes = []
+
+    def fake_process_export_setting(ex_setting, output_name, app_loc):
+        if ex_setting.value:
+            used_payloads.append((ex_setting.name, app_loc, project_base.app_nw_hash))
+            payload_hashes.append(utils.hash_path(app_loc))
+
+    monkeypatch.setattr(command_line, "zip_files", counting_zip_files)
+    monkeypatch.setattr(
+        project_base, "process_export_setting", fake_process_export_setting
+    )
+
+    for name in ["windows-x64", "linux-x64", "mac-x64"]:
+        project_base.get_setting(name).value = True
+
+    project_base.make_output_dirs(write_json=False)
+
+    assert len(zip_calls) == 1
+    assert len(used_payloads) == 3
+    assert len({(loc, digest) for _, loc, digest in used_payloads}) == 1
+    assert payload_hashes == [project_base.app_nw_hash] * 3
+    assert not os.path.exists(used_payloads[0][1])
+
+
+def test_failed_platform_does_not_abort_others(project_base, monkeypatch):
+    from command_line import ExportError
+
+    exported = []
+
+    def fake_process_export_setting(ex_setting, output_name, app_loc):
+        if ex_setting.name == "linux-x64":
+            raise RuntimeError("boom")
+        exported.append(ex_setting.name)
+
+    monkeypatch.setattr(
+        project_base, "process_export_setting", fake_process_export_setting
+    )
+
+    for name in ["windows-x64", "linux-x64", "mac-x64"]:
+        project_base.get_setting(name).value = True
+    project_base.export_jobs = 3
+
+    with pytest.raises(ExportError) as exc_info:
+        project_base.make_output_dirs(write_json=False)
+
+    assert list(exc_info.value.errors) == ["linux-x64"]
+    assert "boom" in exc_info.value.errors["linux-x64"]
+    assert sorted(exported) == ["mac-x64", "windows-x64"]
+
+
+def test_cli_reports_failed_platform_and_exits(tmp_path, monkeypatch, capsys):
+    import command_line
+
+    project_dir = tmp_path / "project"
+    project_dir.mkdir()
+    (project_dir / "index.html").write_text("<html></html>")
+    output_dir = tmp_path / "output"
+
+    def fake_process_export_setting(self, ex_setting, output_name, app_loc):
+        if ex_setting.name == "linux-x64":
+            raise RuntimeError("boom")
+        export_dir = os.path.join(self.output_dir(), output_name, ex_setting.name)
+        os.makedirs(export_dir)
+        with open(os.path.join(export_dir, "Test.exe"), "w") as f:
+            f.write("exe")
+
+    original_init = CommandBase.__init__
+
+    def init_in_tmp_path(self, *args, **kwargs):
+        original_init(self, *args, **kwargs)
+        self.file_tree.index_dir = str(tmp_path / "file_index")
+        self.payload_store = str(tmp_path / "payloads")
+
+    monkeypatch.setattr(sys, "excepthook", sys.excepthook)
+    monkeypatch.setattr(CommandBase, "__init__", init_in_tmp_path)
+    monkeypatch.setattr(CommandBase, "get_versions", lambda self: None)
+    monkeypatch.setattr(CommandBase, "download_files", lambda self: True)
+    monkeypatch.setattr(
+        CommandBase, "process_export_setting", fake_process_export_setting
+    )
+
+    with pytest.raises(SystemExit) as exc_info:
+        command_line.main(
+            [
+                str(project_dir),
+                "--output-dir",
+                str(output_dir),
+                "--download-dir",
+                str(tmp_path / "downloads"),
+                "--name",
+                "Test",
+                "--main",
+                "index.html",
+                "--quiet",
+                "--export-to",
+                "windows-x64",
+                "linux-x64",
+            ]
+        )
+
+    assert exc_info.value.code == 1
+    assert (output_dir / "project" / "windows-x64" / "Test.exe").exists()
+    assert not (output_dir / "project" / "linux-x64").exists()
+    err = capsys.readouterr().err
+    assert "Failed to export linux-x64:" in err
+    assert "boom" in err
+    assert "ExportError" not in err
+
+
+def test_stage_progress_shown_from_coordinator(project_base, monkeypatch):
+    shown = []
+
+    def set_progress_text(value):
+        shown.append((threading.current_thread(), value))
+
+    def fake_process_export_setting(ex_setting, output_name, app_loc):
+        project_base.progress_text = "Making files for {}".format(ex_setting.name)
+        for _ in range(50):
+            project_base.progress_text += "."
+        assert project_base.progress_text.endswith("." * 50)
+
+    monkeypatch.setattr(project_base, "set_progress_text", set_progress_text)
+    monkeypatch.setattr(
+        project_base, "process_export_setting", fake_process_export_setting
+    )
+
+    for name in ["windows-x64", "linux-x64", "mac-x64"]:
+        project_base.get_setting(name).value = True
+    project_base.export_jobs = 3
+
+    errors = project_base.run_export_stages("Test", None)
+
+    assert errors == {}
+    assert set(thread for thread, _ in shown) == {threading.current_thread()}
+    texts = [text for _, text in shown]
+    assert sum("done." in text for text in texts) == 3
+    for name in ["windows-x64", "linux-x64", "mac-x64"]:
+        assert any(
+            text.endswith("Making files for {}{}".format(name, "." * 50))
+            for text in texts
+        )
+
+
+def test_upx_failure_fails_only_its_stage(project_base, tmp_path, monkeypatch):
+    upx_bin = tmp_path / "upx"
+    upx_bin.write_bytes(b"")
+
+    def fake_process_export_setting(ex_setting, output_name, app_loc):
+        nw_path = tmp_path / ex_setting.name
+        nw_path.mkdir()
+        (nw_path / "nw").write_bytes(ex_setting.name.encode())
+        project_base.compress_nw(str(nw_path), ex_setting)
+
+    def fake_run_upx(cmd):
+        if "windows" in cmd[-1]:
+            return 1, b"NotCompressibleException"
+        return 0, b""
+
+    monkeypatch.setattr(
+        project_base, "process_export_setting", fake_process_export_setting
+    )
+    monkeypatch.setattr(project_base, "upx_path", lambda: str(upx_bin))
+    monkeypatch.setattr(project_base, "upx_version", lambda upx_bin: "test")
+    monkeypatch.setattr(
+        project_base,
+        "upx_targets",
+        lambda nw_path, ex_setting: [os.path.join(nw_path, "nw")],
+    )
+    monkeypatch.setattr(project_base, "run_upx", fake_run_upx)
+
+    project_base.get_setting("download_dir").value = str(tmp_path / "downloads")
+    project_base.get_setting("nw_compression_level").value = 3
+    for name in ["windows-x64", "linux-x64", "mac-x64"]:
+        project_base.get_setting(name).value = True
+    project_base.export_jobs = 3
+
+    errors = project_base.run_export_stages("Test", None)
+
+    assert list(errors) == ["windows-x64"]
+    assert "Cannot compress files for windows-x64" in errors["windows-x64"]
+
+
+def make_runtime_archive(directory, version, platform_name="win-x64"):
+    import zipfile
+
+    prefix = "nwjs-v{}-{}".format(version, platform_name)
+    archive_path = os.path.join(str(directory), prefix + ".zip")
+    with zipfile.ZipFile(archive_path, "w") as archive:
+        archive.writestr(prefix + "/nw.exe", b"MZ" + b"\0" * 64)
+        archive.writestr(prefix + "/locales/en-US.pak", b"pak" * 100)
+    return archive_path
+
+
+def test_runtime_cache_extracts_once(project_base, tmp_path):
+    downloads = tmp_path / "downloads"
+    downloads.mkdir()
+    archive_path = make_runtime_archive(downloads, "0.1.0")
+
+    project_base.get_setting("download_dir").value = str(downloads)
+    project_base.get_setting("nw_version").value = "0.1.0"
+    ex_setting = project_base.get_setting("windows-x64")
+    ex_setting.value = True
+
+    cache = project_base.runtime_cache()
+    key = project_base.runtime_key(ex_setting)
+    assert key == "0.1.0-windows-x64"
+    assert cache.get(key) is None
+
+    project_base.extract_files()
+
+    runtime_path = project_base.runtime_path(ex_setting)
+    assert os.path.exists(os.path.join(runtime_path, "nw.exe"))
+    assert cache.get(key, archive_path) == runtime_path
+
+    mtime = os.path.getmtime(os.path.join(runtime_path, "nw.exe"))
+    project_base.extract_files()
+    assert os.path.getmtime(os.path.join(runtime_path, "nw.exe")) == mtime
+
+    os.remove(os.path.join(runtime_path, "locales", "en-US.pak"))
+    assert cache.get(key) is None
+
+
+def test_runtime_cache_prunes_least_recently_used(project_base, tmp_path):
+    downloads = tmp_path / "downloads"
+    downloads.mkdir()
+
+    project_base.get_setting("download_dir").value = str(downloads)
+    ex_setting = project_base.get_setting("windows-x64")
+    cache = project_base.runtime_cache()
+
+    for version in ["0.1.0", "0.2.0", "0.3.0"]:
+        archive_path = make_runtime_archive(downloads, version)
+        key = cache.key(version, ex_setting)
+        cache.install(key, ex_setting, version, archive_path)
+
+    manifest = cache.load_manifest("0.1.0-windows-x64")
+    manifest["last_used"] = 0
+    cache.save_manifest("0.1.0-windows-x64", manifest)
+    entry_size = manifest["size"]
+
+    # A runtime another export is reading is not evicted
+    with cache.lock("0.1.0-windows-x64", shared=True):
+        assert project_base.prune_runtimes(entry_size * 2) == ["0.2.0-windows-x64"]
+
+    removed = project_base.prune_runtimes(entry_size)
+
+    assert removed == ["0.1.0-windows-x64"]
+    assert sorted(key for key, _ in cache.entries()) == ["0.3.0-windows-x64"]
+
+
+def test_download_files_concurrently(project_base, tmp_path, monkeypatch):
+    import zipfile
+
+    downloads = tmp_path / "downloads"
+    downloads.mkdir()
+
+    project_base.get_setting("download_dir").value = str(downloads)
+    project_base.get_setting("nw_version").value = "0.1.0"
+    project_base.get_setting("download_jobs").value = "3"
+
+    names = ["windows-x64", "windows-x32", "mac-x64"]
+    for name in names:
+        project_base.get_setting(name).value = True
+
+    # Every fetch waits for the others, so this only passes if the
+    # archives are downloaded at the same time
+    barrier = threading.Barrier(len(names), timeout=10)
+    extracted = []
+
+    def fake_fetch_archive(path, setting, progress_callback=None):
+        barrier.wait()
+        if setting.name == "mac-x64":
+            raise IOError("connection reset")
+
+        file_name = setting.save_file_path("0.1.0", str(downloads))
+        prefix = os.path.basename(file_name)[: -len(".zip")]
+        with zipfile.ZipFile(file_name, "w") as archive:
+            archive.writestr(prefix + "/nw.exe", b"MZ")
+        progress_callback(2, 2)
+        return file_name
+
+    def fake_extract_file(setting, cache=None):
+        extracted.append(setting.name)
+        return original_extract_file(setting, cache)
+
+    original_extract_file = project_base.extract_file
+    monkeypatch.setattr(project_base, "fetch_archive", fake_fetch_archive)
+    monkeypatch.setattr(project_base, "extract_file", fake_extract_file)
+
+    project_base.get_files_to_download()
+    assert project_base.try_to_download_files() is False
+
+    assert sorted(extracted) == ["windows-x32", "windows-x64"]
+    for name in ["windows-x32", "windows-x64"]:
+        runtime_path = project_base.runtime_path(project_base.get_setting(name))
+        assert os.path.exists(os.path.join(runtime_path, "nw.exe"))
+
+
+def test_stream_extract_tar_gz_runtime(project_base, tmp_path, monkeypatch):
+    import io
+    import tarfile
+    import functools
+
+    from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+    from util_classes import Setting
+
+    served = tmp_path / "served" / "v0.1.0"
+    served.mkdir(parents=True)
+    archive_path = served / "nwjs-v0.1.0-linux-x64.tar.gz"
+    with tarfile.open(str(archive_path), "w:gz") as archive:
+        for name, data in [("nw", b"\x7fELF" * 1000), ("locales/en-US.pak", b"pak")]:
+            info = tarfile.TarInfo("nwjs-v0.1.0-linux-x64/" + name)
+            info.size = len(data)
+            info.mode = 0o755
+            archive.addfile(info, io.BytesIO(data))
+
+    handler = functools.partial(
+        SimpleHTTPRequestHandler, directory=str(tmp_path / "served")
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    downloads = tmp_path / "downloads"
+    downloads.mkdir()
+
+    ex_setting = project_base.get_setting("linux-x64")
+    ex_setting.value = True
+    monkeypatch.setattr(
+        ex_setting,
+        "url",
+        "http://127.0.0.1:{}/v{{}}/nwjs-v{{}}-linux-x64.tar.gz".format(
+            server.server_address[1]
+        ),
+    )
+    project_base.get_setting("download_dir").value = str(downloads)
+    project_base.get_setting("nw_version").value = "0.1.0"
+    project_base.get_setting("stream_extract").value = True
+    project_base.get_setting("force_download").value = True
+
+    def fail_extract(*args, **kwargs):
+        raise AssertionError("the archive was extracted a second time")
+
+    monkeypatch.setattr(Setting, "extract", fail_extract)
+
+    try:
+        project_base.get_files_to_download()
+        assert project_base.try_to_download_files() is True
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    saved_path = ex_setting.save_file_path("0.1.0", str(downloads))
+    with open(saved_path, "rb") as saved, open(str(archive_path), "rb") as source:
+        assert saved.read() == source.read()
+
+    runtime_path = project_base.runtime_path(ex_setting)
+    assert os.access(os.path.join(runtime_path, "nw"), os.X_OK)
+    assert os.path.exists(os.path.join(runtime_path, "locales", "en-US.pak"))
+    assert project_base.runtime_cache().is_valid(
+        project_base.runtime_key(ex_setting), saved_path
+    )
+
+
+def test_unchanged_project_reuses_payload(project_base, monkeypatch):
+    import command_line
+
+    zip_calls = []
+    original_zip_files = command_line.zip_files
+
+    def counting_zip_files(*args, **kwargs):
+        zip_calls.append(args[0])
+        return original_zip_files(*args, **kwargs)
+
+    monkeypatch.setattr(command_line, "zip_files", counting_zip_files)
+    monkeypatch.setattr(
+        project_base, "process_export_setting", lambda *args, **kwargs: None
+    )
+    monkeypatch.setattr(FileIndex, "racy_interval", 0)
+    project_base.get_setting("windows-x64").value = True
+
+    project_base.make_output_dirs(write_json=False)
+    first_hash = project_base.app_nw_hash
+
+    project_base.make_output_dirs(write_json=False)
+    assert len(zip_calls) == 1
+    assert project_base.app_nw_hash == first_hash
+
+    app_js = os.path.join(project_base.project_dir(), "js", "app.js")
+    with open(app_js, "w") as f:
+        f.write("console.log('changed');")
+
+    project_base.make_output_dirs(write_json=False)
+    assert len(zip_calls) == 2
+    assert project_base.app_nw_hash != first_hash
+
+
+def test_payload_store_evicts_least_recently_exported(project_base, monkeypatch):
+    monkeypatch.setattr(
+        project_base, "process_export_setting", lambda *args, **kwargs: None
+    )
+    project_base.get_setting("windows-x64").value = True
+    project_base.make_output_dirs(write_json=False)
+    current = project_base.payload_store_dir()
+
+    store = project_base.payload_store_root()
+    for index in range(3):
+        old_dir = os.path.join(store, "project{}".format(index))
+        os.makedirs(old_dir)
+        with open(os.path.join(old_dir, "Test.nw"), "wb") as f:
+            f.write(b"\0" * 1024 * 1024)
+        manifest = os.path.join(old_dir, "payload.json")
+        with open(manifest, "w") as f:
+            f.write("{}")
+        os.utime(manifest, (index, index))
+
+    assert project_base.prune_payloads(max_size=0) == []
+
+    project_base.get_setting("payload_store_size").value = 2
+    removed = project_base.prune_payloads(keep=[current])
+    assert [os.path.basename(path) for path in removed] == ["project0", "project1"]
+    assert sorted(
+        name for name in os.listdir(store) if os.path.isdir(os.path.join(store, name))
+    ) == sorted([os.path.basename(current), "project2"])
+
+
+def test_stream_app_nw_into_executable(project_base, tmp_path, monkeypatch):
+    import io
+    import zipfile
+    import command_line
+
+    project_base.get_setting("stream_app_nw").value = True
+    project_base.file_tree.init(project_base.project_dir())
+    assert project_base.streams_app_nw()
+
+    monkeypatch.setattr(
+        project_base,
+        "build_app_nw_payload",
+        lambda temp_dir: pytest.fail("the payload was built in the temp dir"),
+    )
+    monkeypatch.setattr(FileIndex, "racy_interval", 0)
+    monkeypatch.setattr(utils, "ZIP_RACY_INTERVAL", 0)
+
+    prepared = []
+    original_prepare = command_line.prepare_zip_entries
+
+    def counting_prepare(*args, **kwargs):
+        entries = original_prepare(*args, **kwargs)
+        prepared.append(entries)
+        return entries
+
+    monkeypatch.setattr(command_line, "prepare_zip_entries", counting_prepare)
+
+    nw_path = tmp_path / "nw"
+    nw_path.write_bytes(b"\x7fELF" + os.urandom(64 * 1024))
+    streamed = []
+
+    def fake_process_export_setting(ex_setting, output_name, app_loc):
+        assert app_loc is None
+        dest_path = str(tmp_path / ex_setting.name)
+        project_base.copy_executable(str(tmp_path), dest_path, str(nw_path), None)
+        streamed.append(dest_path)
+
+    monkeypatch.setattr(
+        project_base, "process_export_setting", fake_process_export_setting
+    )
+    for name in ["linux-x64", "windows-x64"]:
+        project_base.get_setting(name).value = True
+    project_base.make_output_dirs(write_json=False)
+
+    assert len(prepared) == 1
+    assert prepared[0].compressed == 2
+    assert len(streamed) == 2
+
+    joined_path = str(tmp_path / "Joined")
+    app_loc = project_base.get_app_nw_loc(str(tmp_path))
+    utils.join_files(joined_path, str(nw_path), app_loc)
+
+    with open(joined_path, "rb") as f:
+        joined = f.read()
+    for dest_path in streamed:
+        with open(dest_path, "rb") as f:
+            assert f.read() == joined
+
+    # The zip offsets are relative to the start of the archive
+    payload = zipfile.ZipFile(io.BytesIO(joined[len(nw_path.read_bytes()) :]))
+    assert payload.testzip() is None
+    assert sorted(payload.namelist()) == ["index.html", "js/app.js"]
+
+    # The payload store was updated once, so the next export copies every
+    # file from it
+    manifest = project_base.load_payload_manifest(project_base.payload_store_dir())
+    assert manifest["fingerprint"] == project_base.payload_fingerprint()
+
+    project_base.make_output_dirs(write_json=False)
+    assert len(prepared) == 2
+    assert (prepared[1].copied, prepared[1].compressed) == (2, 0)
+
+
+@pytest.mark.skipif(sys.platform.startswith("win"), reason="Uses a shell script")
+def test_compress_nw_runs_upx_in_parallel_and_caches(project_base, tmp_path):
+    log_path = tmp_path / "upx.log"
+    upx = tmp_path / "upx"
+    upx.write_text(
+        "#!/bin/sh\n"
+        'if [ "$1" = "--version" ]; then echo "upx 3.96"; exit 0; fi\n'
+        'echo "$3" >> "{}"\n'
+        'printf "UPX" >> "$3"\n'.format(log_path)
+    )
+    os.chmod(str(upx), 0o755)
+
+    project_base.upx_path = lambda: str(upx)
+    project_base.get_setting("nw_compression_level").value = 9
+    project_base.get_setting("download_dir").value = str(tmp_path / "downloads")
+    ex_setting = project_base.get_setting("linux-x64")
+
+    def make_runtime(name):
+        export_dest = tmp_path / name
+        (export_dest / "lib").mkdir(parents=True)
+        for index in range(6):
+            lib = export_dest / "lib" / "lib{}.so".format(index)
+            lib.write_bytes("library {}".format(index).encode())
+        return export_dest
+
+    first = make_runtime("first")
+    project_base.compress_nw(str(first / "nw"), ex_setting)
+
+    assert len(log_path.read_text().splitlines()) == 6
+    assert (first / "lib" / "lib3.so").read_bytes() == b"library 3UPX"
+
+    second = make_runtime("second")
+    project_base.compress_nw(str(second / "nw"), ex_setting)
+
+    assert len(log_path.read_text().splitlines()) == 6
+    for index in range(6):
+        name = "lib{}.so".format(index)
+        assert (second / "lib" / name).read_bytes() == (
+            first / "lib" / name
+        ).read_bytes()
+    assert not project_base.output_err
+
+
+def test_patched_exe_cached_by_runtime_and_icon(project_base, tmp_path, monkeypatch):
+    from PIL import Image
+    from pe import PEFile
+    from tests.test_pe import build_pe
+
+    project_base.get_setting("download_dir").value = str(tmp_path / "downloads")
+    project_base.get_setting("icon").value = "icon.png"
+    icon_path = os.path.join(project_base.project_dir(), "icon.png")
+    Image.new("RGBA", (64, 64), (200, 40, 40, 255)).save(icon_path)
+
+    runtime_exe = tmp_path / "runtime" / "nw.exe"
+    runtime_exe.parent.mkdir()
+    runtime_exe.write_bytes(build_pe([(32, b"\x01" * 65536)]))
+
+    patches = []
+    replace_icon = PEFile.replace_icon
+
+    def counting_replace_icon(self, *args, **kwargs):
+        patches.append(self.file_path)
+        return replace_icon(self, *args, **kwargs)
+
+    monkeypatch.setattr(PEFile, "replace_icon", counting_replace_icon)
+
+    def export(name):
+        exe_path = tmp_path / name
+        utils.materialize_file(str(runtime_exe), str(exe_path), "copy")
+        project_base.replace_icon_in_exe(str(exe_path), str(runtime_exe))
+        return exe_path.read_bytes()
+
+    first = export("first.exe")
+    assert len(patches) == 1
+    assert first != runtime_exe.read_bytes()
+
+    assert export("second.exe") == first
+    assert len(patches) == 1
+    assert runtime_exe.read_bytes() != first
+
+    Image.new("RGBA", (64, 64), (40, 40, 200, 255)).save(icon_path)
+    third = export("third.exe")
+    assert len(patches) == 2
+    assert third != first
@@ -0,0 +1,372 @@
+import struct
+
+import pytest
+from PIL import Image
+
+from pe import PEFile, ResourceTypes, GroupHeader, ICON_SIZES, align
+
+SECTION_RVA = 0x1000
+FILE_ALIGNMENT = 0x200
+TRAILER = b"app.nw payload" * 64
+
+
+def resource_directory(entries):
+    """Packs a resource directory table with (id, rva) entries"""
+    table = struct.pack("<LLHHHH", 0, 0, 0, 0, 0, len(entries))
+    for integer_id, rva in entries:
+        table += struct.pack("<LL", integer_id, rva)
+    return table
+
+
+def build_rsrc(resources):
+    """Builds a .rsrc section holding resources as {type: [data]}
+
+    Every resource gets the ids 1..n and a single language.
+    """
+    types = sorted(resources)
+    names = [(resource_type, resources[resource_type]) for resource_type in types]
+
+    root_size = 16 + 8 * len(types)
+    type_tables_size = sum(16 + 8 * len(datas) for _, datas in names)
+    language_count = sum(len(datas) for _, datas in names)
+    data_entries_offset = root_size + type_tables_size + language_count * 24
+    data_offset = data_entries_offset + language_count * 16
+
+    root = []
+    type_tables = b""
+    language_tables = b""
+    data_entries = b""
+    data = b""
+
+    type_offset = root_size
+    language_offset = root_size + type_tables_size
+    entry_offset = data_entries_offset
+
+    for resource_type, datas in names:
+        root.append((resource_type, 0x80000000 | type_offset))
+        table_entries = []
+        for number, resource in enumerate(datas, 1):
+            table_entries.append((number, 0x80000000 | language_offset))
+            language_tables += resource_directory([(1033, entry_offset)])
+            language_offset += 24
+            data_entries += struct.pack(
+                "<LLLL", SECTION_RVA + data_offset + len(data), len(resource), 0, 0
+            )
+            entry_offset += 16
+            data += resource + b"\0" * (-len(resource) % 8)
+        type_table = resource_directory(table_entries)
+        type_tables += type_table
+        type_offset += len(type_table)
+
+    return (
+        resource_directory(root) + type_tables + language_tables + data_entries + data
+    )
+
+
+def section_data(name):
+    """The raw data of a section built by build_pe"""
+    return (name * FILE_ALIGNMENT)[:FILE_ALIGNMENT]
+
+
+def build_pe(icons, resources=None, sections_after=()):
+    """Builds a minimal PE32+ file with a .rsrc section holding icons
+
+    icons is a list of (width, data) pairs, one per Icon resource.
+    resources adds other resources to the section as {type: [data]}.
+    sections_after adds a section filled with section_data(name) after
+    the .rsrc section for every (name, characteristics) pair. A .reloc
+    section is made the base relocation table.
+    """
+    group = struct.pack("<HHH", 0, 1, len(icons))
+    for number, (width, data) in enumerate(icons, 1):
+        group += struct.pack(
+            "<BBBBHHLH", width % 256, width % 256, 0, 0, 1, 32, len(data), number
+        )
+
+    resources = dict(resources or {})
+    resources[ResourceTypes.Icon] = [data for _, data in icons]
+    resources[ResourceTypes.Group_Icon] = [group]
+
+    rsrc = build_rsrc(resources)
+    rsrc += b"\0" * (-len(rsrc) % FILE_ALIGNMENT)
+
+    pe_offset = 0x40
+    optional_header_size = 240
+    number_of_sections = 1 + len(sections_after)
+    size_of_image = SECTION_RVA + align(len(rsrc), 0x1000)
+    headers = bytearray(FILE_ALIGNMENT)
+    headers[0:2] = b"MZ"
+    struct.pack_into("<L", headers, 0x3C, pe_offset)
+    struct.pack_into(
+        "<4sHHLLLHH",
+        headers,
+        pe_offset,
+        b"PE\0\0",
+        0x8664,
+        number_of_sections,
+        0,
+        0,
+        0,
+        optional_header_size,
+        0x22,
+    )
+
+    optional_offset = pe_offset + 24
+    struct.pack_into("<H", headers, optional_offset, 0x20B)
+    struct.pack_into("<LL", headers, optional_offset + 32, 0x1000, FILE_ALIGNMENT)
+    struct.pack_into(
+        "<LL",
+        headers,
+        optional_offset + 56,
+        size_of_image + 0x1000 * len(sections_after),
+        FILE_ALIGNMENT,
+    )
+    struct.pack_into("<L", headers, optional_offset + 108, 16)
+    struct.pack_into("<LL", headers, optional_offset + 128, SECTION_RVA, len(rsrc))
+
+    struct.pack_into(
+        "<8sLLLLLLHHL",
+        headers,
+        optional_offset + optional_header_size,
+        b".rsrc",
+        len(rsrc),
+        SECTION_RVA,
+        len(rsrc),
+        FILE_ALIGNMENT,
+        0,
+        0,
+        0,
+        0,
+        0x40000040,
+    )
+
+    data = bytes(headers) + rsrc
+    for number, (name, characteristics) in enumerate(sections_after, 1):
+        virtual_address = size_of_image + 0x1000 * (number - 1)
+        struct.pack_into(
+            "<8sLLLLLLHHL",
+            headers,
+            optional_offset + optional_header_size + 40 * number,
+            name,
+            FILE_ALIGNMENT,
+            virtual_address,
+            FILE_ALIGNMENT,
+            len(data),
+            0,
+            0,
+            0,
+            0,
+            characteristics,
+        )
+        if name == b".reloc":
+            struct.pack_into(
+                "<LL", headers, optional_offset + 152, virtual_address, FILE_ALIGNMENT
+            )
+        data += section_data(name)
+
+    return bytes(headers) + data[FILE_ALIGNMENT:] + TRAILER
+
+
+@pytest.fixture
+def icon_png(tmp_path):
+    path = tmp_path / "icon.png"
+    image = Image.new("RGBA", (64, 64), (200, 40, 40, 255))
+    image.save(str(path))
+    return str(path)
+
+
+def group_entries(p):
+    g_icon_dir = p.get_directory_by_type(ResourceTypes.Group_Icon)
+    entry = g_icon_dir.subdirectory_tables[0].data_entries[0]
+    header = GroupHeader.parse_from_data(
+        p.pe_file_data, absolute_offset=entry.get_data_absolute_offset()
+    )
+    return [
+        (e.Width.value, e.DataSize.value, e.IconCursorId.value) for e in header.entries
+    ]
+
+
+def icon_resources(p):
+    icon_dir = p.get_directory_by_type(ResourceTypes.Icon)
+    return {
+        icon_id: bytes(table.data_entries[0].data)
+        for (icon_id, table) in icon_dir.entries
+    }
+
+
+@pytest.mark.parametrize("slot_size", [16, 65536])
+def test_replace_icon_in_place(tmp_path, icon_png, slot_size):
+    original = build_pe([(32, b"\x01" * slot_size)])
+    rewritten = tmp_path / "rewritten.exe"
+    patched = tmp_path / "patched.exe"
+    rewritten.write_bytes(original)
+    patched.write_bytes(original)
+
+    p = PEFile(str(rewritten))
+    p.replace_icon(icon_png)
+    p.write(str(rewritten))
+
+    with PEFile(str(patched), in_place=True) as p:
+        p.replace_icon(icon_png)
+        # A section too small for the new icons makes the file grow, so
+        # it can't stay mapped
+        assert p.in_place == (slot_size == 65536)
+        p.write(str(patched))
+
+    assert patched.read_bytes() == rewritten.read_bytes()
+    assert patched.read_bytes().endswith(TRAILER)
+
+    p = PEFile(str(patched))
+    assert len(p.section_headers) == 1
+    if slot_size == 65536:
+        assert patched.stat().st_size == len(original)
+
+
+@pytest.mark.parametrize("slot_size", [16, 65536])
+def test_replace_icon_rebuilds_resources(tmp_path, icon_png, slot_size):
+    exe = tmp_path / "nw.exe"
+    version_info = b"version info" * 10
+    exe.write_bytes(
+        build_pe(
+            [(16, b"\x01" * 16), (32, b"\x02" * slot_size)],
+            {ResourceTypes.Version_Info: [version_info]},
+        )
+    )
+
+    p = PEFile(str(exe))
+    p.replace_icon(icon_png)
+    p.write(str(exe))
+
+    p = PEFile(str(exe))
+    entries = group_entries(p)
+    assert [width for width, _, _ in entries] == [size % 256 for size in ICON_SIZES]
+    assert [icon_id for _, _, icon_id in entries] == list(range(1, len(ICON_SIZES) + 1))
+
+    icons = icon_resources(p)
+    assert sorted(icons) == list(range(1, len(ICON_SIZES) + 1))
+    for _, data_size, icon_id in entries:
+        assert len(icons[icon_id]) == data_size
+        assert icons[icon_id].startswith(b"\x89PNG")
+
+    version_dir = p.get_directory_by_type(ResourceTypes.Version_Info)
+    assert bytes(version_dir.subdirectory_tables[0].data_entries[0].data) == (
+        version_info
+    )
+
+    section = p.resource_section
+    headers = p.optional_header
+    assert headers.ResourceTableAddress.value == section.VirtualAddress.value
+    assert headers.ResourceTableSize.value == section.VirtualSize.value
+    assert headers.SizeOfImage.value == align(
+        section.VirtualAddress.value + section.VirtualSize.value, 0x1000
+    )
+    assert section.SizeOfRawData.value % FILE_ALIGNMENT == 0
+    assert exe.read_bytes().endswith(TRAILER)
+
+    # The last section grows in place
+    assert p.section_headers == [section]
+    assert section.VirtualAddress.value == 0x1000
+    assert section.PointerToRawData.value == FILE_ALIGNMENT
+
+
+def test_replace_icon_moves_relocations(tmp_path, icon_png):
+    exe = tmp_path / "nw.exe"
+    exe.write_bytes(
+        build_pe(
+            [(32, b"\x01" * 16)],
+            sections_after=[(b".reloc", 0x42000040)],
+        )
+    )
+
+    p = PEFile(str(exe))
+    p.replace_icon(icon_png)
+    p.write(str(exe))
+
+    p = PEFile(str(exe))
+    section, relocations = p.section_headers
+    assert p.resource_section is section
+    assert len(group_entries(p)) == len(ICON_SIZES)
+
+    assert relocations.VirtualAddress.value == align(
+        section.VirtualAddress.value + section.VirtualSize.value, 0x1000
+    )
+    assert relocations.PointerToRawData.value == (
+        section.PointerToRawData.value + section.SizeOfRawData.value
+    )
+    headers = p.optional_header
+    assert headers.BaseRelocationTableAddress.value == relocations.VirtualAddress.value
+    assert headers.SizeOfImage.value == relocations.VirtualAddress.value + 0x1000
+
+    start = relocations.PointerToRawData.value
+    assert exe.read_bytes()[start : start + FILE_ALIGNMENT] == section_data(b".reloc")
+    assert exe.read_bytes().endswith(TRAILER)
+
+
+def test_replace_icon_appends_section_before_fixed_sections(tmp_path, icon_png):
+    exe = tmp_path / "nw.exe"
+    exe.write_bytes(
+        build_pe([(32, b"\x01" * 16)], sections_after=[(b".data", 0xC0000040)])
+    )
+
+    p = PEFile(str(exe))
+    p.replace_icon(icon_png)
+    p.write(str(exe))
+
+    p = PEFile(str(exe))
+    old_section, data_section, section = p.section_headers
+    assert p.resource_section is section
+    assert len(group_entries(p)) == len(ICON_SIZES)
+    assert section.VirtualAddress.value > data_section.VirtualAddress.value
+    assert data_section.VirtualAddress.value == 0x2000
+
+    start = data_section.PointerToRawData.value
+    assert exe.read_bytes()[start : start + FILE_ALIGNMENT] == section_data(b".data")
+    assert exe.read_bytes().endswith(TRAILER)
+
+
+def test_replace_icon_with_full_section_table(tmp_path, icon_png):
+    exe = tmp_path / "nw.exe"
+    sections_after = [(b".data", 0xC0000040), (b".pdata", 0x40000040)]
+    sections_after.append((b".tls", 0xC0000040))
+    original = build_pe([(32, b"\x01" * 16)], sections_after=sections_after)
+    exe.write_bytes(original)
+
+    p = PEFile(str(exe))
+    assert not p.has_room_for_section()
+    p.replace_icon(icon_png)
+    p.write(str(exe))
+
+    # The largest sizes are left out so the icons fit in the old section
+    p = PEFile(str(exe))
+    assert len(p.section_headers) == 4
+    entries = group_entries(p)
+    assert 0 < len(entries) < len(ICON_SIZES)
+    assert [width for width, _, _ in entries] == ICON_SIZES[: len(entries)]
+    assert exe.read_bytes()[FILE_ALIGNMENT * 2 :] == original[FILE_ALIGNMENT * 2 :]
+
+
+def test_resource_tree_parsed_lazily(tmp_path):
+    exe = tmp_path / "nw.exe"
+    exe.write_bytes(build_pe([(16, b"\x01" * 64), (32, b"\x02" * 128)]))
+
+    p = PEFile(str(exe))
+    root = p.resource_directory_table
+    assert not root.parsed
+
+    g_icon_dir = p.get_directory_by_type(ResourceTypes.Group_Icon)
+    icon_dir = root._subdirectory_tables[0]
+    assert root.parsed
+    assert icon_dir.type == ResourceTypes.Icon
+    assert [entry.name for entry in root.id_entries] == ["Icon", "Group Icon"]
+    assert not g_icon_dir.parsed
+    assert not icon_dir.parsed
+
+    assert [table.level for table in icon_dir.subdirectory_tables] == [2, 2]
+    assert icon_dir.parsed
+    assert not icon_dir._subdirectory_tables[1].parsed
+
+    data_entries = [table.data_entries[0] for table in icon_dir.subdirectory_tables]
+    assert [bytes(entry.data) for entry in data_entries] == [
+        b"\x01" * 64,
+        b"\x02" * 128,
+    ]
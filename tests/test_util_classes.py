@@ -0,0 +1,600 @@
+import os
+import sys
+import json
+import shutil
+import threading
+import functools
+
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import config
+import utils
+
+from util_classes import ArtifactStore, FileIndex, FileTree, PathMatcher
+from util_classes import PatchedExeCache
+from util_classes import RangedDownloader
+from util_classes import Inotify, TreeBrowser
+
+from PySide6.QtCore import QModelIndex
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Serves files with support for single byte ranges"""
+
+    requested_ranges = []
+
+    def log_message(self, *args):
+        pass
+
+    def send_head(self):
+        range_header = self.headers.get("Range")
+        path = self.translate_path(self.path)
+
+        if not range_header or not os.path.isfile(path):
+            return super().send_head()
+
+        size = os.path.getsize(path)
+        start, end = range_header.replace("bytes=", "").split("-")
+        start = int(start)
+        end = int(end) if end else size - 1
+        self.requested_ranges.append((start, end))
+
+        f = open(path, "rb")
+        f.seek(start)
+        self.send_response(206)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, size))
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        return _LimitedReader(f, end - start + 1)
+
+    def end_headers(self):
+        if self.command == "HEAD" or not self.headers.get("Range"):
+            self.send_header("Accept-Ranges", "bytes")
+        super().end_headers()
+
+
+class _LimitedReader(object):
+    def __init__(self, f, length):
+        self.f = f
+        self.length = length
+
+    def read(self, size=-1):
+        if self.length <= 0:
+            return b""
+        if size < 0 or size > self.length:
+            size = self.length
+        data = self.f.read(size)
+        self.length -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+def serve(directory, handler_class):
+    handler = functools.partial(handler_class, directory=str(directory))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+@pytest.fixture
+def payload(tmp_path):
+    served = tmp_path / "served"
+    served.mkdir()
+    data = os.urandom(256 * 1024 + 123)
+    (served / "nwjs.zip").write_bytes(data)
+    return served, data
+
+
+@pytest.fixture
+def range_server(payload):
+    RangeRequestHandler.requested_ranges = []
+    server = serve(payload[0], RangeRequestHandler)
+    yield "http://127.0.0.1:{}/nwjs.zip".format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def test_ranged_download_uses_several_connections(payload, range_server, tmp_path):
+    file_name = str(tmp_path / "nwjs.zip")
+    downloader = RangedDownloader(
+        range_server, file_name, connections=4, min_segment_size=32 * 1024
+    )
+
+    downloader.download()
+
+    with open(file_name, "rb") as f:
+        assert f.read() == payload[1]
+    assert len(RangeRequestHandler.requested_ranges) == 4
+    assert not os.path.exists(file_name + ".parts")
+
+
+def test_ranged_download_resumes_segments(payload, range_server, tmp_path):
+    data = payload[1]
+    file_name = str(tmp_path / "nwjs.zip")
+    half = len(data) // 2
+
+    # Simulate an interrupted download where only the first half of the
+    # first segment had been written
+    with open(file_name, "wb") as f:
+        f.write(data[: half // 2])
+        f.truncate(len(data))
+    with open(file_name + ".parts", "w") as f:
+        json.dump(
+            {
+                "url": range_server,
+                "size": len(data),
+                "segments": [[0, half - 1, half // 2], [half, len(data) - 1, 0]],
+            },
+            f,
+        )
+
+    downloader = RangedDownloader(
+        range_server, file_name, connections=2, min_segment_size=32 * 1024
+    )
+    downloader.download()
+
+    with open(file_name, "rb") as f:
+        assert f.read() == data
+    assert downloader.resumed == half // 2
+    assert (half // 2, half - 1) in RangeRequestHandler.requested_ranges
+
+
+def test_download_without_range_support(payload, tmp_path):
+    server = serve(payload[0], SimpleHTTPRequestHandler)
+    url = "http://127.0.0.1:{}/nwjs.zip".format(server.server_address[1])
+    file_name = str(tmp_path / "nwjs.zip")
+
+    progress = []
+    try:
+        downloader = RangedDownloader(
+            url,
+            file_name,
+            connections=4,
+            min_segment_size=32 * 1024,
+            progress_callback=lambda done, size: progress.append((done, size)),
+        )
+        downloader.download()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    with open(file_name, "rb") as f:
+        assert f.read() == payload[1]
+    assert progress[-1] == (len(payload[1]), len(payload[1]))
+
+
+class TruncatingRequestHandler(SimpleHTTPRequestHandler):
+    """Announces the whole file but closes the connection halfway"""
+
+    commands = []
+
+    def log_message(self, *args):
+        pass
+
+    def send_head(self):
+        self.commands.append(self.command)
+        path = self.translate_path(self.path)
+        size = os.path.getsize(path)
+
+        f = open(path, "rb")
+        self.send_response(200)
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        return _LimitedReader(f, size // 2)
+
+
+def test_download_raises_on_short_read(payload, tmp_path):
+    TruncatingRequestHandler.commands = []
+    server = serve(payload[0], TruncatingRequestHandler)
+    url = "http://127.0.0.1:{}/nwjs.zip".format(server.server_address[1])
+
+    try:
+        downloader = RangedDownloader(url, str(tmp_path / "nwjs.zip"))
+        assert downloader.probe() == (len(payload[1]), False)
+
+        with pytest.raises(IOError):
+            downloader.download()
+
+        with pytest.raises(IOError):
+            downloader.stream(lambda fileobj: fileobj.read())
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # download() used the size found by probe()
+    assert TruncatingRequestHandler.commands == ["HEAD", "GET", "GET"]
+
+
+@pytest.fixture
+def project_tree(tmp_path):
+    project = tmp_path / "project"
+    for path in [
+        "index.html",
+        "js/app.js",
+        "js/vendor/lib.min.js",
+        "node_modules/pkg/index.js",
+        "node_modules/pkg/README.md",
+        "node_modules/keep/lib/main.js",
+        ".git/objects/ab/cdef",
+        ".git/HEAD",
+    ]:
+        full_path = project / path
+        full_path.parent.mkdir(parents=True, exist_ok=True)
+        full_path.write_text(path)
+    return str(project)
+
+
+def walk_everything(tree):
+    """Match every path on its own, like the walk did before pruning"""
+    files = []
+    dirs = []
+    for root, dir_names, file_names in os.walk(tree.directory):
+        proj_path = root.replace(tree.directory, "")
+        for name in dir_names:
+            path = os.path.join(proj_path, name)
+            if not tree.determine_skip(path):
+                dirs.append(path)
+        for name in file_names:
+            path = os.path.join(proj_path, name)
+            if not tree.determine_skip(path):
+                files.append(path)
+    return sorted(files), sorted(dirs)
+
+
+@pytest.mark.parametrize(
+    "whitelist, blacklist",
+    [
+        ([], []),
+        ([], ["node_modules*", ".git*"]),
+        ([], ["node_modules"]),
+        ([], ["*/pkg/*", "*.md"]),
+        (["node_modules/keep/*"], ["node_modules*"]),
+        (["*.js"], ["node_modules*", "js*"]),
+        (["node_modules/pkg/index.js"], ["*"]),
+        (["js/v?ndor*"], ["js/*"]),
+    ],
+)
+def test_file_tree_pruning_keeps_results(project_tree, whitelist, blacklist):
+    tree = FileTree(project_tree, whitelist, blacklist)
+
+    assert (sorted(tree.files), sorted(tree.dirs)) == walk_everything(tree)
+
+
+def test_file_tree_does_not_walk_blacklisted_dirs(project_tree, monkeypatch):
+    scanned = []
+    original_scandir = os.scandir
+
+    def recording_scandir(path):
+        scanned.append(os.path.relpath(path, project_tree))
+        return original_scandir(path)
+
+    monkeypatch.setattr(os, "scandir", recording_scandir)
+
+    tree = FileTree(
+        project_tree,
+        whitelist=[os.path.join("node_modules", "keep", "*")],
+        blacklist=["node_modules*", ".git*"],
+    )
+
+    assert os.path.join("node_modules", "keep", "lib", "main.js") in tree.files
+    assert os.path.join("node_modules", "pkg", "index.js") not in tree.files
+    assert "node_modules" in scanned
+    assert os.path.join("node_modules", "pkg") not in scanned
+    assert ".git" not in scanned
+
+
+def test_path_matcher_matches_fnmatch():
+    import random
+    from fnmatch import fnmatch
+
+    patterns = [
+        "",
+        "*",
+        "*.js",
+        "*.min.js",
+        "node_modules*",
+        "node_modules",
+        "js/*",
+        "*/test/*",
+        "*.[jt]s",
+        "*.??",
+        "docs/*.md",
+        "[!.]*",
+        "a[b",
+        "*output*",
+    ]
+    paths = [
+        "index.html",
+        "app.js",
+        "js/app.min.js",
+        "js/app.ts",
+        "node_modules",
+        "node_modules/pkg/index.js",
+        "src/test/spec.js",
+        "docs/README.md",
+        ".git/HEAD",
+        "a[b",
+        "output/app.nw",
+    ]
+
+    rng = random.Random(1234)
+    for _ in range(200):
+        whitelist = rng.sample(patterns, rng.randint(0, 3))
+        blacklist = rng.sample(patterns, rng.randint(0, 4))
+        matcher = PathMatcher(whitelist, blacklist)
+
+        for path in paths:
+            path = path.replace("/", os.sep)
+            if any(fnmatch(path, pattern) for pattern in whitelist):
+                expected = PathMatcher.INCLUDE
+            elif any(fnmatch(path, pattern) for pattern in blacklist):
+                expected = PathMatcher.EXCLUDE
+            else:
+                expected = PathMatcher.UNDECIDED
+
+            assert matcher.match(path) == expected, (path, whitelist, blacklist)
+
+
+def test_file_index_rescans_changed_dirs(project_tree, tmp_path, monkeypatch):
+    monkeypatch.setattr(FileIndex, "racy_interval", 0)
+    index_dir = str(tmp_path / "file_index")
+
+    tree = FileTree(project_tree, index_dir=index_dir)
+    expected_files = sorted(tree.files)
+
+    scanned = []
+    original_scandir = os.scandir
+
+    def recording_scandir(path):
+        scanned.append(os.path.relpath(path, project_tree))
+        return original_scandir(path)
+
+    monkeypatch.setattr(os, "scandir", recording_scandir)
+
+    # A new run loads the index from disk and lists nothing
+    tree = FileTree(project_tree, index_dir=index_dir)
+    assert sorted(tree.files) == expected_files
+    assert scanned == []
+
+    new_file = os.path.join(project_tree, "js", "new.js")
+    with open(new_file, "w") as f:
+        f.write("new")
+    os.utime(os.path.dirname(new_file), ns=(0, 10**18))
+
+    tree = FileTree(project_tree, index_dir=index_dir)
+    assert os.path.join("js", "new.js") in tree.files
+    assert scanned == ["js"]
+
+
+def test_file_index_fingerprint(project_tree, monkeypatch):
+    monkeypatch.setattr(FileIndex, "racy_interval", 0)
+
+    tree = FileTree(project_tree)
+    index = tree.file_index
+    first = index.fingerprint(tree.files)
+
+    assert index.fingerprint(tree.files) == first
+    assert index.fingerprint(tree.files, content_hashes=True) != first
+
+    app_js = os.path.join(project_tree, "js", "app.js")
+    os.utime(app_js, ns=(0, 10**18))
+
+    assert index.fingerprint(tree.files) != first
+
+
+def test_artifact_store_dedupes_and_gcs(tmp_path):
+    store = ArtifactStore(str(tmp_path / "downloads"))
+
+    outputs = []
+    for name in ["first", "second"]:
+        output = tmp_path / name
+        (output / "lib").mkdir(parents=True)
+        (output / "lib" / "libnw.so").write_bytes(b"so" * 1024)
+        (output / "nw").write_bytes(b"\x7fELF" * 16)
+        (output / "app.nw").write_bytes(name.encode())
+        os.chmod(str(output / "nw"), 0o755)
+        outputs.append(output)
+
+    assert store.add_tree(str(outputs[0])) == (3, 0)
+    assert store.add_tree(str(outputs[1])) == (3, 2048 + 64)
+
+    for path in [os.path.join("lib", "libnw.so"), "nw"]:
+        first, second = [os.stat(str(output / path)) for output in outputs]
+        assert first.st_ino == second.st_ino
+        assert first.st_nlink == 3
+    assert os.stat(str(outputs[0] / "nw")).st_mode & 0o777 == 0o755
+    assert (outputs[1] / "app.nw").read_bytes() == b"second"
+    assert len(list(store.blobs())) == 4
+
+    shutil.rmtree(str(outputs[0]))
+    assert store.gc() == (1, len(b"first"))
+
+    shutil.rmtree(str(outputs[1]))
+    assert store.gc()[0] == 3
+    assert list(store.blobs()) == []
+
+
+def test_artifact_store_copies_shared_files_and_gcs_by_reference(tmp_path):
+    store = ArtifactStore(str(tmp_path / "downloads"))
+
+    runtime = tmp_path / "runtime"
+    runtime.mkdir()
+    (runtime / "nw").write_bytes(b"\x7fELF" * 16)
+
+    output = tmp_path / "output"
+    output.mkdir()
+    os.link(str(runtime / "nw"), str(output / "nw"))
+
+    assert store.add_tree(str(output)) == (1, 0)
+
+    (blob_path,) = store.blobs()
+    assert os.path.samefile(blob_path, str(output / "nw"))
+    assert not os.path.samefile(blob_path, str(runtime / "nw"))
+
+    (runtime / "nw").write_bytes(b"changed")
+    assert (output / "nw").read_bytes() == b"\x7fELF" * 16
+
+    # A link from outside of the recorded outputs doesn't keep the blob
+    os.link(blob_path, str(tmp_path / "elsewhere"))
+    assert store.gc() == (0, 0)
+
+    shutil.rmtree(str(output))
+    assert store.gc() == (1, 64)
+    assert list(store.blobs()) == []
+    assert (tmp_path / "elsewhere").read_bytes() == b"\x7fELF" * 16
+
+
+@pytest.fixture(scope="module")
+def qapp():
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PySide6 import QtWidgets
+
+    return QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+
+def child_names(model, parent=None):
+    parent = parent or QModelIndex()
+    return [model.index(row, 0, parent).data() for row in range(model.rowCount(parent))]
+
+
+def excluded_names(model, parent=None):
+    parent = parent or QModelIndex()
+    return [
+        model.index(row, 0, parent).data()
+        for row in range(model.rowCount(parent))
+        if not model.is_included(model.index(row, 0, parent))
+    ]
+
+
+def test_patched_exe_cache_prunes_and_remembers_digests(tmp_path, monkeypatch):
+    cache = PatchedExeCache(str(tmp_path / "downloads"), max_entries=2)
+
+    runtime_exe = tmp_path / "nw.exe"
+    runtime_exe.write_bytes(b"MZ" * 64)
+
+    hashed = []
+    hash_path = utils.hash_path
+    monkeypatch.setattr(
+        utils, "hash_path", lambda path: hashed.append(path) or hash_path(path)
+    )
+
+    digest = cache.digest(str(runtime_exe))
+    assert cache.digest(str(runtime_exe)) == digest
+    assert len(hashed) == 1
+
+    # Digests saved at the same time are all kept
+    runtimes = []
+    for index in range(8):
+        runtime = tmp_path / "nw{}.exe".format(index)
+        runtime.write_bytes(b"MZ" * index)
+        runtimes.append(os.path.realpath(str(runtime)))
+
+    threads = [
+        threading.Thread(target=cache.digest, args=(runtime,)) for runtime in runtimes
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert set(runtimes) < set(cache.load_digests())
+
+    exe = tmp_path / "patched.exe"
+    for index in range(3):
+        exe.write_bytes("patched {}".format(index).encode())
+        cache.put(cache.key(digest, index, "options"), str(exe))
+        os.utime(cache.entry_path(cache.key(digest, index, "options")), (index, index))
+
+    assert cache.get(cache.key(digest, 1, "options"), str(exe))
+    assert exe.read_bytes() == b"patched 1"
+
+    cache.prune()
+    assert sorted(os.path.basename(path) for path in cache.entries()) == sorted(
+        cache.key(digest, index, "options") for index in (1, 2)
+    )
+    assert not cache.get(cache.key(digest, 0, "options"), str(exe))
+
+
+def test_tree_browser_applies_changes(qapp, project_tree):
+    browser = TreeBrowser(project_tree, [], ["node_modules*", ".git*"])
+    browser.watcher.stop()
+    model = browser.model
+
+    assert child_names(model) == [".git", "index.html", "js", "node_modules"]
+    js = model.index_for_path("js")
+    model.fetchMore(js)
+
+    os.makedirs(os.path.join(project_tree, "css"))
+    with open(os.path.join(project_tree, "css", "app.css"), "w") as f:
+        f.write("body {}")
+    os.remove(os.path.join(project_tree, "index.html"))
+    os.remove(os.path.join(project_tree, "js", "app.js"))
+
+    browser.apply_changes(["", "js"])
+
+    assert child_names(model) == [".git", "css", "js", "node_modules"]
+    assert child_names(model, model.index_for_path("js")) == ["vendor"]
+    assert sorted(model.fetched) == ["", "js"]
+
+
+def test_tree_browser_fetches_dirs_on_expand(qapp, project_tree):
+    browser = TreeBrowser(project_tree, [], [])
+    browser.watcher.stop()
+    model = browser.model
+
+    node_modules = model.index_for_path("node_modules")
+    assert model.hasChildren(node_modules)
+    assert model.canFetchMore(node_modules)
+    assert model.rowCount(node_modules) == 0
+    assert sorted(model.fetched) == [""]
+    assert browser.file_tree.files == []
+
+    model.fetchMore(node_modules)
+
+    assert not model.canFetchMore(node_modules)
+    assert child_names(model, node_modules) == ["keep", "pkg"]
+    assert sorted(model.fetched) == ["", "node_modules"]
+
+
+def test_tree_browser_filter_edit_stays_in_memory(qapp, project_tree, monkeypatch):
+    browser = TreeBrowser(project_tree, [], [])
+    browser.watcher.stop()
+    model = browser.model
+
+    assert excluded_names(model) == []
+
+    with monkeypatch.context() as m:
+        m.setattr(os, "scandir", no_disk_access)
+        m.setattr(os, "stat", no_disk_access)
+
+        browser.refresh(blacklist=["node_modules*", ".git*", "js*"])
+
+    assert excluded_names(model) == [".git", "js", "node_modules"]
+    assert child_names(model) == [".git", "index.html", "js", "node_modules"]
+
+
+def no_disk_access(*args, **kwargs):
+    raise AssertionError("the filter edit touched the disk")
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="Linux only")
+def test_inotify_reports_new_entries(tmp_path):
+    inotify = Inotify()
+    try:
+        wd = inotify.add_watch(str(tmp_path), Inotify.IN_CREATE | Inotify.IN_DELETE)
+        (tmp_path / "new.js").write_text("")
+        os.remove(str(tmp_path / "new.js"))
+
+        events = inotify.read_events()
+    finally:
+        inotify.close()
+
+    assert (wd, Inotify.IN_CREATE, "new.js") in events
+    assert (wd, Inotify.IN_DELETE, "new.js") in events
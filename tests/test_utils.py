@@ -0,0 +1,340 @@
+import os
+import json
+import shutil
+
+import pytest
+
+import config
+import utils
+
+
+@pytest.fixture
+def runtime_tree(tmp_path):
+    src = tmp_path / "runtime"
+    (src / "lib").mkdir(parents=True)
+    (src / "nw").write_bytes(b"\x7fELF" + b"\0" * 128)
+    (src / "lib" / "libnw.so").write_bytes(b"so" * 256)
+    (src / "place_holder.txt").write_text("")
+    os.symlink("libnw.so", str(src / "lib" / "libnw.so.1"))
+    return src
+
+
+@pytest.mark.parametrize("mode", ["auto", "hardlink", "copy"])
+def test_materialize_tree(runtime_tree, tmp_path, mode):
+    dest = tmp_path / "output"
+
+    used_mode = utils.materialize_tree(
+        str(runtime_tree),
+        str(dest),
+        mode=mode,
+        ignore=shutil.ignore_patterns("place_holder.txt"),
+    )
+
+    assert used_mode in utils.MATERIALIZE_MODES[1:]
+    assert (dest / "nw").read_bytes() == (runtime_tree / "nw").read_bytes()
+    assert (dest / "lib" / "libnw.so").read_bytes() == b"so" * 256
+    assert os.readlink(str(dest / "lib" / "libnw.so.1")) == "libnw.so"
+    assert not (dest / "place_holder.txt").exists()
+
+    if mode == "auto":
+        assert used_mode in utils.AUTO_MATERIALIZE_MODES
+        assert os.stat(str(dest / "nw")).st_nlink == 1
+
+    if mode == "hardlink":
+        assert (
+            os.stat(str(dest / "nw")).st_ino == os.stat(str(runtime_tree / "nw")).st_ino
+        )
+    elif mode == "copy":
+        assert (
+            os.stat(str(dest / "nw")).st_ino != os.stat(str(runtime_tree / "nw")).st_ino
+        )
+
+
+def test_break_hardlink(runtime_tree, tmp_path):
+    dest = tmp_path / "output"
+    utils.materialize_tree(str(runtime_tree), str(dest), mode="hardlink")
+
+    utils.break_hardlink(str(dest / "nw"))
+
+    assert os.stat(str(dest / "nw")).st_nlink == 1
+    with open(str(dest / "nw"), "r+b") as f:
+        f.write(b"MZ")
+
+    assert (runtime_tree / "nw").read_bytes().startswith(b"\x7fELF")
+    assert (dest / "nw").read_bytes()[2:] == (runtime_tree / "nw").read_bytes()[2:]
+
+
+def test_extract_zip(tmp_path):
+    import stat
+    import zipfile
+
+    zip_path = str(tmp_path / "nwjs.zip")
+    framework = "nwjs.app/Contents/Frameworks/nwjs Framework.framework/"
+
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as archive:
+        info = zipfile.ZipInfo(framework)
+        info.external_attr = (stat.S_IFDIR | 0o755) << 16
+        archive.writestr(info, b"")
+
+        info = zipfile.ZipInfo(framework + "Versions/A/nwjs Framework")
+        info.external_attr = (stat.S_IFREG | 0o755) << 16
+        archive.writestr(info, b"\xcf\xfa\xed\xfe" * 4096)
+
+        info = zipfile.ZipInfo(framework + "nwjs Framework")
+        info.external_attr = (stat.S_IFLNK | 0o777) << 16
+        archive.writestr(info, b"Versions/A/nwjs Framework")
+
+        for index in range(50):
+            archive.writestr("nwjs.app/locales/{}.pak".format(index), b"pak" * index)
+
+        archive.writestr("../outside.txt", b"nope")
+
+    dest = tmp_path / "runtime"
+    num_bytes, seconds = utils.extract_zip(zip_path, str(dest), workers=4)
+
+    binary = dest / framework / "Versions" / "A" / "nwjs Framework"
+    link = dest / framework / "nwjs Framework"
+
+    assert binary.read_bytes() == b"\xcf\xfa\xed\xfe" * 4096
+    assert os.stat(str(binary)).st_mode & 0o777 == 0o755
+    assert os.readlink(str(link)) == "Versions/A/nwjs Framework"
+    assert link.read_bytes() == binary.read_bytes()
+    assert len(os.listdir(str(dest / "nwjs.app" / "locales"))) == 50
+    assert (dest / "outside.txt").exists()
+    assert not (tmp_path / "outside.txt").exists()
+    assert num_bytes == 4 * 4096 + sum(3 * index for index in range(50)) + 4
+    assert seconds >= 0
+
+
+@pytest.mark.parametrize("compression", ["stored", "deflated"])
+def test_zip_files_reuses_unchanged_entries(tmp_path, monkeypatch, compression):
+    import zipfile
+
+    monkeypatch.setattr(utils, "ZIP_RACY_INTERVAL", 0)
+    monkeypatch.setattr(
+        config, "ZIP_MODE", getattr(zipfile, "ZIP_" + compression.upper())
+    )
+
+    project = tmp_path / "project"
+    (project / "js").mkdir(parents=True)
+    files = {
+        "index.html": b"<html></html>" * 100,
+        os.path.join("js", "app.js"): b"console.log('app');" * 100,
+        os.path.join("js", "lib.js"): b"var lib = {};" * 100,
+    }
+    for name, data in files.items():
+        (project / name).write_bytes(data)
+
+    first = str(tmp_path / "first.nw")
+    assert utils.zip_files(first, str(project), *files) == (0, 3)
+
+    files[os.path.join("js", "app.js")] = b"console.log('changed');"
+    app_js = project / "js" / "app.js"
+    app_js.write_bytes(files[os.path.join("js", "app.js")])
+    os.utime(str(app_js), ns=(0, 10**18))
+
+    second = str(tmp_path / "second.nw")
+    assert utils.zip_files(second, str(project), *files, previous=first) == (2, 1)
+
+    with zipfile.ZipFile(second) as archive:
+        assert archive.testzip() is None
+        for name, data in files.items():
+            assert archive.read(name.replace(os.sep, "/")) == data
+
+    manifest = utils.load_zip_manifest(second)
+    assert sorted(manifest["files"]) == ["index.html", "js/app.js", "js/lib.js"]
+
+
+def test_zip_files_deflates_in_parallel(tmp_path):
+    import zipfile
+
+    project = tmp_path / "project"
+    (project / "img").mkdir(parents=True)
+    files = {
+        "file{}.js".format(index): ("var x{} = {};".format(index, index) * 500).encode()
+        for index in range(20)
+    }
+    files[os.path.join("img", "logo.png")] = os.urandom(4096)
+    for name, data in files.items():
+        (project / name).write_bytes(data)
+
+    app_nw = str(tmp_path / "app.nw")
+    assert utils.zip_files(
+        app_nw, str(project), *files, compresslevel=6, workers=4
+    ) == (0, 21)
+
+    with zipfile.ZipFile(app_nw) as archive:
+        assert archive.testzip() is None
+        assert [info.filename for info in archive.infolist()] == [
+            name.replace(os.sep, "/") for name in files
+        ]
+        for name, data in files.items():
+            info = archive.getinfo(name.replace(os.sep, "/"))
+            assert archive.read(info) == data
+            if name.endswith(".png"):
+                assert info.compress_type == zipfile.ZIP_STORED
+            else:
+                assert info.compress_type == zipfile.ZIP_DEFLATED
+                assert info.compress_size < info.file_size
+
+    # A rebuild at the same level copies every entry
+    rebuilt = str(tmp_path / "rebuilt.nw")
+    manifest = utils.load_zip_manifest(app_nw)
+    manifest["written"] += 10**12
+    with open(utils.zip_manifest_path(app_nw), "w") as f:
+        json.dump(manifest, f)
+
+    assert utils.zip_files(
+        rebuilt, str(project), *files, previous=app_nw, compresslevel=6
+    ) == (21, 0)
+    with open(app_nw, "rb") as a, open(rebuilt, "rb") as b:
+        assert a.read() == b.read()
+
+
+def test_write_raw_zip_entry_round_trips(tmp_path):
+    import zlib
+    import zipfile
+
+    deflated = b"console.log('app');" * 1000
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated_data = compressor.compress(deflated) + compressor.flush()
+    stored = os.urandom(4096)
+
+    archive_path = str(tmp_path / "app.nw")
+    with zipfile.ZipFile(archive_path, "w") as archive:
+        archive.writestr("index.html", b"<html></html>")
+
+        for name, data, compress_type, raw in [
+            ("js/app.js", deflated, zipfile.ZIP_DEFLATED, deflated_data),
+            ("img/logo.png", stored, zipfile.ZIP_STORED, stored),
+        ]:
+            zinfo = zipfile.ZipInfo(name, (2020, 1, 2, 3, 4, 6))
+            zinfo.compress_type = compress_type
+            zinfo.CRC = zlib.crc32(data)
+            zinfo.file_size = len(data)
+            zinfo.compress_size = len(raw)
+            utils.write_raw_zip_entry(archive, zinfo, [raw[:100], raw[100:]])
+
+        # Entries written by zipfile after the raw ones land after them
+        archive.writestr("package.json", b"{}")
+
+    with zipfile.ZipFile(archive_path) as archive:
+        assert archive.testzip() is None
+        assert archive.namelist() == [
+            "index.html",
+            "js/app.js",
+            "img/logo.png",
+            "package.json",
+        ]
+        assert archive.read("js/app.js") == deflated
+        assert archive.read("img/logo.png") == stored
+        assert archive.read("package.json") == b"{}"
+        assert archive.getinfo("js/app.js").date_time == (2020, 1, 2, 3, 4, 6)
+
+        # Copying the raw entries into another archive keeps them intact
+        copy_path = str(tmp_path / "copy.nw")
+        with open(archive_path, "rb") as f, zipfile.ZipFile(copy_path, "w") as copy:
+            for zinfo in archive.infolist():
+                utils.copy_zip_entry(f, zinfo, copy)
+
+    with zipfile.ZipFile(copy_path) as copy:
+        assert copy.testzip() is None
+        assert copy.read("js/app.js") == deflated
+
+
+@pytest.mark.parametrize("compresslevel", [None, 0, 6])
+def test_prepared_zip_entries_match_zip_files(tmp_path, monkeypatch, compresslevel):
+    import zipfile
+
+    monkeypatch.setattr(utils, "ZIP_RACY_INTERVAL", 0)
+
+    project = tmp_path / "project"
+    (project / "img").mkdir(parents=True)
+    files = {
+        "index.html": b"<html></html>" * 100,
+        "app.js": b"console.log('app');" * 100,
+        os.path.join("img", "logo.png"): os.urandom(4096),
+    }
+    for name, data in files.items():
+        (project / name).write_bytes(data)
+    names = ["img"] + list(files)
+
+    previous = str(tmp_path / "previous.nw")
+    utils.zip_files(previous, str(project), *names, compresslevel=compresslevel)
+
+    app_js = project / "app.js"
+    app_js.write_bytes(b"console.log('changed');")
+    os.utime(str(app_js), ns=(0, 10**18))
+
+    expected = str(tmp_path / "expected.nw")
+    utils.zip_files(
+        expected, str(project), *names, previous=previous, compresslevel=compresslevel
+    )
+
+    entries = utils.prepare_zip_entries(
+        str(project), *names, previous=previous, compresslevel=compresslevel
+    )
+    assert (entries.copied, entries.compressed) == (2, 1)
+
+    exe = tmp_path / "nw"
+    exe.write_bytes(b"\x7fELF" * 1024)
+    for name in ["first", "second"]:
+        dest = str(tmp_path / name)
+        utils.write_zip_entries(dest, entries, prefix=str(exe), manifest=False)
+
+        with open(dest, "rb") as f, open(expected, "rb") as e:
+            data = f.read()
+            assert data == exe.read_bytes() + e.read()
+
+    utils.write_zip_entries(str(tmp_path / "stored.nw"), entries)
+    with zipfile.ZipFile(str(tmp_path / "stored.nw")) as archive:
+        assert archive.testzip() is None
+    assert (
+        utils.load_zip_manifest(str(tmp_path / "stored.nw"))["files"]
+        == utils.load_zip_manifest(expected)["files"]
+    )
+
+
+@pytest.mark.parametrize("method", utils.JOIN_METHODS)
+def test_join_files(tmp_path, method):
+    exe = tmp_path / "nw.exe"
+    payload = tmp_path / "app.nw"
+    exe.write_bytes(b"MZ" + os.urandom(3 * 1024 * 1024 + 17))
+    payload.write_bytes(b"PK" + os.urandom(123457))
+
+    dest = str(tmp_path / "app.exe")
+    used = utils.join_files(
+        dest, str(exe), str(tmp_path / "missing"), str(payload), methods=[method]
+    )
+
+    assert used in utils.JOIN_METHODS
+    with open(dest, "rb") as f:
+        assert f.read() == exe.read_bytes() + payload.read_bytes()
+
+
+def test_file_lock(tmp_path):
+    path = str(tmp_path / "locks" / "runtime.lock")
+
+    with utils.FileLock(path):
+        other = utils.FileLock(path)
+        assert not other.acquire(blocking=False)
+        assert not utils.FileLock(path, shared=True).acquire(blocking=False)
+
+    assert other.acquire(blocking=False)
+    other.release()
+
+    with utils.FileLock(path, shared=True):
+        if utils.fcntl is not None:
+            shared = utils.FileLock(path, shared=True)
+            assert shared.acquire(blocking=False)
+            shared.release()
+        assert not utils.FileLock(path).acquire(blocking=False)
+
+
+def test_split_patterns():
+    assert utils.split_patterns("node_modules*\n*.git*, *.psd") == [
+        "node_modules*",
+        "*.git*",
+        "*.psd",
+    ]
+    assert utils.split_patterns("") == []
@@ -1,12 +1,27 @@
 """Utility classes that are used both in the GUI and the CMD."""
 
 import os
+import io
+import sys
+import stat
+import errno
+import struct
+import ctypes
+import ctypes.util
+import hashlib
+import bisect
 import re
 from fnmatch import fnmatch
+from fnmatch import translate as fnmatch_translate
 import zipfile
 import tarfile
 import time
+import json
+import codecs
+import shutil
+import threading
 import logging
+from concurrent import futures
 from pprint import pformat
 
 import config
@@ -17,28 +32,403 @@ from PySide6 import QtWidgets
 from PySide6.QtCore import Qt
 
 
-class FileItem(QtWidgets.QTreeWidgetItem):
-    def __init__(self, parent=None, path=None):
-        super(FileItem, self).__init__(parent)
-        self.path = path
+class PatternSet(object):
+    """
+    A list of glob patterns compiled once to match many paths quickly.
+
+    Matching is identical to calling fnmatch with every pattern. Literal
+    patterns are looked up in a set, patterns that are only a literal
+    prefix or suffix around a single * use str.startswith/endswith, and
+    everything else is combined into one regular expression.
+    """
+
+    magic = re.compile(r"[*?[]")
+
+    def __init__(self, patterns):
+        self.literals = set()
+        prefixes = []
+        suffixes = []
+        globs = []
+
+        for pattern in patterns:
+            if not pattern:
+                continue
+
+            pattern = os.path.normcase(pattern)
+
+            if not self.magic.search(pattern):
+                self.literals.add(pattern)
+            elif pattern.startswith("*") and not self.magic.search(pattern[1:]):
+                suffixes.append(pattern[1:])
+            elif pattern.endswith("*") and not self.magic.search(pattern[:-1]):
+                prefixes.append(pattern[:-1])
+            else:
+                globs.append(fnmatch_translate(pattern))
+
+        self.prefixes = tuple(prefixes)
+        self.suffixes = tuple(suffixes)
+        self.regex = re.compile("|".join(globs)).match if globs else None
+        self.empty = not (self.literals or prefixes or suffixes or globs)
+
+    def matches(self, path):
+        if self.empty:
+            return False
+
+        path = os.path.normcase(path)
+        return (
+            path in self.literals
+            or path.startswith(self.prefixes)
+            or path.endswith(self.suffixes)
+            or (self.regex is not None and self.regex(path) is not None)
+        )
+
+
+class PathMatcher(object):
+    """
+    Decides whether paths are included by a whitelist and blacklist.
+
+    A path matching the whitelist is always included, a path matching only
+    the blacklist is excluded and any other path is undecided.
+    """
+
+    INCLUDE = "include"
+    EXCLUDE = "exclude"
+    UNDECIDED = "undecided"
+
+    def __init__(self, whitelist=None, blacklist=None):
+        self.whitelist = PatternSet(whitelist or [])
+        self.blacklist = PatternSet(blacklist or [])
+
+    def match(self, path):
+        if self.whitelist.matches(path):
+            return self.INCLUDE
+        if self.blacklist.matches(path):
+            return self.EXCLUDE
+        return self.UNDECIDED
+
+
+class FileIndex(object):
+    """
+    Persistent index of the files in a project directory.
+
+    The index stores the listing of every directory along with the size,
+    mtime and inode of its files, and is saved as json between runs. A
+    walk only lists the directories whose mtime changed since they were
+    indexed, every other directory is served from the index.
+
+    Directories and files that were modified less than racy_interval
+    seconds before they were indexed are always checked again, because a
+    second change within the same mtime tick would go unnoticed.
+    """
+
+    format_version = 1
+    racy_interval = 2.0
+
+    def __init__(self, directory, index_path=None):
+        self.directory = directory
+        self.index_path = index_path
+        self.entries = {}
+        self.hashes = {}
+        self.changed = False
+        self.logger = config.getLogger(__name__)
+
+        self.load()
+
+    @staticmethod
+    def default_path(index_dir, directory):
+        """Get the index file for directory inside index_dir"""
+        name = hashlib.sha1(
+            os.path.normcase(os.path.abspath(directory)).encode("utf-8")
+        ).hexdigest()
+        return utils.path_join(index_dir, name + ".json")
+
+    def load(self):
+        if not self.index_path:
+            return
+
+        try:
+            with codecs.open(self.index_path, encoding="utf-8") as f:
+                index = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+
+        if (
+            index.get("version") == self.format_version
+            and index.get("directory") == self.directory
+        ):
+            self.entries = index.get("entries", {})
+            self.hashes = index.get("hashes", {})
+
+    def save(self):
+        if not self.index_path or not self.changed:
+            return
+
+        self.remove_stale_entries()
+
+        index = {
+            "version": self.format_version,
+            "directory": self.directory,
+            "entries": self.entries,
+            "hashes": self.hashes,
+        }
+
+        tmp_path = "{}.{}.tmp".format(self.index_path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            with codecs.open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(index, f, separators=(",", ":"))
+            os.replace(tmp_path, self.index_path)
+        except (IOError, OSError) as e:
+            # The index only saves time, so an export never fails over it
+            self.logger.warning("Could not save the file index: {}".format(e))
+            return
+
+        self.changed = False
+
+    def is_racy(self, mtime_ns, indexed_ns):
+        return indexed_ns - mtime_ns < self.racy_interval * 1e9
+
+    def list_dir(self, root, dir_stat):
+        """Index the entries of the directory root"""
+        entry = {
+            "mtime": dir_stat.st_mtime_ns,
+            "indexed": time.time_ns(),
+            "dirs": [],
+            "links": [],
+            "files": {},
+        }
+
+        with os.scandir(root) as dir_entries:
+            for dir_entry in dir_entries:
+                try:
+                    is_dir = dir_entry.is_dir()
+                except OSError:
+                    is_dir = False
+
+                if is_dir:
+                    entry["dirs"].append(dir_entry.name)
+                    if dir_entry.is_symlink():
+                        entry["links"].append(dir_entry.name)
+                    continue
+
+                try:
+                    st = dir_entry.stat()
+                except OSError:
+                    st = dir_entry.stat(follow_symlinks=False)
+
+                entry["files"][dir_entry.name] = [
+                    st.st_size,
+                    st.st_mtime_ns,
+                    st.st_ino,
+                ]
+
+        return entry
+
+    def walk(self, prune=None, start="", check=True):
+        """
+        Walk the directory top down like os.walk, listing only the
+        directories that changed since they were indexed.
+
+        Symlinked directories and directories that prune returns True for
+        are not descended into. prune is called with the path of each
+        directory relative to the project. The index is saved once the
+        walk completes.
+
+        Args:
+            prune: decides which directories not to descend into
+            start: the project relative directory to start walking from
+            check: if False, directories that are already indexed are
+                   trusted without checking their mtime
+        """
+        stack = [start]
+
+        while stack:
+            rel_path = stack.pop()
+            root = os.path.join(self.directory, rel_path)
+
+            try:
+                entry = self.listing(rel_path, check)
+            except OSError:
+                continue
+
+            yield root, list(entry["dirs"]), list(entry["files"])
+
+            descend = []
+            for name in entry["dirs"]:
+                path = os.path.join(rel_path, name)
+                if name in entry["links"]:
+                    continue
+                if prune is not None and prune(path):
+                    continue
+                descend.append(path)
+
+            stack.extend(reversed(descend))
+
+        self.save()
+
+    def listing(self, rel_path, check=True):
+        """
+        Get the index entry of the directory rel_path, listing it if it is
+        not indexed yet or, when check is True, if it changed.
+
+        Raises:
+            OSError if the directory can not be listed
+        """
+        entry = self.entries.get(rel_path)
+
+        if entry is None or check:
+            dir_stat = os.stat(os.path.join(self.directory, rel_path))
+
+            if (
+                entry is None
+                or entry["mtime"] != dir_stat.st_mtime_ns
+                or self.is_racy(entry["mtime"], entry["indexed"])
+            ):
+                entry = self.list_dir(os.path.join(self.directory, rel_path), dir_stat)
+                self.entries[rel_path] = entry
+                self.changed = True
+
+        return entry
+
+    def rescan(self, rel_path):
+        """
+        List the directory rel_path again after it changed.
+
+        Returns:
+            A tuple of the project relative paths that were added and
+            removed, or None if the directory no longer exists
+        """
+        old_entry = self.entries.get(rel_path)
+        root = os.path.join(self.directory, rel_path)
+
+        try:
+            entry = self.list_dir(root, os.stat(root))
+        except OSError:
+            entry = None
+
+        self.changed = True
+
+        if entry is None:
+            self.entries.pop(rel_path, None)
+            return None
+
+        self.entries[rel_path] = entry
+
+        old_names = set()
+        if old_entry is not None:
+            old_names = set(old_entry["dirs"]) | set(old_entry["files"])
+        new_names = set(entry["dirs"]) | set(entry["files"])
+
+        added = [os.path.join(rel_path, name) for name in sorted(new_names - old_names)]
+        removed = [
+            os.path.join(rel_path, name) for name in sorted(old_names - new_names)
+        ]
+
+        return added, removed
+
+    def is_dir(self, rel_path):
+        """Check if the index lists rel_path as a directory"""
+        parent, name = os.path.split(rel_path)
+        return name in self.entries.get(parent, {}).get("dirs", ())
+
+    def remove_stale_entries(self):
+        """Forget directories that are no longer listed by their parent"""
+        for rel_path in sorted(self.entries, key=len):
+            if not rel_path or rel_path not in self.entries:
+                continue
+
+            parent, name = os.path.split(rel_path)
+            parent_entry = self.entries.get(parent)
+
+            if parent_entry is None or name not in parent_entry["dirs"]:
+                prefix = rel_path + os.sep
+                for path in list(self.entries):
+                    if path == rel_path or path.startswith(prefix):
+                        del self.entries[path]
+
+        for path in list(self.hashes):
+            parent, name = os.path.split(path)
+            if name not in self.entries.get(parent, {}).get("files", {}):
+                del self.hashes[path]
+
+    def file_hash(self, path, file_stat):
+        """Get the content hash of path, reusing it while the file is unchanged"""
+        stat_key = [file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino]
+        cached = self.hashes.get(path)
+
+        if cached is not None and cached[:3] == stat_key:
+            return cached[3]
+
+        digest = utils.hash_path(os.path.join(self.directory, path))
+
+        if not self.is_racy(file_stat.st_mtime_ns, time.time_ns()):
+            self.hashes[path] = stat_key + [digest]
+            self.changed = True
+
+        return digest
+
+    def fingerprint(self, paths, content_hashes=False):
+        """
+        Get a digest that changes whenever any of the files in paths does.
+
+        Files are compared by their size, mtime and inode. Files modified
+        too recently to be trusted are hashed, and so is every file when
+        content_hashes is True. The file stats in the index are updated
+        along the way.
+
+        Args:
+            paths: file paths relative to the project directory
+
+        Returns:
+            A hex digest of the files
+        """
+        digest = hashlib.sha256()
+        now = time.time_ns()
+
+        for path in sorted(paths):
+            file_stat = os.stat(os.path.join(self.directory, path))
+            stat_key = [file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino]
+
+            parent, name = os.path.split(path)
+            files = self.entries.get(parent, {}).get("files")
+            if files is not None and files.get(name) != stat_key:
+                files[name] = stat_key
+                self.changed = True
+
+            digest.update(path.encode("utf-8") + b"\0")
+
+            if content_hashes or self.is_racy(file_stat.st_mtime_ns, now):
+                digest.update(self.file_hash(path, file_stat).encode("utf-8"))
+            else:
+                digest.update("{}:{}:{}".format(*stat_key).encode("utf-8"))
+
+        self.save()
+
+        return digest.hexdigest()
 
 
 class FileTree(object):
-    def __init__(self, directory=None, whitelist=None, blacklist=None):
+    def __init__(self, directory=None, whitelist=None, blacklist=None, index_dir=None):
         self.whitelist = None
         self.blacklist = None
 
         self.paths = []
-        self.walkcache = {}
-        self.cache = True
-        self.time = time.time()
+        self.index_dir = index_dir
+        self.file_index = None
 
         self.files = []
         self.dirs = []
 
         self.init(directory, whitelist, blacklist)
 
-    def init(self, directory=None, whitelist=None, blacklist=None):
+    def init(self, directory=None, whitelist=None, blacklist=None, generate=True):
+        """
+        Set the project directory and filters.
+
+        Args:
+            generate: if False, only set the filters and leave the file
+                      lists empty instead of walking the whole project
+        """
         self.logger = config.getLogger(__name__)
 
         if directory:
@@ -46,7 +436,11 @@ class FileTree(object):
         else:
             self.directory = directory
 
-        self.refresh(whitelist, blacklist)
+        if generate:
+            self.refresh(whitelist, blacklist)
+        else:
+            self.set_filters(whitelist, blacklist)
+            self.clear()
 
     def clear(self):
         self.files = []
@@ -59,41 +453,92 @@ class FileTree(object):
 
         self.generate_files()
 
-    def walk(self, directory):
-        refresh = False
+    def walk(self, directory, prune=None, start="", check=True):
+        """
+        Walk directory like os.walk through the file index, so that only
+        the directories that changed since the last walk are listed.
+
+        Args:
+            directory: the directory to walk
+            prune: a function called with the project relative path of
+                   every directory, returning True if the walk should not
+                   descend into it
+            start: the project relative directory to start walking from
+            check: if False, trust the index without touching the disk
+                   for directories that are already indexed
+        """
+        return self.load_index(directory).walk(prune, start, check)
+
+    def load_index(self, directory):
+        """Get the file index of directory, loading it if needed"""
+        if self.file_index is None or self.file_index.directory != directory:
+            index_path = None
+            if self.index_dir:
+                index_path = FileIndex.default_path(self.index_dir, directory)
+            self.file_index = FileIndex(directory, index_path)
+
+        return self.file_index
+
+    def can_prune(self, path):
+        """
+        Check if nothing below the directory path can be included, so that
+        walking into it can be skipped.
+
+        Every path is matched on its own, so this is only the case when a
+        blacklist pattern ending in * matches everything below path and no
+        whitelist pattern could match anything below it.
+        """
+        prefix = os.path.normcase(path + os.sep)
+
+        blacklisted = any(
+            pattern.endswith("*") and fnmatch(prefix, pattern)
+            for pattern in self.blacklist
+        )
 
-        if (time.time() - self.time) > 10:
-            refresh = True
-            self.time = time.time()
+        if not blacklisted:
+            return False
 
-        if not self.walkcache.get(directory) or refresh:
-            self.walkcache[directory] = []
-            return os.walk(directory)
+        for pattern in self.whitelist:
+            if not pattern:
+                continue
 
-        return self.walkcache[directory]
+            literal = os.path.normcase(re.split(r"[*?[]", pattern, 1)[0])
+
+            if len(literal) == len(pattern):
+                if literal.startswith(prefix):
+                    return False
+            elif literal.startswith(prefix) or prefix.startswith(literal):
+                return False
+
+        return True
 
     def determine_skip(self, path, *args, **kwargs):
         skip = False
 
-        for blacklist in self.blacklist:
-            match = fnmatch(path, blacklist)
-            if match:
-                skip = True
-                self.on_blacklist_match(path, *args, **kwargs)
-                break
+        if self.matcher.blacklist.matches(path):
+            skip = True
+            self.on_blacklist_match(path, *args, **kwargs)
 
-        for whitelist in self.whitelist:
-            match = fnmatch(path, whitelist)
-            if match:
-                skip = False
-                self.on_whitelist_match(path, *args, **kwargs)
-                break
+        if self.matcher.whitelist.matches(path):
+            skip = False
+            self.on_whitelist_match(path, *args, **kwargs)
 
         return skip
 
+    def match(self, path):
+        """Get whether path is included, excluded or undecided by the filters"""
+        return self.matcher.match(path)
+
     def set_filters(self, whitelist=None, blacklist=None):
-        self.whitelist = whitelist or self.whitelist or []
-        self.blacklist = blacklist or self.blacklist or []
+        if whitelist is not None:
+            self.whitelist = whitelist
+        if blacklist is not None:
+            self.blacklist = blacklist
+
+        self.whitelist = self.whitelist or []
+        self.blacklist = self.blacklist or []
+
+        self.matcher = PathMatcher(self.whitelist, self.blacklist)
 
     def on_whitelist_match(self, path, *args, **kwargs):
         pass
@@ -101,18 +546,6 @@ class FileTree(object):
     def on_blacklist_match(self, path, *args, **kwargs):
         pass
 
-    def init_cache(self):
-        if self.walkcache.get(self.directory) is None:
-            self.walkcache[self.directory] = []
-
-        self.cache = False
-        if not self.walkcache[self.directory]:
-            self.cache = True
-
-    def add_to_cache(self, *args):
-        if self.cache:
-            self.walkcache[self.directory].append(args)
-
     def is_in_skipped(self, skipped, path):
         temp = path
 
@@ -135,26 +568,27 @@ class FileTree(object):
         self.logger.debug(pformat(self.whitelist))
         self.logger.debug("")
 
-        self.init_cache()
-
         skipped_files = set()
 
-        for root, dirs, files in self.walk(self.directory):
-            self.add_to_cache(root, dirs, files)
+        # Tracking the skipped paths only serves the debug log
+        log_skipped = self.logger.isEnabledFor(logging.DEBUG)
 
+        walk = self.walk(self.directory, prune=self.can_prune)
+
+        for root, dirs, files in walk:
             proj_path = root.replace(self.directory, "")
 
             for directory in dirs:
                 path = os.path.join(proj_path, directory)
 
                 if self.determine_skip(path):
-                    if not self.is_in_skipped(skipped_files, path):
-                        self.logger.debug("Skipping dir: %s", path)
-                    skipped_files.add(path)
+                    if log_skipped:
+                        if not self.is_in_skipped(skipped_files, path):
+                            self.logger.debug("Skipping dir: %s", path)
+                        skipped_files.add(path)
                     continue
-                else:
-                    if self.is_in_skipped(skipped_files, path):
-                        self.logger.debug("Keeping dir: %s", path)
+                elif log_skipped and self.is_in_skipped(skipped_files, path):
+                    self.logger.debug("Keeping dir: %s", path)
 
                 self.dirs.append(path)
 
@@ -162,137 +596,590 @@ class FileTree(object):
                 path = os.path.join(proj_path, file)
 
                 if self.determine_skip(path):
-                    if not self.is_in_skipped(skipped_files, path):
-                        self.logger.debug("Skipping file: %s", path)
-                    skipped_files.add(path)
+                    if log_skipped:
+                        if not self.is_in_skipped(skipped_files, path):
+                            self.logger.debug("Skipping file: %s", path)
+                        skipped_files.add(path)
                     continue
-                else:
-                    if self.is_in_skipped(skipped_files, path):
-                        self.logger.debug("Keeping file: %s", path)
+                elif log_skipped and self.is_in_skipped(skipped_files, path):
+                    self.logger.debug("Keeping file: %s", path)
 
                 self.files.append(path)
 
 
-class TreeBrowser(QtWidgets.QWidget):
-    def __init__(self, directory=None, whitelist=None, blacklist=None, parent=None):
-        QtWidgets.QWidget.__init__(self, parent=parent)
-        self.root = QtWidgets.QTreeWidget()
-        self.root.header().setSectionResizeMode(QtWidgets.QHeaderView.ResizeToContents)
-        self.root.header().setStretchLastSection(False)
-        self.root.setHeaderLabel("Included files")
+class Inotify(object):
+    """Minimal ctypes binding of the Linux inotify API"""
 
-        self.parent_map = {}
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
 
-        layout = QtWidgets.QVBoxLayout()
-        layout.setContentsMargins(0, 0, 0, 0)
-        layout.addWidget(self.root)
-        self.setLayout(layout)
+    event_header = struct.Struct("iIII")
 
-        self.file_tree = FileTree(directory, whitelist, blacklist)
-        self.init(directory, whitelist, blacklist)
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
 
-    def clear(self):
-        self.root.clear()
-        self.file_tree.clear()
+        self.libc = ctypes.CDLL(
+            ctypes.util.find_library("c") or "libc.so.6", use_errno=True
+        )
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """Read the pending events as a list of (wd, mask, name)"""
+        events = []
+
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
 
-    def init(self, directory=None, whitelist=None, blacklist=None):
-        self.file_tree.init(directory, whitelist, blacklist)
+            if not data:
+                break
 
-        self.refresh(whitelist, blacklist)
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = self.event_header.unpack_from(data, offset)
+                offset += self.event_header.size
+                name = data[offset : offset + length].rstrip(b"\0")
+                offset += length
+                events.append((wd, mask, os.fsdecode(name)))
+
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class FileWatcher(QtCore.QObject):
+    """
+    Watches the directories of a project for entries being added or
+    removed.
+
+    inotify is used on Linux. Elsewhere, or when inotify runs out of
+    watches, the mtime of every watched directory is polled instead.
+    Changes are collected for debounce_interval milliseconds and then
+    reported together through the changed signal as a list of project
+    relative directories.
+    """
+
+    changed = QtCore.Signal(list)
+
+    poll_interval = 2000
+    debounce_interval = 100
+
+    watch_mask = (
+        Inotify.IN_CREATE
+        | Inotify.IN_DELETE
+        | Inotify.IN_MOVED_FROM
+        | Inotify.IN_MOVED_TO
+        | Inotify.IN_DELETE_SELF
+        | Inotify.IN_MOVE_SELF
+        | Inotify.IN_ONLYDIR
+    )
+
+    def __init__(self, parent=None):
+        super(FileWatcher, self).__init__(parent)
+        self.logger = config.getLogger(__name__)
 
-    def refresh(self, whitelist=None, blacklist=None):
-        self.file_tree.set_filters(whitelist, blacklist)
-        self.clear()
-        self.generate_files()
+        self.directory = None
+        self.inotify = None
+        self.notifier = None
+        self.watches = {}
+        self.paths = {}
+        self.pending = set()
+
+        self.debounce_timer = QtCore.QTimer(self)
+        self.debounce_timer.setSingleShot(True)
+        self.debounce_timer.timeout.connect(self.flush)
+
+        self.poll_timer = QtCore.QTimer(self)
+        self.poll_timer.timeout.connect(self.poll)
+
+    def start(self, directory):
+        self.stop()
+        self.directory = directory
+
+        try:
+            self.inotify = Inotify()
+        except (OSError, AttributeError) as e:
+            self.logger.info("Watching files by polling: {}".format(e))
+            self.poll_timer.start(self.poll_interval)
+            return
 
-    def fix_tree(self, path, parent):
-        temp = parent
-        tree = []
-        root = None
-        base, direc = os.path.split(path)
-        new_path = os.path.join(base, direc)
-
-        while new_path and root is None:
-            temp = self.parent_map.get(os.path.join(base, direc))
-            if temp is not None:
-                root = temp
-                break
+        self.notifier = QtCore.QSocketNotifier(
+            self.inotify.fd, QtCore.QSocketNotifier.Type.Read, self
+        )
+        self.notifier.activated.connect(self.read_events)
+
+    def stop(self):
+        self.poll_timer.stop()
+        self.debounce_timer.stop()
+
+        if self.notifier is not None:
+            self.notifier.setEnabled(False)
+            self.notifier.deleteLater()
+            self.notifier = None
+
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+        self.directory = None
+        self.watches = {}
+        self.paths = {}
+        self.pending = set()
+
+    def set_dirs(self, rel_paths):
+        """Watch exactly the project relative directories in rel_paths"""
+        if self.directory is None:
+            return
 
-            child = FileItem(None, os.path.join(base, direc))
-            child.setText(0, direc)
+        rel_paths = set(rel_paths)
 
-            tree.insert(0, child)
-            base, direc = os.path.split(base)
-            new_path = os.path.join(base, direc)
+        for rel_path in list(self.watches):
+            if rel_path not in rel_paths:
+                self.remove_dir(rel_path)
 
-            self.parent_map[child.path] = child
+        for rel_path in rel_paths:
+            if rel_path not in self.watches:
+                self.add_dir(rel_path)
 
-        # if we reached the top of the directory chain
-        if root is None:
-            # if the path is still valid, that means we need to create
-            # a new top level item
-            if new_path:
-                root = FileItem(None, new_path)
-                root.setText(0, direc)
-                self.parent_map[root.path] = root
+    def add_dir(self, rel_path):
+        path = os.path.join(self.directory, rel_path)
+
+        if self.inotify is not None:
+            try:
+                wd = self.inotify.add_watch(path, self.watch_mask)
+            except OSError as e:
+                if e.errno != errno.ENOSPC:
+                    return
+                self.logger.warning("Out of inotify watches, polling instead")
+                self.fall_back_to_polling()
             else:
-                # otherwise, the if the path is empty, we already
-                # have a top level item, so use that
-                root = tree.pop(0)
+                self.watches[rel_path] = wd
+                self.paths[wd] = rel_path
+                return
 
-            self.root.addTopLevelItem(root)
+        try:
+            self.watches[rel_path] = os.stat(path).st_mtime_ns
+        except OSError:
+            pass
 
-        # add all the children to the root node
-        temp = root
-        for child in tree:
-            temp.addChild(child)
-            temp = child
+    def remove_dir(self, rel_path):
+        watch = self.watches.pop(rel_path, None)
 
-    def on_whitelist_match(self, path, parent=None):
-        if parent is None:
-            self.fix_tree(path, parent)
+        if self.inotify is not None and watch is not None:
+            self.paths.pop(watch, None)
+            self.inotify.rm_watch(watch)
 
-    def generate_files(self):
-        directory = self.file_tree.directory
+    def fall_back_to_polling(self):
+        rel_paths = list(self.watches)
+        directory = self.directory
+
+        self.stop()
+        self.directory = directory
+
+        for rel_path in rel_paths:
+            self.add_dir(rel_path)
+
+        self.poll_timer.start(self.poll_interval)
+
+    def read_events(self, *args):
+        for wd, mask, name in self.inotify.read_events():
+            if mask & Inotify.IN_Q_OVERFLOW:
+                self.pending.update(self.watches)
+                continue
+
+            rel_path = self.paths.get(wd)
+
+            if mask & Inotify.IN_IGNORED:
+                self.paths.pop(wd, None)
+                if self.watches.get(rel_path) == wd:
+                    del self.watches[rel_path]
+                continue
 
-        if directory is None:
+            if rel_path is None:
+                continue
+
+            if mask & (Inotify.IN_DELETE_SELF | Inotify.IN_MOVE_SELF):
+                self.pending.add(os.path.dirname(rel_path) if rel_path else rel_path)
+            else:
+                self.pending.add(rel_path)
+
+        if self.pending:
+            self.debounce_timer.start(self.debounce_interval)
+
+    def poll(self):
+        for rel_path, mtime in list(self.watches.items()):
+            try:
+                new_mtime = os.stat(os.path.join(self.directory, rel_path)).st_mtime_ns
+            except OSError:
+                new_mtime = None
+                del self.watches[rel_path]
+                rel_path = os.path.dirname(rel_path)
+
+            if new_mtime != mtime:
+                if new_mtime is not None:
+                    self.watches[rel_path] = new_mtime
+                self.pending.add(rel_path)
+
+        if self.pending:
+            self.flush()
+
+    def flush(self):
+        pending = sorted(self.pending, key=len)
+        self.pending = set()
+        self.changed.emit(pending)
+
+
+class ProjectTreeNode(object):
+    """A file or directory in the ProjectTreeModel"""
+
+    __slots__ = ("path", "name", "is_dir", "parent", "children", "row")
+
+    def __init__(self, path, name, is_dir, parent=None, row=0):
+        self.path = path
+        self.name = name
+        self.is_dir = is_dir
+        self.parent = parent
+        self.row = row
+        # None until the children are fetched
+        self.children = None if is_dir else []
+
+
+class ProjectTreeModel(QtCore.QAbstractItemModel):
+    """
+    Item model of the project directory backed by the FileTree index.
+
+    The children of a directory are only created when the view expands
+    it, so memory stays proportional to what has been shown rather than
+    to the size of the project. Every node shows whether the filters of
+    the FileTree include or exclude it from the export.
+    """
+
+    excluded_color = QtGui.QColor("gray")
+
+    def __init__(self, file_tree, parent=None):
+        super(ProjectTreeModel, self).__init__(parent)
+        self.file_tree = file_tree
+        self.root_node = ProjectTreeNode("", "", True)
+        self.fetched = {}
+
+    def reset(self):
+        """Forget every fetched directory and start again from the root"""
+        self.beginResetModel()
+        self.root_node = ProjectTreeNode("", "", True)
+        self.fetched = {}
+        self.endResetModel()
+
+        # The top level is always shown
+        self.fetchMore(QtCore.QModelIndex())
+
+    def node(self, index):
+        if index.isValid():
+            return index.internalPointer()
+        return self.root_node
+
+    def node_index(self, node):
+        if node is self.root_node:
+            return QtCore.QModelIndex()
+        return self.createIndex(node.row, 0, node)
+
+    def index_for_path(self, path):
+        """Get the index of path if it has been fetched"""
+        node = self.fetched.get(path)
+        if node is None:
+            parent = self.fetched.get(os.path.dirname(path))
+            if parent is None:
+                return QtCore.QModelIndex()
+            for child in parent.children:
+                if child.path == path:
+                    node = child
+                    break
+            else:
+                return QtCore.QModelIndex()
+        return self.node_index(node)
+
+    def index(self, row, column, parent=QtCore.QModelIndex()):
+        node = self.node(parent)
+        if node.children is None or not 0 <= row < len(node.children):
+            return QtCore.QModelIndex()
+        return self.createIndex(row, column, node.children[row])
+
+    def parent(self, index=QtCore.QModelIndex()):
+        if not index.isValid():
+            return QtCore.QModelIndex()
+        return self.node_index(index.internalPointer().parent)
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.column() > 0:
+            return 0
+        children = self.node(parent).children
+        return len(children) if children is not None else 0
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 1
+
+    def hasChildren(self, parent=QtCore.QModelIndex()):
+        node = self.node(parent)
+        return node.is_dir and (node.children is None or bool(node.children))
+
+    def canFetchMore(self, parent):
+        node = self.node(parent)
+        return node.is_dir and node.children is None
+
+    def fetchMore(self, parent):
+        node = self.node(parent)
+        if node.children is not None or self.file_tree.directory is None:
             return
 
-        self.parent_map = {"": self.root}
+        file_index = self.file_tree.load_index(self.file_tree.directory)
+        try:
+            # Once fetched, the watcher keeps the directory current
+            entry = file_index.listing(node.path)
+        except OSError:
+            entry = {"dirs": [], "links": [], "files": {}}
+
+        names = [(name, True) for name in entry["dirs"]]
+        names += [(name, False) for name in entry["files"]]
+        children = [self.make_node(node, entry, name, is_dir) for name, is_dir in names]
+        children.sort(key=self.sort_key)
+        self.renumber_children(children)
+
+        self.fetched[node.path] = node
+        if not children:
+            node.children = []
+            return
 
-        self.file_tree.init_cache()
+        self.beginInsertRows(parent, 0, len(children) - 1)
+        node.children = children
+        self.endInsertRows()
+
+    def make_node(self, parent, entry, name, is_dir):
+        node = ProjectTreeNode(os.path.join(parent.path, name), name, is_dir, parent)
+        if name in entry["links"]:
+            # Symlinked directories are not walked
+            node.children = []
+        return node
+
+    @staticmethod
+    def sort_key(node):
+        return node.name, node.is_dir
+
+    def is_included(self, index):
+        return not self.file_tree.determine_skip(self.node(index).path)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+
+        node = index.internalPointer()
+
+        if role == Qt.DisplayRole:
+            return node.name
+        if role == Qt.ToolTipRole:
+            if self.is_included(index):
+                return "{} is exported".format(node.path)
+            return "{} is excluded from the export".format(node.path)
+        if role == Qt.ForegroundRole and not self.is_included(index):
+            return self.excluded_color
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return "Project files"
+        return None
+
+    def filters_changed(self):
+        """Show the include/exclude state of the new filters"""
+        for node in self.fetched.values():
+            if node.children:
+                first = self.createIndex(0, 0, node.children[0])
+                last = self.createIndex(len(node.children) - 1, 0, node.children[-1])
+                self.dataChanged.emit(first, last, [Qt.ForegroundRole, Qt.ToolTipRole])
+
+    def update_dir(self, path, added, removed):
+        """Add and remove the children of a fetched directory"""
+        node = self.fetched.get(path)
+        if node is None:
+            return
 
-        for root, dirs, files in self.file_tree.walk(directory):
-            self.file_tree.add_to_cache(root, dirs, files)
+        parent = self.node_index(node)
 
-            proj_path = root.replace(directory, "")
+        for child_path in removed:
+            for row, child in enumerate(node.children):
+                if child.path == child_path:
+                    break
+            else:
+                continue
 
-            for dir in dirs:
-                parent = self.parent_map.get(proj_path)
+            self.beginRemoveRows(parent, row, row)
+            del node.children[row]
+            self.renumber_children(node.children)
+            prefix = child_path + os.sep
+            for fetched_path in list(self.fetched):
+                if fetched_path == child_path or fetched_path.startswith(prefix):
+                    del self.fetched[fetched_path]
+            self.endRemoveRows()
 
-                path = os.path.join(proj_path, dir)
+        entry = self.file_tree.file_index.listing(path, check=False)
+        keys = [self.sort_key(child) for child in node.children]
 
-                if self.file_tree.determine_skip(path, parent=parent) or parent is None:
-                    continue
+        for child_path in added:
+            name = os.path.basename(child_path)
+            child = self.make_node(node, entry, name, name in entry["dirs"])
+            row = bisect.bisect(keys, self.sort_key(child))
 
-                child = FileItem(parent, path)
-                child.setText(0, dir)
-                self.parent_map[path] = child
-                self.file_tree.dirs.append(path)
+            self.beginInsertRows(parent, row, row)
+            node.children.insert(row, child)
+            keys.insert(row, self.sort_key(child))
+            self.renumber_children(node.children)
+            self.endInsertRows()
 
-            for file in files:
-                parent = self.parent_map.get(proj_path)
+    @staticmethod
+    def renumber_children(children):
+        for row, child in enumerate(children):
+            child.row = row
 
-                path = os.path.join(proj_path, file)
 
-                if self.file_tree.determine_skip(path, parent=parent) or parent is None:
-                    continue
+class TreeBrowser(QtWidgets.QWidget):
+    """
+    Shows the project directory, fetching each directory as it is
+    expanded and greying out what the filters exclude.
+    """
+
+    def __init__(
+        self,
+        directory=None,
+        whitelist=None,
+        blacklist=None,
+        parent=None,
+        index_dir=None,
+    ):
+        QtWidgets.QWidget.__init__(self, parent=parent)
+
+        self.file_tree = FileTree(None, whitelist, blacklist, index_dir)
+
+        self.model = ProjectTreeModel(self.file_tree, self)
+        self.view = QtWidgets.QTreeView()
+        self.view.setModel(self.model)
+        self.view.setUniformRowHeights(True)
+        self.view.header().setSectionResizeMode(QtWidgets.QHeaderView.ResizeToContents)
+        self.view.header().setStretchLastSection(False)
+
+        self.watcher = FileWatcher(self)
+        self.watcher.changed.connect(self.apply_changes)
+        self.model.rowsInserted.connect(self.watch_dirs)
+
+        layout = QtWidgets.QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(self.view)
+        self.setLayout(layout)
+
+        self.init(directory, whitelist, blacklist)
+
+    def clear(self):
+        self.model.reset()
+        self.file_tree.clear()
+
+    def init(self, directory=None, whitelist=None, blacklist=None):
+        # The file lists are generated at export, the view only lists the
+        # directories that are expanded
+        self.file_tree.init(directory, whitelist, blacklist, generate=False)
+
+        if self.file_tree.directory is not None:
+            self.watcher.start(self.file_tree.directory)
+        else:
+            self.watcher.stop()
+
+        self.model.reset()
+        self.watch_dirs()
+
+    def refresh(self, whitelist=None, blacklist=None):
+        self.file_tree.set_filters(whitelist, blacklist)
+
+        if whitelist is None and blacklist is None:
+            # A plain refresh checks the disk again
+            self.reload()
+        else:
+            # Filter edits only re-evaluate what is already shown
+            self.model.filters_changed()
+
+    def reload(self):
+        """Rebuild the model, expanding the directories that were expanded"""
+        expanded = [
+            path
+            for path in sorted(self.model.fetched, key=len)
+            if path and self.view.isExpanded(self.model.index_for_path(path))
+        ]
+
+        self.model.reset()
+
+        for path in expanded:
+            index = self.model.index_for_path(path)
+            if index.isValid():
+                self.view.expand(index)
+
+        self.watch_dirs()
+
+    def watch_dirs(self, *args):
+        """Watch every directory whose children are shown"""
+        if self.file_tree.file_index is not None:
+            self.watcher.set_dirs(list(self.model.fetched))
+
+    def apply_changes(self, rel_dirs):
+        """
+        Update the model for the directories the watcher reported as
+        changed, only adding and removing the rows that changed.
+        """
+        file_index = self.file_tree.file_index
+
+        if file_index is None:
+            return
+
+        for rel_dir in rel_dirs:
+            if rel_dir not in self.model.fetched:
+                continue
+
+            changes = file_index.rescan(rel_dir)
 
-                child = FileItem(parent, path)
-                child.setText(0, file)
-                self.file_tree.files.append(path)
+            if changes is None:
+                if not rel_dir:
+                    # The project directory itself is gone
+                    self.model.reset()
+                # Otherwise the parent reports the directory as removed
+                continue
 
-        self.root.sortItems(0, Qt.AscendingOrder)
+            self.model.update_dir(rel_dir, *changes)
+
+        file_index.save()
+        self.watch_dirs()
 
 
 class ExistingProjectDialog(QtWidgets.QDialog):
@@ -503,21 +1390,45 @@ class Setting(object):
 
         path = location or self.save_file_path(version, sdk_build=sdk_build)
 
-        file = self.extract_class(path, *self.extract_args)
-        # currently, python's extracting mechanism for zipfile doesn't
-        # copy file permissions, resulting in a binary that
-        # that doesn't work. Copied from a patch here:
-        # http://bugs.python.org/file34873/issue15795_cleaned.patch
+        # python's extracting mechanism for zipfile doesn't copy file
+        # permissions or symlinks, resulting in a binary that doesn't work,
+        # so zips are extracted with utils.extract_zip
         if path.endswith(".zip"):
-            members = file.namelist()
-            for zipinfo in members:
-                minfo = file.getinfo(zipinfo)
-                target = file.extract(zipinfo, ex_path)
-                mode = minfo.external_attr >> 16 & 0x1FF
-                os.chmod(target, mode)
+            num_bytes, seconds = utils.extract_zip(path, ex_path)
+            MB = num_bytes / 1000000.0
+            config.getLogger(__name__).info(
+                "Extracted {}: {:.2f} MB in {:.1f}s ({:.2f} MB/s)".format(
+                    os.path.basename(path), MB, seconds, MB / max(seconds, 0.001)
+                )
+            )
         else:
+            file = self.extract_class(path, *self.extract_args)
             file.extractall(ex_path)
 
+        self.flatten_archive_dir(ex_path, path)
+
+    def extract_stream(self, ex_path, fileobj, archive_path):
+        """
+        Extract a .tar.gz archive while it is being read from fileobj.
+
+        The archive is read once, front to back, so this works on a
+        download that is still in progress.
+
+        Args:
+            ex_path: the directory to extract into
+            fileobj: a file-like object positioned at the start of the archive
+            archive_path: the path the archive is being saved to
+        """
+        if os.path.exists(ex_path):
+            utils.rmtree(ex_path, ignore_errors=True)
+
+        with tarfile.open(fileobj=fileobj, mode="r|gz") as file:
+            file.extractall(ex_path)
+
+        self.flatten_archive_dir(ex_path, archive_path)
+
+    def flatten_archive_dir(self, ex_path, path):
+        """Move the contents of the archive's top level directory into ex_path"""
         if path.endswith(".tar.gz"):
             dir_name = utils.path_join(
                 ex_path, os.path.basename(path).replace(".tar.gz", "")
@@ -547,6 +1458,1028 @@ class Setting(object):
         )
 
 
+class RuntimeCache(object):
+    """
+    Persistent cache of extracted NW.js runtimes.
+
+    Every runtime is extracted once into
+    ``<download_dir>/runtimes/<version>-<platform>[-sdk]/`` and described by
+    a ``<version>-<platform>[-sdk].json`` manifest next to it. The manifest
+    records the number of files and bytes that were extracted so that a
+    partially deleted or modified runtime is detected and extracted again.
+    Entries are evicted least recently used first once the cache grows
+    beyond max_size bytes.
+    """
+
+    def __init__(self, location, max_size=0):
+        self.location = utils.path_join(location, "runtimes")
+        self.max_size = max_size
+        self.logger = config.getLogger(__name__)
+
+        if not os.path.exists(self.location):
+            os.makedirs(self.location, exist_ok=True)
+
+    def key(self, version, setting, sdk_build=False):
+        """Get the cache key for a runtime"""
+        key = "{}-{}".format(version, setting.name)
+        if sdk_build:
+            key += "-sdk"
+        return key
+
+    def entry_path(self, key):
+        return utils.path_join(self.location, key)
+
+    def manifest_path(self, key):
+        return utils.path_join(self.location, key + ".json")
+
+    def lock(self, key, shared=False):
+        """
+        Get the lock of the runtime for key.
+
+        Exports hold it shared while they read the runtime, installing or
+        evicting it holds it exclusively, so concurrent exports on one
+        machine never see a runtime that is being replaced.
+        """
+        return utils.FileLock(utils.path_join(self.location, key + ".lock"), shared)
+
+    def load_manifest(self, key):
+        """Load the manifest for key, or None if it is missing or invalid"""
+        manifest_path = self.manifest_path(key)
+        try:
+            with codecs.open(manifest_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save_manifest(self, key, manifest):
+        manifest_path = self.manifest_path(key)
+        tmp_path = "{}.{}.tmp".format(manifest_path, os.getpid())
+        with codecs.open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=4, sort_keys=True)
+        os.replace(tmp_path, manifest_path)
+
+    @staticmethod
+    def tree_size(path):
+        """Count the files and bytes contained in the path"""
+        num_files = 0
+        num_bytes = 0
+        for root, dirs, files in os.walk(path):
+            for file_name in files:
+                num_files += 1
+                num_bytes += os.lstat(os.path.join(root, file_name)).st_size
+        return num_files, num_bytes
+
+    def is_valid(self, key, archive_path=None):
+        """
+        Check that the cached runtime matches its manifest.
+
+        Args:
+            key: the cache key of the runtime
+            archive_path: if the archive still exists, the cached runtime
+                          must have been extracted from an archive of the
+                          same size
+        """
+        manifest = self.load_manifest(key)
+        entry_path = self.entry_path(key)
+
+        if manifest is None or not os.path.isdir(entry_path):
+            return False
+
+        if archive_path and os.path.exists(archive_path):
+            if os.path.getsize(archive_path) != manifest.get("archive_size"):
+                return False
+
+        num_files, num_bytes = self.tree_size(entry_path)
+
+        return num_files == manifest.get("files") and num_bytes == manifest.get("size")
+
+    def get(self, key, archive_path=None):
+        """
+        Get the path of a valid cached runtime and mark it as recently used.
+
+        Returns:
+            The path of the runtime or None if it is not cached
+        """
+        if not self.is_valid(key, archive_path):
+            return None
+
+        manifest = self.load_manifest(key)
+        manifest["last_used"] = time.time()
+        self.save_manifest(key, manifest)
+
+        return self.entry_path(key)
+
+    def install(self, key, setting, version, archive_path, sdk_build=False):
+        """
+        Extract the archive into the cache.
+
+        The runtime is extracted into a staging directory first and only
+        moved into place once it is complete, so an interrupted extraction
+        never leaves a runtime that looks valid.
+
+        Returns:
+            The path of the cached runtime
+        """
+        staging_path = self.staging_path(key)
+
+        setting.extract(staging_path, version, archive_path, sdk_build)
+
+        return self.commit(key, setting, version, staging_path, archive_path, sdk_build)
+
+    def staging_path(self, key):
+        """Get a private directory to extract the runtime for key into"""
+        return "{}.partial-{}-{}".format(
+            self.entry_path(key), os.getpid(), threading.get_ident()
+        )
+
+    def commit(
+        self, key, setting, version, staging_path, archive_path, sdk_build=False
+    ):
+        """
+        Move a fully extracted runtime into place and write its manifest.
+
+        Args:
+            staging_path: the directory the runtime was extracted into
+            archive_path: the archive the runtime was extracted from
+
+        Returns:
+            The path of the cached runtime
+        """
+        entry_path = self.entry_path(key)
+
+        num_files, num_bytes = self.tree_size(staging_path)
+
+        if os.path.exists(entry_path):
+            utils.rmtree(entry_path, ignore_errors=True)
+
+        os.rename(staging_path, entry_path)
+
+        now = time.time()
+        self.save_manifest(
+            key,
+            {
+                "version": version,
+                "platform": setting.name,
+                "sdk_build": bool(sdk_build),
+                "archive": os.path.basename(archive_path),
+                "archive_size": os.path.getsize(archive_path),
+                "files": num_files,
+                "size": num_bytes,
+                "created": now,
+                "last_used": now,
+            },
+        )
+
+        self.logger.info(
+            "Cached runtime {} ({} files, {} bytes)".format(key, num_files, num_bytes)
+        )
+
+        return entry_path
+
+    def entries(self):
+        """Get a list of (key, manifest) for every runtime in the cache"""
+        entries = []
+        for file_name in os.listdir(self.location):
+            if file_name.endswith(".json"):
+                key = file_name[: -len(".json")]
+                manifest = self.load_manifest(key)
+                if manifest is not None:
+                    entries.append((key, manifest))
+        return entries
+
+    def remove(self, key):
+        entry_path = self.entry_path(key)
+        if os.path.exists(entry_path):
+            utils.rmtree(entry_path, ignore_errors=True)
+        if os.path.exists(self.manifest_path(key)):
+            os.remove(self.manifest_path(key))
+
+    def prune(self, max_size=None, keep=()):
+        """
+        Remove broken entries, then evict the least recently used
+        runtimes until the cache fits in max_size bytes.
+
+        Args:
+            max_size: the size cap in bytes. Defaults to self.max_size.
+                      A cap of 0 or less means the cache is unbounded.
+            keep: keys that must not be evicted, such as the runtimes
+                  used by the current export
+
+        Returns:
+            A list of the keys that were removed
+        """
+        if max_size is None:
+            max_size = self.max_size
+
+        removed = []
+        stale_time = time.time() - 60 * 60
+
+        for file_name in os.listdir(self.location):
+            path = utils.path_join(self.location, file_name)
+            if ".partial-" in file_name and os.path.getmtime(path) < stale_time:
+                # Left behind by an interrupted extraction
+                utils.rmtree(path, ignore_errors=True)
+            elif os.path.isdir(path) and self.load_manifest(file_name) is None:
+                if ".partial-" in file_name:
+                    continue
+                lock = self.lock(file_name)
+                if not lock.acquire(blocking=False):
+                    continue
+                try:
+                    if self.load_manifest(file_name) is None:
+                        utils.rmtree(path, ignore_errors=True)
+                        removed.append(file_name)
+                finally:
+                    lock.release()
+
+        entries = self.entries()
+        total_size = sum(manifest.get("size", 0) for _, manifest in entries)
+
+        if max_size is None or max_size <= 0:
+            return removed
+
+        entries.sort(key=lambda entry: entry[1].get("last_used", 0))
+
+        for key, manifest in entries:
+            if total_size <= max_size:
+                break
+            if key in keep:
+                continue
+
+            # Runtimes that another export is using are kept
+            lock = self.lock(key)
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                self.remove(key)
+            finally:
+                lock.release()
+
+            total_size -= manifest.get("size", 0)
+            removed.append(key)
+            self.logger.info("Evicted runtime {} from the cache".format(key))
+
+        return removed
+
+
+class FileCache(object):
+    """
+    Cache of files generated from other files.
+
+    Every output is kept in ``<download_dir>/<name>`` under a key made of
+    everything it was generated from, and is hardlinked or copied back
+    out on a hit.
+    """
+
+    name = None
+
+    def __init__(self, location):
+        self.location = utils.path_join(location, self.name)
+        self.logger = config.getLogger(__name__)
+
+        os.makedirs(self.location, exist_ok=True)
+
+    @staticmethod
+    def make_key(*parts):
+        key = "\0".join(str(part) for part in parts)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def entry_path(self, key):
+        return utils.path_join(self.location, key[:2], key)
+
+    def get(self, key, path):
+        """
+        Replace path with the cached output for key.
+
+        Returns:
+            True if the output was cached
+        """
+        entry_path = self.entry_path(key)
+        if not os.path.exists(entry_path):
+            return False
+
+        tmp_path = "{}.{}-{}.tmp".format(path, os.getpid(), threading.get_ident())
+        try:
+            utils.materialize_file(entry_path, tmp_path, "hardlink")
+        except OSError:
+            utils.materialize_file(entry_path, tmp_path, "copy")
+        os.replace(tmp_path, path)
+
+        return True
+
+    def put(self, key, path):
+        """Add the file path to the cache as the output for key"""
+        entry_path = self.entry_path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+
+        tmp_path = "{}.{}-{}.tmp".format(entry_path, os.getpid(), threading.get_ident())
+        try:
+            shutil.copy2(path, tmp_path)
+            os.replace(tmp_path, entry_path)
+        except (IOError, OSError) as e:
+            # The cache only saves time, so generating never fails over it
+            self.logger.warning("Could not cache {}: {}".format(path, e))
+
+
+class UpxCache(FileCache):
+    """
+    Cache of files compressed by UPX.
+
+    The compressed output of every file is kept in ``<download_dir>/upx``
+    under a key made of the hash of the input file, the compression level
+    and the UPX version, so recompressing the same runtime library is
+    just a link or copy.
+    """
+
+    name = "upx"
+
+    @staticmethod
+    def key(input_hash, level, upx_version):
+        return FileCache.make_key(input_hash, level, upx_version)
+
+
+class PatchedExeCache(FileCache):
+    """
+    Cache of Windows executables with the project icon patched in.
+
+    Patched executables are kept in ``<download_dir>/patched`` under a key
+    made of the hash of the unpatched runtime binary, the hash of the icon
+    and the patch options. Only the max_entries most recently used are
+    kept, since every entry is a full copy of nw.exe.
+
+    The runtime binary hashes are remembered in ``digests.json`` by path,
+    size and modification time, so the binary is only read once.
+    """
+
+    name = "patched"
+
+    def __init__(self, location, max_entries=8):
+        super(PatchedExeCache, self).__init__(location)
+        self.max_entries = max_entries
+        self.digests_path = utils.path_join(self.location, "digests.json")
+
+    @staticmethod
+    def key(runtime_hash, icon_hash, options):
+        return FileCache.make_key(runtime_hash, icon_hash, options)
+
+    def load_digests(self):
+        try:
+            with codecs.open(self.digests_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def digest(self, path):
+        """Get the sha256 of the file path, hashing it only if it changed"""
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        file_id = [st.st_size, st.st_mtime_ns, st.st_ino]
+
+        digests = self.load_digests()
+        entry = digests.get(path)
+        if entry and entry[:3] == file_id:
+            return entry[3]
+
+        digest = utils.hash_path(path)
+
+        # Other exports may have added digests since they were loaded
+        with utils.FileLock(self.digests_path + ".lock"):
+            digests = self.load_digests()
+            digests[path] = file_id + [digest]
+
+            tmp_path = "{}.{}-{}.tmp".format(
+                self.digests_path, os.getpid(), threading.get_ident()
+            )
+            try:
+                with codecs.open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(digests, f, indent=4, sort_keys=True)
+                os.replace(tmp_path, self.digests_path)
+            except (IOError, OSError) as e:
+                self.logger.warning("Could not save runtime digests: {}".format(e))
+
+        return digest
+
+    def get(self, key, path):
+        # The modification time orders the entries for prune(). Touching
+        # the entry before linking it keeps a concurrent prune() from
+        # picking it, and a pruned entry is just a miss.
+        try:
+            os.utime(self.entry_path(key))
+        except OSError:
+            return False
+        return super(PatchedExeCache, self).get(key, path)
+
+    def put(self, key, path):
+        super(PatchedExeCache, self).put(key, path)
+        self.prune()
+
+    def entries(self):
+        """Get the paths of all cached executables"""
+        paths = []
+        for dir_name in os.listdir(self.location):
+            dir_path = utils.path_join(self.location, dir_name)
+            if not os.path.isdir(dir_path):
+                continue
+            for file_name in os.listdir(dir_path):
+                if not file_name.endswith(".tmp"):
+                    paths.append(utils.path_join(dir_path, file_name))
+        return paths
+
+    def prune(self):
+        """Remove the least recently used entries beyond max_entries"""
+        entries = []
+        for path in self.entries():
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except OSError:
+                pass
+
+        entries.sort(reverse=True)
+
+        for _, path in entries[self.max_entries :]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class ArtifactStore(object):
+    """
+    Content-addressed store of exported files.
+
+    Every file of an export is hashed and replaced by a hardlink to
+    ``<download_dir>/store/objects/<xx>/<sha256>-<mode>``, so identical
+    runtime files and assets across projects and NW.js versions are only
+    stored once. The permissions are part of the key because hardlinks
+    share them.
+
+    Output files are hardlinks into the store, so they must be passed to
+    :py:func:`utils.break_hardlink` before being modified in place. Every
+    output directory added to the store is recorded under
+    ``<download_dir>/store/refs``, and gc() removes the blobs that none of
+    the recorded directories still link to.
+    """
+
+    def __init__(self, location, workers=None):
+        self.location = utils.path_join(location, "store")
+        self.objects_path = utils.path_join(self.location, "objects")
+        self.refs_path = utils.path_join(self.location, "refs")
+        self.workers = workers or os.cpu_count() or 1
+        self.logger = config.getLogger(__name__)
+
+        os.makedirs(self.objects_path, exist_ok=True)
+        os.makedirs(self.refs_path, exist_ok=True)
+
+    def lock(self, shared=False):
+        """Get the lock that keeps gc() from running during add_tree()"""
+        return utils.FileLock(utils.path_join(self.location, "store.lock"), shared)
+
+    def blob_path(self, digest, mode):
+        return utils.path_join(
+            self.objects_path, digest[:2], "{}-{:o}".format(digest, mode)
+        )
+
+    def add_file(self, path):
+        """
+        Move a file into the store and replace it with a hardlink to its
+        blob.
+
+        Returns:
+            The number of bytes saved because the blob was already stored
+
+        Raises:
+            OSError if the file can not be hardlinked into the store
+        """
+        st = os.lstat(path)
+        if not stat.S_ISREG(st.st_mode):
+            return 0
+
+        blob_path = self.blob_path(utils.hash_path(path), stat.S_IMODE(st.st_mode))
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+
+        if st.st_nlink > 1:
+            # The file shares its data with something outside of the
+            # store, such as the runtime cache, so the blob gets a copy
+            # of its own that nothing else can modify
+            tmp_path = "{}.{}-{}.tmp".format(
+                blob_path, os.getpid(), threading.get_ident()
+            )
+            try:
+                utils.materialize_file(path, tmp_path, "reflink")
+            except OSError:
+                utils.materialize_file(path, tmp_path, "copy")
+            try:
+                os.link(tmp_path, blob_path)
+                saved = 0
+            except FileExistsError:
+                saved = st.st_size
+            finally:
+                os.remove(tmp_path)
+        else:
+            try:
+                os.link(path, blob_path)
+                return 0
+            except FileExistsError:
+                saved = st.st_size
+
+        if os.path.samefile(path, blob_path):
+            return 0
+
+        tmp_path = "{}.{}-{}.tmp".format(path, os.getpid(), threading.get_ident())
+        os.link(blob_path, tmp_path)
+        os.replace(tmp_path, path)
+
+        return saved
+
+    def ref_path(self, directory):
+        directory = os.path.abspath(directory)
+        name = hashlib.sha1(directory.encode("utf-8", "surrogateescape")).hexdigest()
+        return utils.path_join(self.refs_path, name)
+
+    def add_ref(self, directory):
+        """Record that directory links to blobs of the store"""
+        directory = os.path.abspath(directory)
+        with io.open(self.ref_path(directory), "w", encoding="utf-8") as f:
+            f.write(directory)
+
+    def refs(self):
+        """
+        Get the recorded output directories, forgetting the ones that no
+        longer exist.
+        """
+        directories = []
+        for name in os.listdir(self.refs_path):
+            ref_path = utils.path_join(self.refs_path, name)
+            try:
+                with io.open(ref_path, "r", encoding="utf-8") as f:
+                    directory = f.read()
+            except OSError:
+                continue
+
+            if os.path.isdir(directory):
+                directories.append(directory)
+            else:
+                try:
+                    os.remove(ref_path)
+                except OSError:
+                    pass
+        return directories
+
+    def add_tree(self, directory):
+        """
+        Move every file of directory into the store.
+
+        Returns:
+            A tuple of the number of files stored and the number of bytes
+            saved by files that were already in the store
+        """
+        paths = []
+        for root, dirs, files in os.walk(directory):
+            paths.extend(os.path.join(root, file_name) for file_name in files)
+
+        if not paths:
+            return 0, 0
+
+        with self.lock(shared=True):
+            self.add_ref(directory)
+
+            # Fail early and keep the plain files if hardlinks into the
+            # store are not possible, for example across file systems
+            saved = self.add_file(paths[0])
+
+            with futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+                saved += sum(executor.map(self.add_file, paths[1:]))
+
+        return len(paths), saved
+
+    def blobs(self):
+        """Get the paths of every blob in the store"""
+        for root, dirs, files in os.walk(self.objects_path):
+            for file_name in files:
+                if not file_name.endswith(".tmp"):
+                    yield os.path.join(root, file_name)
+
+    def referenced_files(self):
+        """Get the (st_dev, st_ino) of every file in the recorded outputs"""
+        files = set()
+        for directory in self.refs():
+            for root, dirs, file_names in os.walk(directory):
+                for file_name in file_names:
+                    try:
+                        st = os.lstat(os.path.join(root, file_name))
+                    except OSError:
+                        continue
+                    if st.st_nlink > 1:
+                        files.add((st.st_dev, st.st_ino))
+        return files
+
+    def gc(self):
+        """
+        Remove the blobs that no recorded output links to anymore.
+
+        A blob can share its inode with files outside of the recorded
+        outputs, so its link count alone does not tell whether an export
+        still uses it.
+
+        Returns:
+            A tuple of the number of blobs and bytes removed
+        """
+        removed = 0
+        removed_bytes = 0
+
+        with self.lock():
+            referenced = self.referenced_files()
+
+            for blob_path in self.blobs():
+                try:
+                    st = os.lstat(blob_path)
+                    if st.st_nlink > 1 and (st.st_dev, st.st_ino) in referenced:
+                        continue
+                    os.remove(blob_path)
+                except OSError:
+                    continue
+
+                removed += 1
+                removed_bytes += st.st_size
+
+            for root, dirs, files in os.walk(self.objects_path, topdown=False):
+                if root != self.objects_path and not dirs and not files:
+                    try:
+                        os.rmdir(root)
+                    except OSError:
+                        pass
+
+        self.logger.info(
+            "Removed {} unreferenced blobs ({} bytes)".format(removed, removed_bytes)
+        )
+
+        return removed, removed_bytes
+
+
+class TeeReader(object):
+    """
+    File-like wrapper that copies everything read from a stream into
+    another file.
+    """
+
+    def __init__(self, stream, tee_file, callback=None):
+        self.stream = stream
+        self.tee_file = tee_file
+        self.callback = callback
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        if data:
+            self.tee_file.write(data)
+            if self.callback is not None:
+                self.callback(len(data))
+        return data
+
+    def drain(self, block_size=64 * 1024):
+        """Read whatever the consumer left unread, such as archive padding"""
+        while self.read(block_size):
+            pass
+
+
+class RangedDownloader(object):
+    """
+    Downloads a file over several connections at once.
+
+    The file is split into byte ranges that are fetched concurrently into
+    a preallocated file. Progress of every range is kept in a small
+    ``<file_name>.parts`` sidecar file, so an interrupted download resumes
+    each range where it stopped. Servers that do not advertise
+    ``Accept-Ranges: bytes`` are downloaded with a single stream, which
+    resumes from the end of the partial file when possible.
+    """
+
+    block_size = 64 * 1024
+    state_interval = 1.0
+
+    def __init__(
+        self,
+        url,
+        file_name,
+        connections=4,
+        min_segment_size=1024 * 1024,
+        progress_callback=None,
+    ):
+        self.url = url
+        self.file_name = file_name
+        self.state_file = file_name + ".parts"
+        self.connections = max(1, connections)
+        self.min_segment_size = min_segment_size
+        self.progress_callback = progress_callback
+        self.logger = config.getLogger(__name__)
+
+        self.size = None
+        self.accept_ranges = None
+        self.resumed = 0
+        self._lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._segments = []
+        self._last_state_save = 0
+
+    def probe(self):
+        """
+        Find the size of the file and whether the server supports ranges.
+
+        The result is kept in size and accept_ranges, so download() does
+        not ask the server again.
+
+        Returns:
+            A tuple of (size or None, supports_ranges)
+        """
+        try:
+            response = utils.urlopen(self.url, method="HEAD")
+        except Exception:
+            response = utils.urlopen(self.url, headers={"Range": "bytes=0-0"})
+
+        with response:
+            headers = response.info()
+            size = None
+            accept_ranges = headers.get("Accept-Ranges", "").lower() == "bytes"
+            content_range = headers.get("Content-Range")
+
+            if response.status == 206 and content_range:
+                accept_ranges = True
+                size = int(content_range.split("/")[-1])
+            elif headers.get("Content-Length") is not None:
+                size = int(headers.get("Content-Length"))
+
+        self.size = size
+        self.accept_ranges = accept_ranges
+
+        return size, accept_ranges
+
+    def download(self):
+        """Download the file, resuming any previous partial download"""
+        if self.accept_ranges is None:
+            self.probe()
+
+        segmented = (
+            self.accept_ranges
+            and self.size is not None
+            and self.connections > 1
+            and self.size >= self.min_segment_size * 2
+        )
+
+        if segmented:
+            self.download_segments()
+        else:
+            self.download_stream()
+
+        if os.path.exists(self.state_file):
+            os.remove(self.state_file)
+
+        return self.file_name
+
+    @property
+    def downloaded(self):
+        with self._lock:
+            return sum(done for _, _, done in self._segments)
+
+    def report_progress(self):
+        if self.progress_callback is not None:
+            self.progress_callback(self.downloaded, self.size)
+
+    def download_stream(self):
+        """Download the file with one connection"""
+        tmp_size = 0
+        if os.path.exists(self.file_name):
+            tmp_size = os.path.getsize(self.file_name)
+
+        if self.size is not None and tmp_size >= self.size:
+            tmp_size = 0
+
+        headers = {}
+        if tmp_size:
+            headers["Range"] = "bytes={}-".format(tmp_size)
+
+        response = utils.urlopen(self.url, headers=headers)
+
+        with response:
+            mode = "ab"
+            if tmp_size and response.status != 206:
+                # The server ignored the range, so start over
+                tmp_size = 0
+                mode = "wb"
+            elif not tmp_size:
+                mode = "wb"
+
+            if self.size is None and response.info().get("Content-Length"):
+                self.size = tmp_size + int(response.info().get("Content-Length"))
+
+            self.resumed = tmp_size
+            self._segments = [[0, (self.size or 0) - 1, tmp_size]]
+
+            with io.open(self.file_name, mode) as f:
+                while True:
+                    buff = response.read(self.block_size)
+                    if not buff:
+                        break
+                    f.write(buff)
+                    with self._lock:
+                        self._segments[0][2] += len(buff)
+                    self.report_progress()
+
+        self.check_complete()
+
+    def check_complete(self):
+        """
+        Raise an IOError if the connection closed before the whole file,
+        as far as its size is known, was received.
+        """
+        if self.size is not None and self.downloaded < self.size:
+            raise IOError(
+                "Connection closed after {} of {} bytes".format(
+                    self.downloaded, self.size
+                )
+            )
+
+    def stream(self, consumer):
+        """
+        Download the file with one connection while consumer reads it.
+
+        The body is written to file_name as consumer reads it, so the
+        file is kept on disk without being read a second time. A streamed
+        download always starts from the first byte, because the consumer
+        needs the whole stream.
+
+        Args:
+            consumer: a function that receives a file-like object for the
+                      body of the response
+
+        Returns:
+            The return value of consumer
+        """
+        if os.path.exists(self.state_file):
+            os.remove(self.state_file)
+
+        response = utils.urlopen(self.url)
+
+        with response:
+            if response.info().get("Content-Length") is not None:
+                self.size = int(response.info().get("Content-Length"))
+
+            self.resumed = 0
+            self._segments = [[0, (self.size or 0) - 1, 0]]
+
+            def advance(num_bytes):
+                with self._lock:
+                    self._segments[0][2] += num_bytes
+                self.report_progress()
+
+            with io.open(self.file_name, "wb") as f:
+                reader = TeeReader(response, f, advance)
+                result = consumer(reader)
+                reader.drain(self.block_size)
+
+        self.check_complete()
+
+        return result
+
+    def plan_segments(self):
+        """Split the remaining bytes into one range per connection"""
+        start = 0
+        if os.path.exists(self.file_name) and not os.path.exists(self.state_file):
+            # Resume a partial single stream download
+            start = min(os.path.getsize(self.file_name), self.size)
+
+        segments = []
+        if start:
+            segments.append([0, start - 1, start])
+
+        remaining = self.size - start
+        count = max(1, min(self.connections, remaining // self.min_segment_size))
+        segment_size = -(-remaining // count) if remaining else 0
+
+        while start < self.size:
+            end = min(start + segment_size, self.size) - 1
+            segments.append([start, end, 0])
+            start = end + 1
+
+        return segments
+
+    def load_state(self):
+        """Load the segments from the sidecar file if it matches this file"""
+        try:
+            with codecs.open(self.state_file, encoding="utf-8") as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if state.get("url") != self.url or state.get("size") != self.size:
+            return None
+
+        if not os.path.exists(self.file_name):
+            return None
+
+        return state.get("segments")
+
+    def save_state(self, force=False):
+        with self._state_lock:
+            now = time.time()
+            if not force and now - self._last_state_save < self.state_interval:
+                return
+            self._last_state_save = now
+
+            with self._lock:
+                state = {
+                    "url": self.url,
+                    "size": self.size,
+                    "segments": [list(segment) for segment in self._segments],
+                }
+
+            tmp_state_file = self.state_file + ".tmp"
+            with codecs.open(tmp_state_file, "w", encoding="utf-8") as f:
+                json.dump(state, f)
+            os.replace(tmp_state_file, self.state_file)
+
+    def download_segments(self):
+        """Download every unfinished range concurrently"""
+        segments = self.load_state()
+
+        if segments is None:
+            segments = self.plan_segments()
+            with io.open(self.file_name, "ab") as f:
+                f.truncate(self.size)
+
+        self._segments = segments
+        self.resumed = self.downloaded
+        self.save_state(force=True)
+
+        if self.resumed:
+            self.logger.info("Resuming {} from {} bytes".format(self.url, self.resumed))
+
+        pending = [
+            index
+            for index, (start, end, done) in enumerate(self._segments)
+            if start + done <= end
+        ]
+
+        errors = []
+
+        def run(index):
+            try:
+                self.download_segment(index)
+            except Exception as e:
+                errors.append(e)
+                self._stop.set()
+
+        threads = [threading.Thread(target=run, args=(index,)) for index in pending]
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.5)
+        except KeyboardInterrupt:
+            self._stop.set()
+            raise
+        finally:
+            self.save_state(force=True)
+
+        if errors:
+            raise errors[0]
+
+    def download_segment(self, index):
+        start, end, done = self._segments[index]
+        headers = {"Range": "bytes={}-{}".format(start + done, end)}
+
+        response = utils.urlopen(self.url, headers=headers)
+
+        with response:
+            if response.status != 206:
+                raise IOError(
+                    "Server did not return the range {}".format(headers["Range"])
+                )
+
+            # Unbuffered so that the bytes recorded in the state file
+            # have always been handed to the OS
+            with io.open(self.file_name, "r+b", buffering=0) as f:
+                f.seek(start + done)
+                while not self._stop.is_set():
+                    remaining = end - (start + self._segments[index][2]) + 1
+                    if remaining <= 0:
+                        break
+                    buff = response.read(min(self.block_size, remaining))
+                    if not buff:
+                        break
+                    f.write(buff)
+                    with self._lock:
+                        self._segments[index][2] += len(buff)
+                    self.report_progress()
+                    self.save_state()
+
+        if start + self._segments[index][2] <= end and not self._stop.is_set():
+            raise IOError("Connection closed before the range was complete")
+
+
 class CompleterLineEdit(QtWidgets.QLineEdit):
     def __init__(self, tag_dict, *args):
         QtWidgets.QLineEdit.__init__(self, *args)
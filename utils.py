@@ -5,14 +5,27 @@ and GUI modules, but aren't related to either module.
 """
 from __future__ import print_function
 import os
+import re
 import zipfile
 import io
+import zlib
+import json
+import struct
+import contextlib
+import time
+import heapq
+import collections
+import hashlib
 import platform
 import urllib.request as request
 import tempfile
 import codecs
 import shutil
+import stat
+import errno
+import threading
 import subprocess
+from concurrent import futures
 from appdirs import AppDirs
 import validators
 import traceback
@@ -24,6 +37,16 @@ from PySide6 import QtCore
 logger = logging.getLogger(__name__)
 
 
+def split_patterns(value):
+    """
+    Split a blacklist or whitelist setting into its glob patterns.
+
+    Patterns are separated by new lines or commas.
+    """
+    patterns = re.split(r"[,\n]", value or "")
+    return [pattern.strip() for pattern in patterns if pattern.strip()]
+
+
 def url_exists(path):
     if validators.url(path):
         return True
@@ -211,6 +234,395 @@ def copytree(src, dest, **kwargs):
     shutil.copytree(src, dest, **kwargs)
 
 
+## Materialization -------------------------------------------------------
+# Runtime files that never change are materialized into the output
+# directories with reflinks or hardlinks when the filesystem allows it, so
+# exporting a platform costs metadata operations instead of full copies.
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# From linux/fs.h, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+MATERIALIZE_MODES = ["auto", "reflink", "hardlink", "copy"]
+# Hardlinked files share their data with the cache, so writing to one
+# changes every export using it. They are only used when asked for.
+AUTO_MATERIALIZE_MODES = ["reflink", "copy"]
+
+_materialize_modes = {}
+_materialize_lock = threading.Lock()
+
+
+def reflink(src, dest):
+    """
+    Clone src into dest with the FICLONE ioctl so that both files share
+    their data blocks until one of them is modified.
+
+    Raises:
+        OSError: if the platform or filesystem does not support reflinks
+    """
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported", src)
+
+    with io.open(src, "rb") as src_file:
+        with io.open(dest, "wb") as dest_file:
+            try:
+                fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+            except OSError:
+                dest_file.close()
+                os.remove(dest)
+                raise
+    shutil.copystat(src, dest)
+
+
+def materialize_file(src, dest, mode="copy"):
+    """
+    Materialize a single file with the given mode.
+
+    Args:
+        src (string): the file to materialize
+        dest (string): the destination path, which must not exist
+        mode (string): one of "reflink", "hardlink" or "copy"
+    """
+    if mode == "reflink":
+        reflink(src, dest)
+    elif mode == "hardlink":
+        os.link(src, dest)
+    else:
+        shutil.copy2(src, dest)
+
+
+def _probe_materialize_mode(src, dest):
+    """
+    Find the cheapest mode of AUTO_MATERIALIZE_MODES that works between
+    the filesystems of src and dest by materializing the first file with it.
+
+    Returns:
+        The mode that was used to materialize dest
+    """
+    for mode in AUTO_MATERIALIZE_MODES:
+        try:
+            materialize_file(src, dest, mode)
+            return mode
+        except OSError:
+            if mode == "copy":
+                raise
+    return "copy"
+
+
+def materialize_tree(src, dest, mode="auto", ignore=None):
+    """
+    Recreate the src tree at dest with reflinks, hardlinks or copies.
+
+    In "auto" mode a reflink is tried once between the two filesystems
+    and the result remembered, falling back to copies. Hardlinks are
+    never picked automatically. Any file that cannot be materialized with
+    the requested mode falls back to a copy. Symlinks are recreated as
+    symlinks.
+
+    Files materialized as hardlinks share their data with src, so they
+    must be passed to :py:func:`break_hardlink` before being modified in
+    place.
+
+    Args:
+        src (string): the directory to materialize
+        dest (string): the destination directory, created if needed
+        mode (string): one of "auto", "reflink", "hardlink" or "copy"
+        ignore (callable): same as the ignore argument of shutil.copytree
+
+    Returns:
+        string: the mode that was used for the last file materialized
+    """
+    if is_windows():
+        if os.path.isabs(src) and not src.startswith("\\\\"):
+            src = "\\\\?\\" + src.replace("/", "\\")
+        if os.path.isabs(dest) and not dest.startswith("\\\\"):
+            dest = "\\\\?\\" + dest.replace("/", "\\")
+
+    if mode not in MATERIALIZE_MODES:
+        mode = "auto"
+
+    os.makedirs(dest, exist_ok=True)
+    dev_key = (os.stat(src).st_dev, os.stat(dest).st_dev)
+
+    if mode == "auto":
+        mode = _materialize_modes.get(dev_key, "auto")
+
+    for root, dirs, files in os.walk(src):
+        rel_root = os.path.relpath(root, src)
+        dest_root = os.path.normpath(os.path.join(dest, rel_root))
+
+        ignored = set()
+        if ignore is not None:
+            ignored = ignore(root, dirs + files)
+
+        for name in list(dirs):
+            src_path = os.path.join(root, name)
+            if name in ignored:
+                dirs.remove(name)
+            elif os.path.islink(src_path):
+                # os.walk does not descend into symlinked directories
+                files.append(name)
+            else:
+                os.makedirs(os.path.join(dest_root, name), exist_ok=True)
+
+        for name in files:
+            if name in ignored:
+                continue
+
+            src_path = os.path.join(root, name)
+            dest_path = os.path.join(dest_root, name)
+
+            if os.path.islink(src_path):
+                try:
+                    os.symlink(os.readlink(src_path), dest_path)
+                    continue
+                except OSError:
+                    if os.path.isdir(src_path):
+                        shutil.copytree(src_path, dest_path)
+                        continue
+
+            if mode == "auto":
+                with _materialize_lock:
+                    mode = _materialize_modes.get(dev_key, "auto")
+                    if mode == "auto":
+                        mode = _probe_materialize_mode(src_path, dest_path)
+                        _materialize_modes[dev_key] = mode
+                        logger.info("Materializing files with {}".format(mode))
+                        continue
+
+            try:
+                materialize_file(src_path, dest_path, mode)
+            except OSError:
+                materialize_file(src_path, dest_path, "copy")
+
+        shutil.copystat(root, dest_root)
+
+    return mode
+
+
+def break_hardlink(path, keep_contents=True):
+    """
+    Give path its own copy of its data if it is hardlinked elsewhere so it
+    can be modified in place without changing the other links.
+
+    Args:
+        path (string): the file that is about to be modified
+        keep_contents (bool): if False the file is about to be
+                              overwritten completely, so it is just
+                              unlinked instead of copied
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return
+
+    if not stat.S_ISREG(st.st_mode) or st.st_nlink <= 1:
+        return
+
+    if not keep_contents:
+        os.remove(path)
+        return
+
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    shutil.copy2(path, tmp_path)
+    os.replace(tmp_path, path)
+
+
+## Locking ---------------------------------------------------------------
+# Several exports can run on one machine at the same time, so the shared
+# caches in the download location are guarded by lock files.
+
+try:
+    import msvcrt
+except ImportError:  # POSIX
+    msvcrt = None
+
+
+class FileLock(object):
+    """
+    A lock shared between processes and threads, held on a lock file.
+
+    Shared locks can be held by any number of holders at once, an
+    exclusive lock by one holder only. Windows has no shared locks, so
+    they are exclusive there.
+
+    Use it as a context manager, or call acquire and release.
+    """
+
+    poll_interval = 0.1
+
+    def __init__(self, path, shared=False):
+        self.path = path
+        self.shared = shared
+        self.lock_file = None
+
+    def acquire(self, blocking=True):
+        """
+        Acquire the lock.
+
+        Args:
+            blocking: if False, give up instead of waiting when the lock
+                      is held elsewhere
+
+        Returns:
+            True if the lock was acquired
+        """
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        lock_file = io.open(self.path, "a+b")
+
+        try:
+            if fcntl is not None:
+                flags = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+                if not blocking:
+                    flags |= fcntl.LOCK_NB
+                fcntl.flock(lock_file.fileno(), flags)
+            else:
+                self._lock_windows(lock_file, blocking)
+        except (IOError, OSError) as e:
+            lock_file.close()
+            if not blocking and e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+
+        self.lock_file = lock_file
+        return True
+
+    def _lock_windows(self, lock_file, blocking):
+        lock_file.seek(0)
+        while True:
+            try:
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+                return
+            except OSError:
+                if not blocking:
+                    raise OSError(errno.EAGAIN, "Lock is held", self.path)
+                time.sleep(self.poll_interval)
+
+    def release(self):
+        if self.lock_file is None:
+            return
+
+        if fcntl is not None:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+        else:
+            self.lock_file.seek(0)
+            msvcrt.locking(self.lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+        self.lock_file.close()
+        self.lock_file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def _zip_member_path(dest, arcname):
+    """Get a path for arcname that can not escape dest"""
+    arcname = os.path.splitdrive(arcname.replace("\\", "/"))[1]
+    parts = [part for part in arcname.split("/") if part not in ("", ".", "..")]
+    return os.path.join(dest, *parts)
+
+
+def extract_zip(zip_path, dest, workers=None):
+    """
+    Extract a zip archive with several threads.
+
+    The members are split into partitions of roughly equal uncompressed
+    size, and each worker extracts one partition through its own ZipFile
+    handle. Directories are created up front, the unix permissions stored
+    in external_attr are applied, and symlinks (such as the ones inside the
+    mac framework) are recreated as symlinks.
+
+    Args:
+        zip_path (string): the zip archive to extract
+        dest (string): the directory to extract into
+        workers (int): the number of threads, defaults to the cpu count
+
+    Returns:
+        tuple: the number of bytes extracted and the seconds it took
+    """
+    start_time = time.time()
+
+    with zipfile.ZipFile(zip_path) as archive:
+        infos = archive.infolist()
+
+    os.makedirs(dest, exist_ok=True)
+
+    dirs = []
+    files = []
+    links = []
+
+    for info in infos:
+        target = _zip_member_path(dest, info.filename)
+        mode = info.external_attr >> 16
+
+        if info.is_dir():
+            os.makedirs(target, exist_ok=True)
+            dirs.append((target, mode))
+        elif stat.S_ISLNK(mode):
+            links.append((info, target))
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            files.append((info, target))
+
+    workers = max(1, min(workers or os.cpu_count() or 1, len(files)))
+
+    # Hand the largest remaining member to the lightest partition
+    partitions = [(0, index, []) for index in range(workers)]
+    for info, target in sorted(files, key=lambda item: -item[0].file_size):
+        size, index, members = heapq.heappop(partitions)
+        members.append((info, target))
+        heapq.heappush(partitions, (size + info.file_size, index, members))
+
+    def extract_partition(members):
+        with zipfile.ZipFile(zip_path) as archive:
+            for info, target in members:
+                with archive.open(info) as src, open(target, "wb") as dest_file:
+                    shutil.copyfileobj(src, dest_file, 1024 * 1024)
+
+                mode = info.external_attr >> 16 & 0o7777
+                if mode:
+                    os.chmod(target, mode)
+
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        jobs = [
+            executor.submit(extract_partition, members)
+            for _, _, members in partitions
+            if members
+        ]
+        for job in jobs:
+            job.result()
+
+    with zipfile.ZipFile(zip_path) as archive:
+        for info, target in links:
+            link_target = archive.read(info).decode("utf-8")
+            if os.path.lexists(target):
+                os.remove(target)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            try:
+                os.symlink(link_target, target)
+            except (OSError, NotImplementedError):
+                # No symlink support, keep the link as a plain file
+                with open(target, "wb") as dest_file:
+                    dest_file.write(link_target.encode("utf-8"))
+
+    # Deepest first, so a read-only directory does not block its children
+    for target, mode in sorted(dirs, key=lambda item: -len(item[0])):
+        if mode & 0o7777:
+            os.chmod(target, mode & 0o7777)
+
+    total_bytes = sum(info.file_size for info, _ in files)
+
+    return total_bytes, time.time() - start_time
+
+
 ## ------------------------------------------------------------
 
 
@@ -231,37 +643,789 @@ def open_folder_in_explorer(path):
         subprocess.Popen(["xdg-open", path])
 
 
+ZIP_MANIFEST_VERSION = 1
+
+# Files modified this close to the time the manifest was written are
+# always compressed again, a second change within the same mtime tick
+# would go unnoticed
+ZIP_RACY_INTERVAL = 2.0
+
+
+def zip_manifest_path(zip_file_name):
+    """Get the path of the manifest that is kept next to an archive"""
+    return zip_file_name + ".manifest"
+
+
+def load_zip_manifest(zip_file_name):
+    """
+    Load the manifest of the archive zip_file_name.
+
+    Returns:
+        The manifest dict, or None if there is no usable manifest
+    """
+    try:
+        with codecs.open(zip_manifest_path(zip_file_name), encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if manifest.get("version") != ZIP_MANIFEST_VERSION:
+        return None
+
+    return manifest
+
+
+def zip_entry_data_offset(f, zinfo):
+    """
+    Get the offset of the compressed data of an archive member, after its
+    local header.
+
+    Args:
+        f: the archive opened in binary mode
+        zinfo: the ZipInfo of the member
+    """
+    f.seek(zinfo.header_offset)
+    header = f.read(zipfile.sizeFileHeader)
+
+    if len(header) != zipfile.sizeFileHeader:
+        raise zipfile.BadZipFile("Truncated file header")
+
+    fields = struct.unpack(zipfile.structFileHeader, header)
+
+    if fields[0] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile("Bad magic number for file header")
+
+    # The name and extra field lengths of the local header
+    return zinfo.header_offset + zipfile.sizeFileHeader + fields[10] + fields[11]
+
+
+def read_file_range(f, offset, size, block_size=1024 * 1024):
+    """
+    Read size bytes of f starting at offset.
+
+    Yields:
+        The data in chunks of block_size
+    """
+    f.seek(offset)
+
+    remaining = size
+    while remaining > 0:
+        data = f.read(min(block_size, remaining))
+        if not data:
+            raise zipfile.BadZipFile("Truncated data in {}".format(f.name))
+        remaining -= len(data)
+        yield data
+
+
+def read_raw_zip_entry(f, zinfo, block_size=1024 * 1024):
+    """
+    Read the compressed bytes of an archive member without decompressing
+    them.
+
+    Args:
+        f: the archive opened in binary mode
+        zinfo: the ZipInfo of the member
+
+    Yields:
+        The compressed data in chunks of block_size
+    """
+    offset = zip_entry_data_offset(f, zinfo)
+    return read_file_range(f, offset, zinfo.compress_size, block_size)
+
+
+def write_raw_zip_entry(zip_file, zinfo, chunks):
+    """
+    Write an already compressed member into zip_file.
+
+    zipfile has no public way of doing this, so the local header is
+    written the same way ZipFile.write does it and the entry is then
+    registered for the central directory. This relies on the fp,
+    filelist, NameToInfo, start_dir and _didModify attributes of ZipFile,
+    which are the same from Python 3.6 to 3.13, the version the CI runs.
+    test_write_raw_zip_entry_round_trips checks the result with
+    ZipFile.testzip on the Python that runs the tests.
+
+    Args:
+        zip_file: a ZipFile opened for writing
+        zinfo: the ZipInfo of the member, with the compression type, CRC
+               and sizes of the data already set
+        chunks: an iterable of the compressed data
+    """
+    # The sizes are known up front, so there is no data descriptor
+    zinfo.flag_bits &= ~0x08
+    zinfo.extra = b""
+    zinfo.header_offset = zip_file.fp.tell()
+
+    zip_file.fp.write(zinfo.FileHeader())
+    for chunk in chunks:
+        zip_file.fp.write(chunk)
+
+    zip_file.filelist.append(zinfo)
+    zip_file.NameToInfo[zinfo.filename] = zinfo
+    zip_file.start_dir = zip_file.fp.tell()
+    zip_file._didModify = True
+
+
+def copy_zip_info(zinfo):
+    """Get a new ZipInfo for the data of zinfo, to write into another archive"""
+    new_info = zipfile.ZipInfo(zinfo.filename, zinfo.date_time)
+    new_info.compress_type = zinfo.compress_type
+    new_info.create_system = zinfo.create_system
+    new_info.external_attr = zinfo.external_attr
+    new_info.flag_bits = zinfo.flag_bits
+    new_info.CRC = zinfo.CRC
+    new_info.compress_size = zinfo.compress_size
+    new_info.file_size = zinfo.file_size
+    return new_info
+
+
+def copy_zip_entry(f, zinfo, zip_file):
+    """Copy the member zinfo of the archive f into zip_file as is"""
+    write_raw_zip_entry(zip_file, copy_zip_info(zinfo), read_raw_zip_entry(f, zinfo))
+
+
+# Files that are already compressed are stored as is in a deflated app.nw
+PRECOMPRESSED_EXTENSIONS = {
+    ".png",
+    ".jpg",
+    ".jpeg",
+    ".gif",
+    ".webp",
+    ".ico",
+    ".mp3",
+    ".mp4",
+    ".m4a",
+    ".ogg",
+    ".webm",
+    ".woff",
+    ".woff2",
+    ".zip",
+    ".gz",
+    ".7z",
+}
+
+
+def zip_info(file_path, arcname=None):
+    """Get the ZipInfo of file_path, fixing mtimes the zip format can not store"""
+    try:
+        return zipfile.ZipInfo.from_file(file_path, arcname)
+    except ValueError:
+        os.utime(file_path, None)
+        return zipfile.ZipInfo.from_file(file_path, arcname)
+
+
+class OffsetFile(object):
+    """
+    Wrap a file so that it seems to start at its current position.
+
+    A zip archive written through it has its offsets relative to its own
+    start, as if it was a separate file, even when it is written after
+    other data such as an executable.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.offset = f.tell()
+
+    def write(self, data):
+        return self.f.write(data)
+
+    def tell(self):
+        return self.f.tell() - self.offset
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            pos += self.offset
+        return self.f.seek(pos, whence) - self.offset
+
+    def seekable(self):
+        return True
+
+    def flush(self):
+        self.f.flush()
+
+
+def deflate_file(file_path, level, block_size=1024 * 1024):
+    """
+    Compress a file into a raw deflate stream, the way it is stored in a
+    zip archive.
+
+    Returns:
+        A tuple of the CRC and size of the file and the compressed data
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    crc = 0
+    size = 0
+    chunks = []
+
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            crc = zlib.crc32(block, crc)
+            size += len(block)
+            chunks.append(compressor.compress(block))
+
+    chunks.append(compressor.flush())
+
+    return crc, size, b"".join(chunks)
+
+
+def zip_compression(compresslevel=None):
+    """
+    Get the [compression type, deflate level] of an archive, as it is
+    recorded in its manifest.
+    """
+    if compresslevel is None:
+        return [config.ZIP_MODE, None]
+    elif compresslevel > 0:
+        return [zipfile.ZIP_DEFLATED, compresslevel]
+    return [zipfile.ZIP_STORED, None]
+
+
+def reusable_zip_entries(previous, compression):
+    """
+    Get the manifest entries of the previous archive that can be copied
+    into a new archive with the given compression.
+
+    Entries whose files were modified shortly before the previous archive
+    was written are left out, since a later change to them could keep
+    the same size and mtime.
+
+    Returns:
+        A dict of archive name to [size, mtime_ns, CRC]
+    """
+    if previous is None or not os.path.exists(previous):
+        return {}
+
+    manifest = load_zip_manifest(previous)
+    if manifest is None or manifest.get("compression") != compression:
+        return {}
+
+    racy_limit = manifest["written"] - int(ZIP_RACY_INTERVAL * 1e9)
+    return {
+        name: entry
+        for name, entry in manifest["files"].items()
+        if entry[1] < racy_limit
+    }
+
+
+@contextlib.contextmanager
+def open_zip_for_writing(zip_file_name, compression_type, prefix=None):
+    """
+    Open a ZipFile for writing, after a copy of prefix if one is given.
+
+    The offsets of an archive written after prefix stay relative to the
+    start of the archive.
+    """
+    zip_fp = zip_file_name
+    if prefix is not None:
+        join_files(zip_file_name, prefix)
+        zip_fp = io.open(zip_file_name, "r+b")
+        zip_fp.seek(0, os.SEEK_END)
+        zip_fp = OffsetFile(zip_fp)
+
+    zip_file = zipfile.ZipFile(zip_fp, "w", compression_type)
+    try:
+        yield zip_file
+    finally:
+        zip_file.close()
+        if prefix is not None:
+            zip_fp.f.close()
+
+
+def write_zip_manifest(zip_file_name, compression, files, written=None):
+    """
+    Write the manifest of an archive next to it.
+
+    Args:
+        compression: the [compression type, deflate level] of the archive
+        files: a dict of archive name to [size, mtime_ns, CRC]
+        written: the time in ns the files were read, defaults to now
+    """
+    manifest = {
+        "version": ZIP_MANIFEST_VERSION,
+        "compression": compression,
+        "written": written or time.time_ns(),
+        "files": files,
+    }
+
+    with codecs.open(zip_manifest_path(zip_file_name), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, separators=(",", ":"))
+
+
 def zip_files(zip_file_name, project_dir, *args, **kwargs):
     """
     Zip files into an archive programmatically.
 
+    A manifest of the size, mtime and CRC of every file is written next to
+    the archive. When the archive of a previous build is given, the files
+    that did not change since then are copied over as compressed bytes
+    instead of being read and compressed again.
+
+    With a compression level above 0, the files are deflated in a thread
+    pool as independent streams and written to the archive in order by
+    this thread. zlib releases the GIL while compressing, so this scales
+    with the number of cores. Already compressed file types are stored.
+
     Args:
         zip_file_name (string): the name of the resulting zip file
         args: the files to zip
         kwargs: Options
             verbose (bool): if True, gives verbose output
             exclude_paths (list): a list of paths to exclude
+            previous (string): the archive of a previous build along with
+                               its manifest
+            compresslevel (int): the deflate level from 0 to 9, 0 stores
+                                 the files. If not given, config.ZIP_MODE
+                                 is used
+            workers (int): the number of compression threads
+            prefix (string): a file, such as the NW.js executable, to copy
+                             into zip_file_name before the archive. The
+                             archive offsets stay relative to its start
+            manifest (bool): if False, no manifest is written
+
+    Returns:
+        A tuple of the number of files copied from the previous archive
+        and the number of files that were compressed
     """
-    zip_file = zipfile.ZipFile(zip_file_name, "w", config.ZIP_MODE)
     verbose = kwargs.pop("verbose", False)
-    old_path = os.getcwd()
+    previous = kwargs.pop("previous", None)
+    compresslevel = kwargs.pop("compresslevel", None)
+    workers = kwargs.pop("workers", None) or os.cpu_count() or 1
+    prefix = kwargs.pop("prefix", None)
+    write_manifest = kwargs.pop("manifest", True)
+
+    compression = zip_compression(compresslevel)
+
+    previous_files = reusable_zip_entries(previous, compression)
+    previous_zip = None
+
+    if previous_files:
+        try:
+            previous_zip = zipfile.ZipFile(previous)
+        except (IOError, OSError, zipfile.BadZipFile):
+            previous_files = {}
+
+    files = {}
+    copied = 0
+    compressed = 0
+
+    # Entries waiting to be written, in the order of args. Deflated
+    # entries hold the future of their compressed data.
+    pending = collections.deque()
+    max_pending = workers * 4
+
+    def write_pending(limit):
+        while len(pending) > limit:
+            zinfo, file_path, st, future = pending.popleft()
+
+            if future is None:
+                zip_file.write(
+                    file_path, zinfo.filename, compress_type=zinfo.compress_type
+                )
+                crc = zip_file.filelist[-1].CRC
+            else:
+                crc, size, data = future.result()
+                zinfo.CRC = crc
+                zinfo.file_size = size
+                zinfo.compress_size = len(data)
+                write_raw_zip_entry(zip_file, zinfo, [data])
+
+            files[zinfo.filename] = [st.st_size, st.st_mtime_ns, crc]
+
+    with contextlib.ExitStack() as stack:
+        zip_file = stack.enter_context(
+            open_zip_for_writing(zip_file_name, compression[0], prefix)
+        )
+
+        previous_f = None
+        if previous_zip is not None:
+            stack.enter_context(previous_zip)
+            previous_f = stack.enter_context(open(previous, "rb"))
+
+        executor = None
+        if compression[1] is not None:
+            executor = stack.enter_context(
+                futures.ThreadPoolExecutor(max_workers=workers)
+            )
 
-    os.chdir(project_dir)
+        for arg in args:
+            file_path = os.path.join(project_dir, arg)
+            if not os.path.exists(file_path):
+                continue
 
-    for arg in args:
-        if os.path.exists(arg):
-            file_loc = arg
             if verbose:
-                log(file_loc)
-            try:
-                zip_file.write(file_loc)
-            except ValueError:
-                os.utime(file_loc, None)
-                zip_file.write(file_loc)
+                log(arg)
+
+            if os.path.isdir(file_path):
+                zip_file.write(file_path, arg)
+                continue
+
+            zinfo = zip_info(file_path, arg)
+            st = os.stat(file_path)
+            entry = previous_files.get(zinfo.filename)
+
+            if (
+                entry is not None
+                and entry[0] == st.st_size
+                and entry[1] == st.st_mtime_ns
+            ):
+                try:
+                    previous_info = previous_zip.getinfo(zinfo.filename)
+                except KeyError:
+                    previous_info = None
+
+                if previous_info is not None and previous_info.CRC == entry[2]:
+                    write_pending(0)
+                    copy_zip_entry(previous_f, previous_info, zip_file)
+                    files[zinfo.filename] = entry
+                    copied += 1
+                    continue
+
+            compressed += 1
+            ext = os.path.splitext(arg)[1].lower()
+            future = None
+
+            if executor is None:
+                zinfo.compress_type = compression[0]
+            elif ext in PRECOMPRESSED_EXTENSIONS:
+                zinfo.compress_type = zipfile.ZIP_STORED
+            else:
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+                future = executor.submit(deflate_file, file_path, compression[1])
+
+            pending.append((zinfo, file_path, st, future))
+            write_pending(max_pending)
+
+        write_pending(0)
+
+    if write_manifest:
+        write_zip_manifest(zip_file_name, compression, files)
+
+    return copied, compressed
+
+
+def crc_file(file_path, block_size=1024 * 1024):
+    """
+    Get the CRC and size of a file, as they are recorded for a member
+    stored in a zip archive.
+    """
+    crc = 0
+    size = 0
+
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            crc = zlib.crc32(block, crc)
+            size += len(block)
+
+    return crc, size
+
+
+class ZipEntries(object):
+    """
+    The members of a zip archive, compressed once so that the same bytes
+    can be written into any number of archives with
+    :py:func:`write_zip_entries`.
+
+    Deflated data is kept in memory. Stored files and the members reused
+    from a previous archive are read from their files every time they are
+    written, so those files must not change until the last archive has
+    been written.
+    """
+
+    def __init__(self, compression):
+        self.compression = compression
+        # (ZipInfo, data, path, offset) for every member, where the
+        # compressed data is either data or read from path at offset
+        self.members = []
+        self.files = {}
+        self.copied = 0
+        self.compressed = 0
+        self.written = None
+
+    def add(self, zinfo, data=None, path=None, offset=0):
+        self.members.append((zinfo, data, path, offset))
+
+    def chunks(self, member):
+        """Get the compressed data of a member in chunks"""
+        zinfo, data, path, offset = member
+
+        if data is not None:
+            yield data
+            return
+
+        if path is None or not zinfo.compress_size:
+            return
+
+        with io.open(path, "rb") as f:
+            for chunk in read_file_range(f, offset, zinfo.compress_size):
+                yield chunk
+
+
+def prepare_zip_entries(project_dir, *args, **kwargs):
+    """
+    Compress files once for any number of archives.
+
+    Takes the same options as :py:func:`zip_files` except for prefix and
+    manifest, and compresses the files the same way. Every file is
+    compressed at once in a thread pool instead of a few at a time, so the
+    deflated data of the whole archive is held in memory.
+
+    Returns:
+        A :py:class:`ZipEntries` of the members
+    """
+    verbose = kwargs.pop("verbose", False)
+    previous = kwargs.pop("previous", None)
+    compresslevel = kwargs.pop("compresslevel", None)
+    workers = kwargs.pop("workers", None) or os.cpu_count() or 1
+
+    compression = zip_compression(compresslevel)
+    entries = ZipEntries(compression)
+
+    previous_files = reusable_zip_entries(previous, compression)
+    previous_zip = None
+
+    if previous_files:
+        try:
+            previous_zip = zipfile.ZipFile(previous)
+        except (IOError, OSError, zipfile.BadZipFile):
+            previous_files = {}
+
+    # The CRC, size and data of the changed files, in the order of args
+    pending = []
+
+    with contextlib.ExitStack() as stack:
+        previous_f = None
+        if previous_zip is not None:
+            stack.enter_context(previous_zip)
+            previous_f = stack.enter_context(open(previous, "rb"))
+
+        executor = stack.enter_context(futures.ThreadPoolExecutor(max_workers=workers))
+
+        for arg in args:
+            file_path = os.path.join(project_dir, arg)
+            if not os.path.exists(file_path):
+                continue
+
+            if verbose:
+                log(arg)
+
+            zinfo = zip_info(file_path, arg)
+
+            if os.path.isdir(file_path):
+                zinfo.compress_size = 0
+                zinfo.CRC = 0
+                entries.add(zinfo, data=b"")
+                continue
+
+            st = os.stat(file_path)
+            entry = previous_files.get(zinfo.filename)
+
+            if (
+                entry is not None
+                and entry[0] == st.st_size
+                and entry[1] == st.st_mtime_ns
+            ):
+                try:
+                    previous_info = previous_zip.getinfo(zinfo.filename)
+                except KeyError:
+                    previous_info = None
+
+                if previous_info is not None and previous_info.CRC == entry[2]:
+                    offset = zip_entry_data_offset(previous_f, previous_info)
+                    entries.add(
+                        copy_zip_info(previous_info), path=previous, offset=offset
+                    )
+                    entries.files[zinfo.filename] = entry
+                    entries.copied += 1
+                    continue
+
+            entries.compressed += 1
+            ext = os.path.splitext(arg)[1].lower()
+
+            if compression[0] == zipfile.ZIP_DEFLATED and (
+                compression[1] is None or ext not in PRECOMPRESSED_EXTENSIONS
+            ):
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+                level = compression[1]
+                if level is None:
+                    level = zlib.Z_DEFAULT_COMPRESSION
+                future = executor.submit(deflate_file, file_path, level)
+            else:
+                zinfo.compress_type = zipfile.ZIP_STORED
+                future = executor.submit(crc_file, file_path)
+
+            entries.add(zinfo, path=file_path)
+            pending.append((len(entries.members) - 1, st, future))
+
+        for index, st, future in pending:
+            zinfo, _, path, _ = entries.members[index]
+            result = future.result()
+            zinfo.CRC = result[0]
+            zinfo.file_size = result[1]
+
+            if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+                zinfo.compress_size = len(result[2])
+                entries.members[index] = (zinfo, result[2], None, 0)
+            else:
+                zinfo.compress_size = zinfo.file_size
+
+            entries.files[zinfo.filename] = [st.st_size, st.st_mtime_ns, zinfo.CRC]
+
+    entries.written = time.time_ns()
+
+    return entries
+
+
+def write_zip_entries(zip_file_name, entries, prefix=None, manifest=True):
+    """
+    Write prepared members into an archive without compressing them again.
+
+    Args:
+        zip_file_name (string): the name of the resulting zip file
+        entries: the :py:class:`ZipEntries` returned by prepare_zip_entries
+        prefix (string): a file to copy into zip_file_name before the
+                         archive, as with zip_files
+        manifest (bool): if False, no manifest is written
+    """
+    with open_zip_for_writing(
+        zip_file_name, entries.compression[0], prefix
+    ) as zip_file:
+        for member in entries.members:
+            write_raw_zip_entry(
+                zip_file, copy_zip_info(member[0]), entries.chunks(member)
+            )
+
+    if manifest:
+        write_zip_manifest(
+            zip_file_name, entries.compression, entries.files, entries.written
+        )
+
+
+def hash_path(path, algorithm="sha256", block_size=1024 * 1024):
+    """
+    Compute a content hash for a file or a directory tree.
+
+    Directories are hashed over their sorted relative file paths and the
+    contents of each file, so two trees with the same layout and contents
+    produce the same digest regardless of where they are located.
+
+    Args:
+        path (string): the file or directory to hash
+        algorithm (string): any algorithm supported by hashlib
+        block_size (int): the size of the chunks read from each file
+
+    Returns:
+        string: the hex digest of the contents
+    """
+    digest = hashlib.new(algorithm)
+
+    def update_from_file(file_path):
+        with io.open(file_path, "rb") as f:
+            while True:
+                chunk = f.read(block_size)
+                if not chunk:
+                    break
+                digest.update(chunk)
+
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            rel_root = os.path.relpath(root, path).replace(os.sep, "/")
+            for file_name in sorted(files):
+                rel_path = "/".join([rel_root, file_name])
+                digest.update(rel_path.encode("utf-8") + b"\0")
+                update_from_file(os.path.join(root, file_name))
+    else:
+        update_from_file(path)
+
+    return digest.hexdigest()
+
+
+JOIN_METHODS = ["reflink", "copy_file_range", "sendfile", "readinto"]
+
+COPY_BLOCK_SIZE = 1024 * 1024
+
+
+def _copy_file_range(src, dest, count):
+    return os.copy_file_range(src.fileno(), dest.fileno(), count)
+
+
+def _sendfile(src, dest, count):
+    return os.sendfile(dest.fileno(), src.fileno(), None, count)
+
+
+def _copy_with(copy_chunk, src, dest, count):
+    """
+    Copy count bytes between the current offsets of src and dest with
+    copy_chunk.
+
+    Returns:
+        The number of bytes copied, or None if copy_chunk is not supported
+        for these files and nothing was copied
+    """
+    copied = 0
+    while copied < count:
+        try:
+            num_bytes = copy_chunk(src, dest, min(count - copied, 1 << 30))
+        except OSError:
+            if copied:
+                raise
+            return None
+        if num_bytes == 0:
+            break
+        copied += num_bytes
+
+    if copied == 0 and count:
+        return None
+
+    return copied
+
+
+def _readinto_copy(src, dest, count):
+    buf = memoryview(bytearray(max(1, min(COPY_BLOCK_SIZE, count))))
+    copied = 0
+    while copied < count:
+        num_bytes = src.readinto(buf[: min(len(buf), count - copied)])
+        if not num_bytes:
+            break
+        view = buf[:num_bytes]
+        while view:
+            view = view[dest.write(view) :]
+        copied += num_bytes
+    return copied
+
+
+_file_copiers = {}
+if hasattr(os, "copy_file_range"):
+    _file_copiers["copy_file_range"] = _copy_file_range
+if hasattr(os, "sendfile") and platform.system() == "Linux":
+    # Other platforms only support sending to sockets
+    _file_copiers["sendfile"] = _sendfile
+
+
+def copy_file_data(src, dest, count, methods=None):
+    """
+    Copy count bytes from the current offset of src to the current offset
+    of dest, letting the kernel copy the data where it can.
 
-    os.chdir(old_path)
+    Args:
+        src: an unbuffered file opened for reading
+        dest: an unbuffered file opened for writing
+        methods (list): the copy methods to try in order, out of
+                        "copy_file_range", "sendfile" and "readinto"
 
-    zip_file.close()
+    Returns:
+        The method that copied the data
+    """
+    methods = methods or JOIN_METHODS
+
+    for method in methods:
+        copy_chunk = _file_copiers.get(method)
+        if copy_chunk is not None and _copy_with(copy_chunk, src, dest, count):
+            return method
+
+    _readinto_copy(src, dest, count)
+    return "readinto"
 
 
 def join_files(destination, *args, **kwargs):
@@ -271,34 +1435,67 @@ def join_files(destination, *args, **kwargs):
     This is used to take advantage of NW.js's ability to execute a zip file
     contained at the end of the exe file.
 
+    The first file is reflinked where the file system supports it, so the
+    executable shares its blocks with the runtime. The other files are
+    copied with copy_file_range or sendfile so the data does not pass
+    through Python, falling back to large readinto copies.
+
     Args:
         destination (string): the name of the resulting file
         args: the files to stitch together
+        kwargs: Options
+            methods (list): the methods to try in order, out of
+                            JOIN_METHODS
+
+    Returns:
+        The method used to copy the last file
     """
-    with io.open(destination, "wb") as dest_file:
-        for arg in args:
-            if os.path.exists(arg):
-                with io.open(arg, "rb") as file:
-                    while True:
-                        bytes = file.read(4096)
-                        if len(bytes) == 0:
-                            break
-                        dest_file.write(bytes)
+    methods = kwargs.pop("methods", None) or JOIN_METHODS
+    paths = [arg for arg in args if os.path.exists(arg)]
+    method = None
+
+    if paths and "reflink" in methods:
+        try:
+            reflink(paths[0], destination)
+        except OSError:
+            pass
+        else:
+            method = "reflink"
+            paths = paths[1:]
+
+    # copy_file_range does not write to files opened for appending
+    with io.open(destination, "r+b" if method else "wb", buffering=0) as dest_file:
+        dest_file.seek(0, os.SEEK_END)
 
+        for path in paths:
+            with io.open(path, "rb", buffering=0) as file:
+                size = os.fstat(file.fileno()).st_size
+                method = copy_file_data(file, dest_file, size, methods)
 
-def urlopen(url):
+    return method
+
+
+def urlopen(url, headers=None, method=None, timeout=None):
     """
     Call urllib.request.urlopen with a modified SSL context to prevent
     "SSL: CERTIFICATE_VERIFY_FAILED” errors when no verification is
     actually needed.
+
+    Args:
+        url (string): the url to open
+        headers (dict): extra headers to send, such as Range
+        method (string): the HTTP method, defaults to GET
+        timeout (float): the seconds the connection or a read may stall,
+                         defaults to config.URL_TIMEOUT
     """
-    req = request.Request(
-        url,
-        headers={
-            "User-Agent": "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1941.0 Safari/537.36"
-        },
+    req_headers = {
+        "User-Agent": "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1941.0 Safari/537.36"
+    }
+    req_headers.update(headers or {})
+    req = request.Request(url, headers=req_headers, method=method)
+    return request.urlopen(
+        req, context=config.SSL_CONTEXT, timeout=timeout or config.URL_TIMEOUT
     )
-    return request.urlopen(req, context=config.SSL_CONTEXT)
 
 
 # To avoid a circular import, we import config at the bottom of the file